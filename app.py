@@ -0,0 +1,547 @@
+# encoding: utf-8
+import ctypes
+import logging
+import os
+import sys
+import threading
+import time
+import tkinter as tk
+from ctypes import wintypes
+from tkinter import messagebox
+
+import keyring
+import portalocker
+import pystray
+from piabackup import APP_GITHUB_ID, APP_VERSION, APPNAME
+import ui.tools
+from PIL import Image, ImageDraw
+from ui.github_update_checker import GithubUpdateChecker
+from ui.licenses_window import LicensesWindow
+from ui.tkless import TkLess
+from windows_toasts import Toast
+
+import piabackup.common as common
+from piabackup.backup_cost import BackupCost
+from piabackup.backup_dir import BackupDir
+from piabackup.change_watcher import ChangeWatcher
+from piabackup.config import Config
+from piabackup.db import DB
+from piabackup.disclaimer_window import DisclaimerWindow
+from piabackup.fast_scan_pool import FastScanPool
+from piabackup.password_dialog import PasswordDialog
+from piabackup.rclone_server import RcloneServer
+from piabackup.scheduler import Scheduler
+from piabackup.settings_window import SettingsWindow
+from piabackup.tools_installer import ToolsInstaller
+from piabackup.worker_thread import (AutoDiscoveryTask, BackupTask,
+                                     PermanentTagBatch, PrescanBatch,
+                                     RepoFullCheckTask, SnapshotListing,
+                                     TagVanishedTask, WorkerThread)
+
+# Global variables
+root:tk.Tk|None = None
+tray_icon = None
+app_lock_handle = None
+lock_file_handle = None
+settings_window = None
+log_window = None
+disclaimer_window = None
+licenses_window = None
+scheduler_timer = None
+last_error_check_time = 0
+scheduler = Scheduler()
+sched_cfg:Config|None = None
+sched_env:dict|None = None   # None while the repository isn't usable
+sched_entries:dict[int, BackupDir] = {}
+
+WM_POWERBROADCAST = 0x218
+PBT_APMPOWERSTATUSCHANGE = 0xA
+PBT_APMRESUMEAUTOMATIC = 0x12
+PBT_APMRESUMESUSPEND = 0x7
+PBT_APMSUSPEND = 0x4
+PBT_POWERSETTINGCHANGE = 0x8013
+
+old_wnd_proc = None
+
+def wnd_proc(hwnd, msg, wparam, lparam):
+    logging.debug(f"wnd_proc: {hwnd} {msg} {wparam} {lparam}")
+    if msg == WM_POWERBROADCAST:
+        event_name = f"UNKNOWN({wparam})"
+        if wparam == PBT_APMPOWERSTATUSCHANGE: event_name = "PBT_APMPOWERSTATUSCHANGE"
+        elif wparam == PBT_APMRESUMEAUTOMATIC:
+            event_name = "PBT_APMRESUMEAUTOMATIC"
+            common.system_suspended = False
+            common.system_last_resumed = time.time()
+        elif wparam == PBT_APMRESUMESUSPEND:
+            event_name = "PBT_APMRESUMESUSPEND"
+            common.system_suspended = False
+            common.system_last_resumed = time.time()
+        elif wparam == PBT_APMSUSPEND:
+            event_name = "PBT_APMSUSPEND"
+            common.system_suspended = True
+        elif wparam == PBT_POWERSETTINGCHANGE: event_name = "PBT_POWERSETTINGCHANGE"
+        logging.debug(f"WM_POWERBROADCAST: {event_name}")
+
+    return ctypes.windll.user32.CallWindowProcW(old_wnd_proc, hwnd, msg, wparam, lparam)
+
+new_proc = 0
+def setup_power_broadcast_logging(root):
+    global old_wnd_proc, new_proc
+    hwnd = root.winfo_id()
+    
+    # 1. Force the OS to physically build the window before we grab its ID
+    root.update_idletasks()
+    
+    # 2. Get the Tkinter HWND
+    tk_hwnd = root.winfo_id()
+    
+    # 3. Traverse up to find the true top-level OS window (GA_ROOT = 2)
+    GA_ROOT = 2
+    hwnd = ctypes.windll.user32.GetAncestor(tk_hwnd, GA_ROOT)
+    
+    logging.debug(f"Tkinter HWND: {tk_hwnd} | True Top-Level HWND: {hwnd}")
+
+    RegisterSuspendResumeNotification = ctypes.windll.user32.RegisterSuspendResumeNotification
+    RegisterSuspendResumeNotification.argtypes = [wintypes.HANDLE, wintypes.DWORD]
+    RegisterSuspendResumeNotification.restype = wintypes.HANDLE
+    DEVICE_NOTIFY_WINDOW_HANDLE = 0x00000000
+    hPowerNotify = RegisterSuspendResumeNotification(wintypes.HANDLE(hwnd), DEVICE_NOTIFY_WINDOW_HANDLE)
+    if not hPowerNotify:
+        logging.error(f"Failed to register for power notifications. Error: {ctypes.GetLastError()}")
+    else:
+        logging.debug(f"Successfully registered for power notifications. Handle: {hPowerNotify}")
+
+    is_64bit = ctypes.sizeof(ctypes.c_void_p) == 8
+    GWL_WNDPROC = -4
+    
+    # LRESULT CALLBACK WndProc(HWND, UINT, WPARAM, LPARAM)
+    LRESULT = ctypes.c_longlong if is_64bit else ctypes.c_long
+    WPARAM = ctypes.c_ulonglong if is_64bit else ctypes.c_uint
+    LPARAM = ctypes.c_longlong if is_64bit else ctypes.c_long
+    
+    WNDPROC = ctypes.WINFUNCTYPE(LRESULT, ctypes.c_void_p, ctypes.c_uint, WPARAM, LPARAM)
+    
+    new_proc = WNDPROC(wnd_proc)
+    
+    CallWindowProc = ctypes.windll.user32.CallWindowProcW
+    CallWindowProc.restype = LRESULT
+    CallWindowProc.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, WPARAM, LPARAM]
+    
+    SetWindowLongPtr = ctypes.windll.user32.SetWindowLongPtrW if is_64bit else ctypes.windll.user32.SetWindowLongW
+    SetWindowLongPtr.restype = ctypes.c_void_p
+    SetWindowLongPtr.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+    
+    old_wnd_proc = SetWindowLongPtr(hwnd, GWL_WNDPROC, new_proc)
+    logging.debug(f"old_wnd_proc={old_wnd_proc}, new_proc={new_proc}")
+
+def acquire_lock():
+    global app_lock_handle, lock_file_handle
+    kernel32 = ctypes.windll.kernel32
+    name = f"Global\\{APPNAME}_SingleInstance"
+    
+    app_lock_handle = kernel32.CreateSemaphoreW(None, 1, 1, name)
+    if not app_lock_handle:
+        name = f"Local\\{APPNAME}_SingleInstance"
+        app_lock_handle = kernel32.CreateSemaphoreW(None, 1, 1, name)
+
+    if not app_lock_handle:
+        return False
+
+    if ctypes.get_last_error() == 183: # ERROR_ALREADY_EXISTS
+        return False
+        
+    try:
+        lock_file_handle = open(common.LOCK_FILE_PATH, 'a')
+        portalocker.lock(lock_file_handle, portalocker.LOCK_EX | portalocker.LOCK_NB)
+    except portalocker.LockException:
+        return False
+
+    return True
+
+def create_image():
+    # Create a simple icon
+    width = 64
+    height = 64
+    image = Image.new('RGB', (width, height), color=(73, 109, 137))
+    dc = ImageDraw.Draw(image)
+    dc.rectangle((16, 16, 48, 48), fill=(255, 255, 255))
+    return image
+
+def check_worker_and_exit():
+    if WorkerThread.isalive():
+        root.after(100, check_worker_and_exit)
+    else:
+        logging.debug("worker thread finished, exiting.")
+        RcloneServer.stop()
+        if tray_icon:
+            tray_icon.stop()
+        root.destroy()
+
+def quit_app():
+    logging.info("user requested app termination")
+    common.shutdown_requested = True
+    ChangeWatcher.shutdown()
+    FastScanPool.shutdown()
+    WorkerThread.shutdown()
+    logging.debug("waiting for worker thread to finish...")
+    check_worker_and_exit()
+
+def open_settings():
+    global settings_window, disclaimer_window
+    if settings_window and settings_window.winfo_exists():
+        settings_window.lift()
+        settings_window.focus_force()
+        return
+
+    if disclaimer_window and disclaimer_window.winfo_exists():
+        disclaimer_window.lift()
+        disclaimer_window.focus_force()
+        return
+
+    cfg = Config()
+    if cfg.disclaimer_accepted:
+        settings_window = SettingsWindow(root, on_trigger_run=lambda manually=False: root.after(0, lambda: reload_scheduler(manually)))
+    else:
+        def on_accept():
+            global settings_window
+            settings_window = SettingsWindow(root, on_trigger_run=lambda manually=False: root.after(0, lambda: reload_scheduler(manually)))
+        disclaimer_window = DisclaimerWindow(root, on_accept, quit_app)
+
+def open_log():
+    global log_window
+    if log_window and log_window.root.winfo_exists():
+        log_window.root.lift()
+        log_window.root.focus_force()
+        return
+    log_window = TkLess(root, common.LOG_FILE_PATH)
+
+def open_licenses():
+    global licenses_window
+    if licenses_window and licenses_window.winfo_exists():
+        licenses_window.lift()
+        licenses_window.focus_force()
+        return
+    
+    extra_licenses = []
+    tools_info = get_tools_info()
+    
+    for name, info in tools_info.items():
+        path = os.path.join(common.BIN_DL_DIR, info["license_filename"])
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    extra_licenses.append({
+                        "Name": name,
+                        "Version": "Installed",
+                        "License": "See Text",
+                        "LicenseText": f.read(),
+                        "URL": info["project_url"],
+                        "Author": f"{name} Team"
+                    })
+            except Exception as e:
+                logging.error(f"Failed to read license for {name}: {e}")
+
+    licenses_window = LicensesWindow(root, extra_licenses=extra_licenses)
+
+def reload_scheduler(manually_triggered=False):
+    """ Reads settings, password and backup folders and rebuilds the schedule. Only needed when those changed. """
+    global sched_cfg, sched_env, sched_entries
+    scheduler.clear()
+    sched_entries = {}
+    sched_env = None
+    now = time.time()
+
+    try:
+        cfg = sched_cfg = Config()
+        WorkerThread.configure(cfg)
+
+        env = os.environ.copy()
+        ready = False
+        if cfg.repo:
+            password = keyring.get_password(APPNAME, "repository")
+            if not password:
+                def open_pwd_dialog(args):
+                    if root: root.after(0, lambda: PasswordDialog(root))
+                toast = Toast()
+                toast.text_fields = ["Backup Failed", "Repository password is not set. Click to set it."]
+                toast.on_activated = open_pwd_dialog
+                common.wintoaster.show_toast(toast)
+                logging.warning("Backup skipped: Password not set")
+                scheduler.schedule(Scheduler.RELOAD, None, now + 300)
+            else:
+                env["RESTIC_REPOSITORY"] = cfg.repo
+                env["RESTIC_PASSWORD"] = password
+                ready = True
+        elif "RESTIC_REPOSITORY" in os.environ:
+            ready = True
+
+        if ready:
+            sched_env = env
+            # up by the time the first backups are due
+            RcloneServer.request(env, cfg.rclone_serve)
+            entries = BackupDir.fetch_enabled_backup_rows()
+            ChangeWatcher.sync(entries if cfg.change_watcher else [])
+            for entry in entries:
+                sched_entries[entry.id] = entry
+                scheduler.schedule(Scheduler.BACKUP, entry.id, entry.next_run)
+            schedule_full_check()
+            scheduler.schedule(Scheduler.ERRORS, None, last_error_check_time + cfg.error_check_frequency)
+            if cfg.auto_discovery:
+                schedule_auto_discovery()
+            logging.debug(f"Scheduler reloaded: {len(scheduler)} events")
+    except Exception as e:
+        logging.exception(f"Scheduler error: {e}")
+        scheduler.schedule(Scheduler.RELOAD, None, now + 60)
+
+    check_scheduler(manually_triggered)
+
+def schedule_full_check():
+    with common.db_conn as conn:
+        last_full_check = float(conn.execute("SELECT value FROM status WHERE key = 'last_full_check'").fetchone()[0])
+    scheduler.schedule(Scheduler.CHECK, None, last_full_check + sched_cfg.full_check_frequency)
+
+def schedule_auto_discovery():
+    with common.db_conn as conn:
+        row = conn.execute("SELECT value FROM status WHERE key = 'last_auto_discovery'").fetchone()
+    last_auto_discovery = float(row[0]) if row else 0
+    scheduler.schedule(Scheduler.DISCOVERY, None, last_auto_discovery + 86400)
+
+class ScheduledBackupTask(BackupTask):
+    def on_final(self):
+        super().on_final()
+        entry = self.backup_dir
+        if entry.id in sched_entries:
+            if self.deferred:
+                # nothing got saved, the task's copy may carry state of a run that didn't happen
+                entry = BackupDir.fetch_enabled_backup_row(entry.id)
+            if entry is None:
+                del sched_entries[self.backup_dir.id]
+            else:
+                # the task's copy has the latest result, even if the schedule got reloaded meanwhile
+                sched_entries[entry.id] = entry
+                scheduler.schedule(Scheduler.BACKUP, entry.id, entry.next_run)
+        if root: root.after(0, check_scheduler)
+
+class ScheduledCheckTask(RepoFullCheckTask):
+    def on_final(self):
+        if sched_cfg is not None:
+            schedule_full_check()
+        if root: root.after(0, check_scheduler)
+
+class ScheduledDiscoveryTask(AutoDiscoveryTask):
+    def on_final(self):
+        # new folders may have been added
+        if root: root.after(0, reload_scheduler)
+
+def run_due_backups(entries:list[BackupDir], env, now, manually_triggered):
+    cfg = sched_cfg
+    idle_sec = common.get_idle_duration_seconds() if cfg.wait_for_idle and not manually_triggered else None
+    due_entries = []
+    for entry in entries:
+        if idle_sec is not None and idle_sec < common.INACTIVITY_TIMEOUT:
+            overdue = now - entry.next_run
+            max_wait = entry.frequency / 2
+            if overdue < max_wait:
+                logging.debug(f"Postponing backup for {entry.path} (User active, overdue {overdue:.0f}s)")
+                scheduler.schedule(Scheduler.BACKUP, entry.id, now + max(5, min(60, max_wait - overdue)))
+                if cfg.prescan_enabled and cfg.prescan_budget > 0 and entry.id not in BackupTask.deferred_ids:
+                    # the budgeted prescan is cheap enough to run while the user is active
+                    WorkerThread.submit_task(ScheduledBackupTask(env, entry, cfg, prescan_only=True, task_id=f"backup_{entry.id}"))
+                continue
+        due_entries.append(entry)
+
+    if len(due_entries) > 1:
+        due_entries = order_due_backups(due_entries, now, cfg.backup_slots)
+
+    # a task that is still queued or running reschedules its folder when it is done
+    prescan_batch = PrescanBatch(due_entries, cfg)
+    snapshot_listing = SnapshotListing(env, cfg.no_lock)
+    tag_batch = PermanentTagBatch(due_entries) if cfg.make_vanished_permanent else None
+    for entry in due_entries:
+        if not WorkerThread.submit_task(ScheduledBackupTask(env, entry, cfg, prescan_batch=prescan_batch, snapshot_listing=snapshot_listing,
+                                                            tag_batch=tag_batch, task_id=f"backup_{entry.id}")):
+            prescan_batch.discard(entry.id)
+            if tag_batch:
+                tag_batch.checked(entry.id)
+    if tag_batch and due_entries:
+        # runs after the backups got past their check for vanished folders
+        WorkerThread.submit_task(TagVanishedTask(env, tag_batch, snapshot_listing, cfg.no_lock, task_id="tag_vanished"))
+
+def order_due_backups(entries:list[BackupDir], now, slots) -> list[BackupDir]:
+    """ Shortest predicted backup first within the fairness bound, see BackupCost. """
+    with common.db_conn as conn:
+        cost = BackupCost(conn)
+    # backups submitted earlier still occupy the slots
+    busy = [BackupCost.queue_done_at] * slots if BackupCost.queue_done_at > now else None
+    order, done_at = cost.plan([(e.id, e.next_run) for e in entries], now, slots, busy)
+    BackupCost.queue_done_at = done_at
+    by_id = {e.id: e for e in entries}
+    size = sum(cost.predict_bytes(id) or 0 for id in order)
+    logging.info(f"{len(order)} backups due, about {common.format_bytes(size)} to read, predicted to be done at {time.strftime('%H:%M', time.localtime(done_at))}")
+    return [by_id[id] for id in order]
+
+def run_full_check(env, now):
+    with common.db_conn as conn:
+        last_full_check = float(conn.execute("SELECT value FROM status WHERE key = 'last_full_check'").fetchone()[0])
+        row = conn.execute("SELECT value FROM status WHERE key = 'last_full_check_segment'").fetchone()
+    last_full_check_segment = int(row[0]) if row else 0
+
+    segment_to_run = None
+    if last_full_check_segment >= 0 and last_full_check_segment < common.FULL_CHECK_SEGMENTS:
+        segment_to_run = last_full_check_segment + 1
+    elif last_full_check + sched_cfg.full_check_frequency <= now:
+        segment_to_run = 0
+
+    if segment_to_run is None or not WorkerThread.submit_task(ScheduledCheckTask(env, sched_cfg, segment_to_run, task_id="full_repo_check")):
+        # nothing to do or already running, the running check schedules the next segment
+        if segment_to_run is None:
+            schedule_full_check()
+
+def show_errors(now):
+    global last_error_check_time
+    cfg = sched_cfg
+    # from the database, bitrot checks and prunes write their errors there and not into the scheduled entries
+    errors = [f"{entry.path}: {entry.errors}" for entry in BackupDir.fetch_enabled_backup_rows() if entry.errors]
+    with common.db_conn as conn:
+        last_full_check = float(conn.execute("SELECT value FROM status WHERE key = 'last_full_check'").fetchone()[0])
+    if now > last_full_check + (2 * cfg.full_check_frequency):
+        last_run_str = time.ctime(last_full_check) if last_full_check > 0 else "Never"
+        errors.append(f"Full check is overdue (Last run: {last_run_str})")
+
+    last_error_check_time = now
+    if errors:
+        toast = Toast()
+        toast.text_fields = ["Backup Errors Detected", "\n".join(errors)[:200]]
+        common.wintoaster.show_toast(toast)
+    scheduler.schedule(Scheduler.ERRORS, None, now + cfg.error_check_frequency)
+
+def check_scheduler(manually_triggered=False):
+    """ Starts whatever is due and sleeps until the next event. """
+    global scheduler_timer
+    if scheduler_timer:
+        if root: root.after_cancel(scheduler_timer)
+        scheduler_timer = None
+
+    if not manually_triggered and common.recently_suspended():
+        if root:
+            scheduler_timer = root.after(15000, check_scheduler)
+        return
+
+    now = time.time()
+    try:
+        due = scheduler.pop_due(now)
+        if (Scheduler.RELOAD, None) in due:
+            reload_scheduler(manually_triggered)
+            return
+
+        env = None
+        if sched_env is not None and due:
+            env = dict(sched_env)
+            RcloneServer.apply(env, sched_cfg.rclone_serve)
+
+        # 1. Backups
+        entries = [sched_entries[key] for kind, key in due if kind == Scheduler.BACKUP and key in sched_entries]
+        if entries:
+            run_due_backups(entries, env, now, manually_triggered)
+
+        for kind, key in due:
+            # 2. Full Repo Check
+            if kind == Scheduler.CHECK:
+                run_full_check(env, now)
+            # 3. error toast
+            elif kind == Scheduler.ERRORS:
+                show_errors(now)
+            # 4. Auto Discovery
+            elif kind == Scheduler.DISCOVERY:
+                if not WorkerThread.submit_task(ScheduledDiscoveryTask(task_id="auto_discovery")):
+                    schedule_auto_discovery()
+
+    except Exception as e:
+        logging.exception(f"Scheduler error: {e}")
+        scheduler.schedule(Scheduler.RELOAD, None, time.time() + 60)
+
+    delay = int(scheduler.delay() * 1000)
+    if delay < 1000: delay = 1000
+    
+    if root:
+        scheduler_timer = root.after(delay, check_scheduler)
+            
+def get_tools_info():
+    return {
+        "restic": {
+            "ver": "restic 0.18.1 compiled with go1.25.1 on windows/amd64",
+            "url": "https://github.com/restic/restic/releases/download/v0.18.1/restic_0.18.1_windows_amd64.zip",
+            "zip_path": "restic_0.18.1_windows_amd64.exe",
+            "exe": "restic.exe",
+            "sha256": "0c1a713440578cb400d2e76208feb24f1b339426b075a21f73b6b2132692515d",
+            "license_url": "https://raw.githubusercontent.com/restic/restic/refs/heads/master/LICENSE",
+            "license_filename": "restic_LICENSE.txt",
+            "project_url": "https://github.com/restic/restic"
+        },
+        "rclone": {
+            "ver": "rclone v1.73.0",
+            "url": "https://github.com/rclone/rclone/releases/download/v1.73.0/rclone-v1.73.0-windows-amd64.zip",
+            "zip_path": "rclone-v1.73.0-windows-amd64/rclone.exe",
+            "exe": "rclone.exe",
+            "sha256": "14e1c40f34ec18532e832c228231338bd182817af6f6529a402474c69acabe0b",
+            "license_url": "https://raw.githubusercontent.com/rclone/rclone/refs/heads/master/COPYING",
+            "license_filename": "rclone_LICENSE.txt",
+            "project_url": "https://rclone.org/"
+        }
+    }
+
+def main():
+    global root, tray_icon
+    try:
+        if not acquire_lock():
+            messagebox.showerror(APPNAME, "Another instance is already running, exit(1).")
+            sys.exit(1)
+
+        DB.init_db()
+
+        installer = ToolsInstaller(common.BIN_DL_DIR, APPNAME)
+        tools_config = get_tools_info()
+        installer.check_and_install_tools(tools_config)
+
+        if not common.IS_ADMIN:
+            toast = Toast()
+            toast.text_fields = ["Privilege Warning", "Running without admin privileges.\nVSS snapshots will not be available."]
+            common.wintoaster.show_toast(toast)
+            logging.warning("Running without admin privileges.")
+
+        root = tk.Tk()
+        common.root = root
+        root.withdraw()
+        setup_power_broadcast_logging(root)
+
+        ui.tools.Tools.start_log_memory_footprint_timerloop(root)
+
+        if ui.tools.IS_DEBUGGER_PRESENT:
+            root.after(0, open_settings)
+            root.after(3, reload_scheduler)
+        else:
+            root.after(5000, reload_scheduler)
+        
+        # Start Update Checker
+        cfg = Config()
+        uc = GithubUpdateChecker(APP_GITHUB_ID, APPNAME, APP_VERSION, common.db_conn, root=root, toaster=common.wintoaster, 
+                                 check_frequency=cfg.update_check_frequency, toast_interval=cfg.update_check_toast_interval, min_check_interval=common.MIN_UPDATE_CHECK_IVAL)
+        if cfg.update_check_enabled:
+            uc.start()
+
+        menu = pystray.Menu(
+            pystray.MenuItem("Run overdue backups now", lambda i, it: root.after(0, lambda: reload_scheduler(True))),
+            pystray.MenuItem("Settings...", lambda i, it: root.after(0, open_settings)),
+            pystray.MenuItem("Open Log", lambda i, it: root.after(0, open_log)),
+            pystray.MenuItem("Licenses", lambda i, it: root.after(0, open_licenses)),
+            pystray.MenuItem("Exit", lambda i, it: root.after(0, quit_app))
+        )
+        tray_icon = pystray.Icon(APPNAME, create_image(), f"{APPNAME} {APP_VERSION}", menu)
+        threading.Thread(target=tray_icon.run, daemon=True, name="IconThread").start()
+        root.mainloop()
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        raise
+    finally:
+        common.db_conn.close()
+        logging.info(f"{APPNAME} exiting")
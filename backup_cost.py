@@ -0,0 +1,101 @@
+# encoding: utf-8
+import heapq
+import json
+import sqlite3
+import statistics
+
+
+class BackupCost:
+    """
+    Moving averages of restic's total_duration and total_bytes_processed per backup dir, and the order of due
+    backups built from them: shortest predicted backup first, but no folder starts more than FAIRNESS_BOUND seconds
+    later than it would in due order. After a resume from standby one big overdue folder no longer holds back all
+    the small ones, and it still doesn't wait for every small one that gets due after it.
+    """
+    SCHEMA = "CREATE TABLE IF NOT EXISTS backup_cost (backup_dir_id INTEGER PRIMARY KEY, sec REAL, bytes REAL, samples INTEGER)"
+
+    ALPHA = 0.3
+    DEFAULT_SEC = 300.0      # folders without any backup yet, as long as no folder has one
+    FAIRNESS_BOUND = 1800.0
+
+    # when the backups submitted so far are expected to be done, for the UI
+    queue_done_at = 0.0
+
+    def __init__(self, conn:sqlite3.Connection):
+        self.costs = {row[0]: (row[1], row[2], row[3]) for row in conn.execute("SELECT backup_dir_id, sec, bytes, samples FROM backup_cost")}
+        self._default = self._median()
+
+    def _median(self) -> float:
+        known = [sec for sec, _, samples in self.costs.values() if samples]
+        return statistics.median(known) if known else self.DEFAULT_SEC
+
+    def predict(self, backup_dir_id) -> float:
+        """ Expected seconds of the next backup, the median of all folders for folders without history. """
+        cost = self.costs.get(backup_dir_id)
+        return cost[0] if cost and cost[2] else self._default
+
+    def predict_bytes(self, backup_dir_id) -> float|None:
+        cost = self.costs.get(backup_dir_id)
+        return cost[1] if cost and cost[2] else None
+
+    def add(self, conn:sqlite3.Connection, backup_dir_id, summary:str|None):
+        if not summary:
+            return
+        js = json.loads(summary)
+        sec = float(js.get('total_duration', 0.0))
+        if sec <= 0:
+            return
+        size = float(js.get('total_bytes_processed', 0))
+        avg_sec, avg_bytes, n = self.costs.get(backup_dir_id, (0.0, 0.0, 0))
+        if n:
+            avg_sec += self.ALPHA * (sec - avg_sec)
+            avg_bytes += self.ALPHA * (size - avg_bytes)
+        else:
+            avg_sec, avg_bytes = sec, size
+        self.costs[backup_dir_id] = (avg_sec, avg_bytes, n + 1)
+        self._default = self._median()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO backup_cost (backup_dir_id, sec, bytes, samples) VALUES (?, ?, ?, ?)",
+                         (backup_dir_id, avg_sec, avg_bytes, n + 1))
+
+    def plan(self, jobs:list[tuple], now:float, slots=1, busy_until:list[float]|None=None) -> tuple[list, float]:
+        """
+        Orders jobs, a list of (backup_dir_id, due), for slots parallel backups whose slots are busy until the
+        times in busy_until. Returns the ids in start order and the predicted time the last one is done.
+        """
+        slots = max(1, slots)
+        free = sorted(max(now, t) for t in (busy_until or [])[:slots])
+        free += [now] * (slots - len(free))
+        heapq.heapify(free)
+
+        # start of every job in due order, the reference for the fairness bound
+        by_due = sorted(jobs, key=lambda j: j[1])
+        reference = {}
+        sim = list(free)
+        for id, _ in by_due:
+            t = heapq.heappop(sim)
+            reference[id] = t
+            heapq.heappush(sim, t + self.predict(id))
+
+        by_cost = sorted(jobs, key=lambda j: (self.predict(j[0]), j[1]))
+        order = []
+        taken = set()
+        i = j = 0
+        done_at = max(free) if free else now
+        while len(order) < len(jobs):
+            t = heapq.heappop(free)
+            while by_due[i][0] in taken:
+                i += 1
+            # a folder out of slack goes next, in due order, otherwise the cheapest one
+            if reference[by_due[i][0]] + self.FAIRNESS_BOUND <= t:
+                id = by_due[i][0]
+            else:
+                while by_cost[j][0] in taken:
+                    j += 1
+                id = by_cost[j][0]
+            taken.add(id)
+            order.append(id)
+            end = t + self.predict(id)
+            done_at = max(done_at, end)
+            heapq.heappush(free, end)
+        return order, done_at
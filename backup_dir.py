@@ -5,10 +5,11 @@ import time
 from pathlib import Path
 
 import piabackup.common as common
+from piabackup.backup_rules import BackupRules
 
 
 class BackupDir:
-    def __init__(self, id, path, enabled='auto', fastscan_fingerprint="1", error='', last_run=0.0, frequency=common.DEFAULT_FREQ, next_run=0.0, bitrot_snap="", summary="", n_backups_since_last_perm_tag=0, iexclude='', last_fullcheck=0.0):
+    def __init__(self, id, path, enabled='auto', fastscan_fingerprint="1", error='', last_run=0.0, frequency=common.DEFAULT_FREQ, next_run=0.0, bitrot_snap="", summary="", n_backups_since_last_perm_tag=0, iexclude='', last_fullcheck=0.0, check_error=''):
         self.id = id
         self.path = Path(path)
         self.enabled = enabled
@@ -22,6 +23,12 @@ class BackupDir:
         self.n_backups_since_last_perm_tag = int(n_backups_since_last_perm_tag)
         self.iexclude = iexclude
         self.last_fullcheck = float(last_fullcheck)
+        # bitrot findings, kept apart from error since the next backup of the folder clears that
+        self.check_error = check_error or ''
+
+    @property
+    def errors(self) -> str:
+        return "\n".join(e for e in (self.check_error, self.error) if e)
 
     def get_current_snapshot_id(self):
         return json.loads(self.summary)['snapshot_id']
@@ -29,16 +36,26 @@ class BackupDir:
     def get_tag(self):
         return self.path.as_posix()
 
+    def scan_snapshot_path(self):
+        return common.SCAN_SNAPSHOT_DIR / f"{self.id}.bin"
+
     @staticmethod
     def load_dirs():
         with common.db_conn as conn:
             return [BackupDir(*r)
-                            for r in conn.execute("SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck FROM backup_dirs ORDER BY id").fetchall()]
+                            for r in conn.execute("SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck, check_error FROM backup_dirs ORDER BY id").fetchall()]
 
     def delete(self):
         if self.id is None:
              raise ValueError("Cannot delete BackupDir without id")
         common.db_conn.execute("DELETE FROM backup_dirs WHERE id=?", (self.id,))
+        common.db_conn.execute("DELETE FROM fastscan_index WHERE backup_dir_id=?", (self.id,))
+        common.db_conn.execute("DELETE FROM watch_state WHERE backup_dir_id=?", (self.id,))
+        common.db_conn.execute("DELETE FROM prescan_checkpoint WHERE backup_dir_id=?", (self.id,))
+        common.db_conn.execute("DELETE FROM prescan_stats WHERE backup_dir_id=?", (self.id,))
+        common.db_conn.execute("DELETE FROM backup_throughput WHERE backup_dir_id=?", (self.id,))
+        common.db_conn.execute("DELETE FROM backup_cost WHERE backup_dir_id=?", (self.id,))
+        self.scan_snapshot_path().unlink(missing_ok=True)
 
     # UI save (insert or update) - does not update fastscan_fingerprint, error, last_run, next_run or bitrot_snap as those are managed by the worker thread and should not be changed from the UI. Only enabled and frequency can be changed from the UI.
     def save_ui(self):
@@ -56,7 +73,7 @@ class BackupDir:
     @staticmethod
     def fetch_overdue_backup_row():
         row = common.db_conn.execute("""
-                SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck 
+                SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck, check_error 
                 FROM backup_dirs 
                 WHERE enabled != 'no' AND next_run <= ?
                 ORDER BY next_run ASC LIMIT 1
@@ -66,11 +83,21 @@ class BackupDir:
             return None
         return BackupDir(*row)
 
+    @staticmethod
+    def fetch_enabled_backup_row(id) -> 'BackupDir|None':
+        with common.db_conn as conn:
+            row = conn.execute("""
+                    SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck, check_error 
+                    FROM backup_dirs 
+                    WHERE enabled != 'no' AND id = ?
+                """, (id,)).fetchone()
+        return BackupDir(*row) if row else None
+
     @staticmethod
     def fetch_enabled_backup_rows() -> list['BackupDir']:
         with common.db_conn as conn:
             rows = conn.execute("""
-                    SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck 
+                    SELECT id, path, enabled, fastscan_fingerprint, error, last_run, frequency, next_run, bitrot_snap, summary, n_backups_since_last_perm_tag, iexclude, last_fullcheck, check_error 
                     FROM backup_dirs 
                     WHERE enabled != 'no'
                     ORDER BY next_run ASC
@@ -81,12 +108,10 @@ class BackupDir:
         if self.id is None:
             raise ValueError("Cannot save backup result for BackupDir without id")
         self.last_run = time.time()
-        if self.error:
-            self.next_run = self.last_run + 300
-        else:
-            self.next_run = self.last_run + (self.frequency if self.frequency > common.MIN_FREQUENCY else common.MIN_FREQUENCY)
+        self.next_run = BackupRules.next_run(self.last_run, self.frequency, self.error)
         with common.db_conn as conn:
-            cur = conn.execute("UPDATE backup_dirs SET error=?, last_run=?, next_run=?, summary=?, fastscan_fingerprint=?, bitrot_snap=?, n_backups_since_last_perm_tag=?, last_fullcheck=? WHERE id=?",
-                        (self.error, self.last_run, self.next_run, self.summary, self.fastscan_fingerprint, self.bitrot_snap, self.n_backups_since_last_perm_tag, self.last_fullcheck, self.id))
+            # bitrot_snap belongs to BitrotCheckTask, which may have advanced it since this entry was read
+            cur = conn.execute("UPDATE backup_dirs SET error=?, last_run=?, next_run=?, summary=?, fastscan_fingerprint=?, n_backups_since_last_perm_tag=?, last_fullcheck=? WHERE id=?",
+                        (self.error, self.last_run, self.next_run, self.summary, self.fastscan_fingerprint, self.n_backups_since_last_perm_tag, self.last_fullcheck, self.id))
             if cur.rowcount != 1:
                 raise Exception(f"Failed to update backup result for BackupDir with id {self.id}")
@@ -0,0 +1,92 @@
+# encoding: utf-8
+import json
+import sqlite3
+import time
+
+
+class BackupProgress:
+    """
+    Turns restic's backup status messages into progress figures. With --no-scan restic doesn't know the totals,
+    so the previous backup's summary serves as estimate for percent done and ETA.
+    """
+    SAMPLE_IVAL = 60  # seconds between two recorded throughput samples
+
+    def __init__(self, previous_summary:str|None=None):
+        prev = json.loads(previous_summary) if previous_summary else {}
+        self.expected_bytes = int(prev.get('total_bytes_processed', 0))
+        self.expected_files = int(prev.get('total_files_processed', 0))
+        self.samples = []  # (at, seconds, bytes_read, files)
+        self._last_sample = (0.0, 0, 0)  # seconds_elapsed, bytes_done, files_done
+
+    def update(self, status:dict) -> dict:
+        elapsed = float(status.get('seconds_elapsed', 0))
+        bytes_done = int(status.get('bytes_done', 0))
+        files_done = int(status.get('files_done', 0))
+        total_bytes = int(status.get('total_bytes', 0))
+        bytes_per_sec = bytes_done / elapsed if elapsed > 0 else 0.0
+
+        if total_bytes:
+            percent = float(status.get('percent_done', 0))
+            eta = status.get('seconds_remaining')
+        elif self.expected_bytes:
+            # an estimate can be exceeded, don't claim to be done before restic is
+            percent = min(0.99, bytes_done / self.expected_bytes)
+            eta = max(0.0, self.expected_bytes - bytes_done) / bytes_per_sec if bytes_per_sec > 0 else None
+        else:
+            percent = None
+            eta = None
+
+        last_elapsed, last_bytes, last_files = self._last_sample
+        if elapsed - last_elapsed >= self.SAMPLE_IVAL:
+            self.samples.append((time.time(), elapsed - last_elapsed, bytes_done - last_bytes, files_done - last_files))
+            self._last_sample = (elapsed, bytes_done, files_done)
+
+        current_files = status.get('current_files') or []
+        return {
+            'percent': percent,
+            'bytes_done': bytes_done,
+            'files_done': files_done,
+            'bytes_per_sec': bytes_per_sec,
+            'files_per_sec': files_done / elapsed if elapsed > 0 else 0.0,
+            'current_file': current_files[0] if current_files else None,
+            'eta_sec': eta,
+            'elapsed_sec': elapsed,
+        }
+
+    @staticmethod
+    def format(progress:dict|None) -> str:
+        if not progress:
+            return ""
+        parts = []
+        if progress['percent'] is not None:
+            parts.append(f"{progress['percent'] * 100:.0f}%")
+        parts.append(f"{progress['bytes_per_sec'] / 1024 / 1024:.1f} MB/s, {progress['files_per_sec']:.0f} files/s")
+        if progress['eta_sec'] is not None:
+            eta = int(progress['eta_sec'])
+            parts.append(f"ETA {eta // 3600}:{eta % 3600 // 60:02d}:{eta % 60:02d}")
+        return ", ".join(parts)
+
+
+class ThroughputLog:
+    """
+    Throughput samples of backups. Samples taken while a backup runs have the bytes read, the one taken from the
+    summary has the amount of new data instead, so read rate (disk) and added data rate (uplink) of a folder can be
+    told apart. The summary's total_bytes_processed includes unchanged files restic skipped by its cache, so it isn't
+    recorded as bytes read: the summary row has the files read (new and changed) and the unmodified ones.
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS backup_throughput (backup_dir_id INTEGER, at REAL, seconds REAL, "
+              "bytes_read INTEGER, files INTEGER, bytes_added INTEGER, files_unmodified INTEGER)")
+    MAX_AGE = 86400 * 90
+
+    @staticmethod
+    def save(conn:sqlite3.Connection, backup_dir_id:int, progress:BackupProgress|None, summary:str|None):
+        rows = [(backup_dir_id, at, sec, b, f, None, None) for at, sec, b, f in progress.samples] if progress else []
+        if summary:
+            js = json.loads(summary)
+            sec = float(js.get('total_duration', 0))
+            if sec > 0:
+                rows.append((backup_dir_id, time.time(), sec, None, int(js.get('files_new', 0)) + int(js.get('files_changed', 0)),
+                             int(js.get('data_added', 0)), int(js.get('files_unmodified', 0))))
+        with conn:
+            conn.executemany("INSERT INTO backup_throughput (backup_dir_id, at, seconds, bytes_read, files, bytes_added, files_unmodified) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("DELETE FROM backup_throughput WHERE at < ?", (time.time() - ThroughputLog.MAX_AGE,))
@@ -0,0 +1,88 @@
+# encoding: utf-8
+import logging
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class BackupRules:
+    """
+    What a backup run of a folder is made of: the restic command line, the exclusions file and when the folder is
+    due again.
+    """
+    MIN_FREQUENCY = 60
+    ERROR_RETRY = 300
+
+    @staticmethod
+    def next_run(last_run:float, frequency:int, error:str) -> float:
+        if error:
+            return last_run + BackupRules.ERROR_RETRY
+        return last_run + max(frequency, BackupRules.MIN_FREQUENCY)
+
+    @staticmethod
+    def backup_cmd(restic_cmd:list[str], backup_path:Path, iexclude_path:str|None, no_lock=False, docheck=False, quiet=True,
+                   fs_snapshot=False) -> list[str]:
+        cmd = restic_cmd + ["backup",
+                    #"--files-from", str(rootsfn.absolute()),
+                    "--compression", "max",
+                    "--no-scan",
+                    "--skip-if-unchanged",
+                    #"--read-concurrency", "2", # makes it slower
+                    ]
+        if fs_snapshot:
+            cmd.append("--use-fs-snapshot")
+        if no_lock:
+            cmd.append("--no-lock")
+        cmd.append("--json")
+        if quiet:
+            cmd.append("--quiet")
+        if docheck:
+            cmd.append("--force")
+            cmd.append("--no-cache")
+        cmd.extend(["--tag", backup_path.as_posix()])
+        if iexclude_path:
+            cmd.extend(["--iexclude-file", iexclude_path])
+        cmd.append(str(backup_path))
+        return cmd
+
+    @staticmethod
+    def format_restic_path(path: Path):
+        # Transform C:\Users\work to /C/Users/work
+        drive = path.drive
+        if drive:
+            return "/" + drive.replace(":", "") + path.as_posix().replace(drive, "")
+        return path.as_posix()
+
+    @staticmethod
+    @contextmanager
+    def iexclude_file(iexclude: str|None, backup_path: Path, is_rewrite: bool = False, debug=False):
+        """ The exclusion lines as absolute paths in a temporary file for --iexclude-file, None without exclusions. """
+        if not iexclude:
+            yield None
+            return
+
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8', suffix=".txt") as tmp:
+            absolute_exclusions = []
+            if sys.platform == "win32" and is_rewrite:
+                for line in iexclude.splitlines():
+                    line = line.strip()
+                    if line:
+                        absolute_exclusions.append(BackupRules.format_restic_path(backup_path.joinpath(line.lstrip('/\\'))))
+            else:
+                for line in iexclude.splitlines():
+                    line = line.strip()
+                    if line:
+                        absolute_exclusions.append(backup_path.joinpath(line.lstrip('/\\')).as_posix())
+
+            if debug:
+                logging.debug("iexclude file=" + "\n".join(absolute_exclusions))
+
+            tmp.write("\n".join(absolute_exclusions))
+            tmp_path = tmp.name
+
+        try:
+            yield tmp_path
+        finally:
+            os.remove(tmp_path)
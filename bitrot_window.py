@@ -100,17 +100,20 @@ class BitrotWindow(tk.Toplevel):
             
         try:
             with common.db_conn as conn:
-                conn.execute("UPDATE backup_dirs SET bitrot_snap=?, error='' WHERE id=?", 
+                conn.execute("UPDATE backup_dirs SET bitrot_snap=?, check_error='' WHERE id=?", 
                              (self.current_bitrot_snap_id, self.backup_dir.id))
             logging.info(f"Current bit rot snap id manually advanced to {self.current_bitrot_snap_id} for {self.backup_dir.path}.")
             self.backup_dir.bitrot_snap = self.current_bitrot_snap_id
-            self.backup_dir.error = ""
+            self.backup_dir.check_error = ""
             messagebox.showinfo("Success", "Bit rot acknowledged. You may need to refresh the main window.")
             self.destroy()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to update database: {e}")
 
 class BitrotScanTask(WorkerTask):
+    lane = WorkerTask.INTERACTIVE
+    read_only = True
+
     def __init__(self, env, backup_dir, no_lock, **kwargs):
         super().__init__(**kwargs)
         self.env = env
@@ -142,21 +145,14 @@ class BitrotScanTask(WorkerTask):
                     break
         
         issues = []
-        if prev_snap and curr_snap:
-            stdout = restic.diff(self.env, prev_snap['id'], curr_snap['id'], self.no_lock)
-            
-            for line in stdout.splitlines():
-                if not line.startswith("{"): continue
-                try:
-                    js = json.loads(line)
-                    if js.get('message_type') == 'change':
-                        if '?' in js.get('modifier', ''):
-                            issues.append({
-                                'path': js['path'],
-                                'raw': line
-                            })
-                except:
-                    pass
+        if prev_snap and curr_snap and prev_snap.get('tree') != curr_snap.get('tree'):
+            for js in restic.diff(self.env, prev_snap['id'], curr_snap['id'], self.no_lock):
+                if js.get('message_type') == 'change':
+                    if '?' in js.get('modifier', ''):
+                        issues.append({
+                            'path': js['path'],
+                            'raw': json.dumps(js)
+                        })
         return {
             'prev': prev_snap,
             'curr': curr_snap,
@@ -1,14 +1,13 @@
 # encoding: utf-8
-import datetime
 import os
 import time
 import tkinter as tk
-from pathlib import PurePosixPath
 from tkinter import filedialog, messagebox, ttk
 
 import piabackup.common as common
-from piabackup.worker_thread import (FindTask, ListSnapshotsTask, LsTask,
-                                     RestoreTask, TagSnapshotTask, WorkerThread)
+from piabackup.ls_cache import LsListing
+from piabackup.worker_thread import (FindTask, ListSnapshotsTask, LocalDiffTask, LsTask,
+                                     RestoreTask, TagSnapshotsTask, WorkerThread)
 from ui.tools import Tools
 
 
@@ -22,11 +21,12 @@ class FileNode:
         self.children = {} # name -> FileNode
 
 class BrowseDialog(tk.Toplevel):
-    def __init__(self, parent, backup_dir, env, no_lock):
+    def __init__(self, parent, backup_dir, env, no_lock, ls_cache_mb=0):
         super().__init__(parent)
         self.backup_dir = backup_dir
         self.env = env
         self.no_lock = no_lock
+        self.ls_cache_mb = ls_cache_mb
         self.title(f"Browse: {backup_dir.path}")
         
         self.paned = ttk.PanedWindow(self, orient=tk.HORIZONTAL)
@@ -38,7 +38,7 @@ class BrowseDialog(tk.Toplevel):
         
         ttk.Label(frame_left, text="Snapshots").pack(anchor=tk.W, padx=5, pady=5)
         
-        self.tree_snaps = ttk.Treeview(frame_left, columns=("time", "tags"), show="headings")
+        self.tree_snaps = ttk.Treeview(frame_left, columns=("time", "tags"), show="headings", selectmode="extended")
         self.tree_snaps.heading("time", text="Time")
         self.tree_snaps.heading("tags", text="Tags")
         self.tree_snaps.column("time", width=140)
@@ -105,7 +105,8 @@ class BrowseDialog(tk.Toplevel):
 
     def on_snap_select(self, event):
         selected = self.tree_snaps.selection()
-        if not selected: return
+        # several selected snapshots are for tagging, keep showing the files
+        if len(selected) != 1: return
         
         item = self.tree_snaps.item(selected[0])
         snap_id = item['tags'][1] # long id
@@ -123,47 +124,53 @@ class BrowseDialog(tk.Toplevel):
         self.lbl_status.config(text=f"Loading files for snapshot {short_id}...")
         
         class FileListTask(LsTask):
-            def on_success(self_task, res): # type: ignore
-                root = self.build_tree(res)
+            def run(self_task):
+                listing = super().run()
+                try:
+                    return self.build_tree(listing)
+                finally:
+                    listing.close()
+            def on_success(self_task, root): # type: ignore
                 self.lbl_status.config(text=f"Snapshot: {short_id}")
                 self.populate_node("", root)
             def on_failure(self_task, e): # type: ignore
                 self.lbl_status.config(text=f"Error loading files: {e}")
                 messagebox.showerror("Error", f"Failed to list files: {e}")
 
-        WorkerThread.submit_task(FileListTask(self.env, snap_id, self.no_lock))
+        WorkerThread.submit_task(FileListTask(self.env, snap_id, self.no_lock, self.ls_cache_mb))
 
-    def build_tree(self, items):
+    def build_tree(self, listing:LsListing):
+        # runs in the worker thread
         root = FileNode("/", True, 0, "", "/")
-        
-        for item in items:
-            path_str = item.get("path")
-            if not path_str: continue
-            
-            # restic paths start with /, e.g. /C/Users/...
-            parts = PurePosixPath(path_str).parts
-            
-            current = root
-            for i, part in enumerate(parts):
-                if part == "/" or part == "\\": continue
-                
-                if part not in current.children:
-                    # Default intermediate node
-                    node = FileNode(part, True, 0, "", "")
-                    current.children[part] = node
-                
-                current = current.children[part]
-                
-                # Update node info if this is the actual item
-                if i == len(parts) - 1:
-                    current.is_dir = (item["type"] == "dir")
-                    current.size = item.get("size", 0)
-                    if item.get("mtime"):
-                        try:
-                            dt = datetime.datetime.fromisoformat(item["mtime"].replace("Z", "+00:00"))
-                            current.mtime = dt.strftime('%Y-%m-%d %H:%M')
-                        except: pass
-                    current.full_path = path_str
+        nodes = [root] * len(listing)
+        parents, types, sizes, mtimes_ns = listing.parents, listing.types, listing.sizes, listing.mtimes_ns
+        for i in range(len(listing)):
+            parent_idx = parents[i]
+            name = listing.name(i)
+            if parent_idx < 0:
+                # directly below the root, or a node whose parent restic didn't list
+                current = root
+                parts = name.split("/")
+                for part in parts[:-1]:
+                    if part not in current.children:
+                        current.children[part] = FileNode(part, True, 0, "", "")
+                    current = current.children[part]
+                parent, name = current, parts[-1]
+            else:
+                parent = nodes[parent_idx]
+            node = parent.children.get(name)
+            if node is None:
+                node = parent.children[name] = FileNode(name, True, 0, "", "")
+            node.is_dir = types[i] == LsListing.DIR
+            node.size = sizes[i]
+            if mtimes_ns[i]:
+                try:
+                    node.mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtimes_ns[i] // 1_000_000_000))
+                except (OSError, OverflowError, ValueError):
+                    # Windows' localtime rejects times before 1970
+                    node.mtime = ""
+            node.full_path = listing.path(i) if parent_idx < 0 else f"{parent.full_path}/{name}"
+            nodes[i] = node
 
         # Navigate to backup_dir root
         current = root
@@ -243,41 +250,70 @@ class BrowseDialog(tk.Toplevel):
         if not item:
             return
         
-        self.tree_snaps.selection_set(item)
+        if item not in self.tree_snaps.selection():
+            self.tree_snaps.selection_set(item)
+        items = self.tree_snaps.selection()
         
         menu = tk.Menu(self, tearoff=0)
-        menu.add_command(label="Restore...", command=self.restore_snapshot_action)
-        menu.add_command(label="Restore without parent paths...", command=lambda: self.restore_snapshot_action(flatten=True))
-        
-        values = self.tree_snaps.item(item, "values")
-        current_tags = values[1].split(", ") if values[1] else []
-        is_permanent = "permanent" in current_tags
-        
-        menu.add_separator()
-        menu.add_command(label="Remove 'permanent' tag" if is_permanent else "Add 'permanent' tag", command=lambda: self.toggle_permanent(item, is_permanent))
+        if len(items) == 1:
+            menu.add_command(label="Restore...", command=self.restore_snapshot_action)
+            menu.add_command(label="Restore without parent paths...", command=lambda: self.restore_snapshot_action(flatten=True))
+            older = self.tree_snaps.next(item)
+            if older:
+                menu.add_command(label="Changes since previous snapshot...", command=lambda: self.show_changes(older, item))
+            menu.add_separator()
+        
+        permanent = [i for i in items if "permanent" in self.tree_snaps.item(i, "values")[1].split(", ")]
+        others = [i for i in items if i not in permanent]
+        suffix = f" ({len(items)} selected)" if len(items) > 1 else ""
+        if others:
+            menu.add_command(label=f"Add 'permanent' tag{suffix}", command=lambda: self.set_permanent(others, False))
+        if permanent:
+            menu.add_command(label=f"Remove 'permanent' tag{suffix}", command=lambda: self.set_permanent(permanent, True))
         
         menu.post(event.x_root, event.y_root)
 
-    def toggle_permanent(self, item, is_removing):
-        snap_id = self.tree_snaps.item(item, "tags")[1] # long id
+    def show_changes(self, old_item, new_item):
+        old_id = self.tree_snaps.item(old_item, "tags")[1]
+        new_id = self.tree_snaps.item(new_item, "tags")[1]
+        title = f"Changes {self.tree_snaps.item(old_item, 'values')[0]} -> {self.tree_snaps.item(new_item, 'values')[0]}"
+        self.lbl_status.config(text="Comparing snapshots...")
+
+        class ChangesTask(LocalDiffTask):
+            def on_success(self_task, res): # type: ignore
+                changes, counts = res
+                self.lbl_status.config(text="Select a snapshot to browse files.")
+                ChangesDialog(self, title, changes, counts)
+            def on_failure(self_task, e): # type: ignore
+                self.lbl_status.config(text=f"Error comparing snapshots: {e}")
+                messagebox.showerror("Error", f"Failed to compare snapshots: {e}")
+
+        WorkerThread.submit_task(ChangesTask(self.env, old_id, new_id, self.no_lock, self.ls_cache_mb))
+
+    def set_permanent(self, items, is_removing):
+        snap_ids = [self.tree_snaps.item(item, "tags")[1] for item in items] # long ids
         
-        class MyTagTask(TagSnapshotTask):
+        class MyTagTask(TagSnapshotsTask):
             def on_success(self_task, res): # type: ignore
                 # Update UI
-                values = self.tree_snaps.item(item, "values")
-                tags_str = values[1]
-                tags = [t for t in tags_str.split(", ") if t]
-                if is_removing:
-                    if "permanent" in tags: tags.remove("permanent")
-                else:
-                    if "permanent" not in tags: tags.append("permanent")
-                
-                self.tree_snaps.item(item, values=(values[0], ", ".join(tags)))
-                self.lbl_status.config(text=f"'permanent' tag {'removed' if is_removing else 'added'}.")
+                for item in items:
+                    if not self.tree_snaps.exists(item):
+                        continue
+                    values = self.tree_snaps.item(item, "values")
+                    tags_str = values[1]
+                    tags = [t for t in tags_str.split(", ") if t]
+                    if is_removing:
+                        if "permanent" in tags: tags.remove("permanent")
+                    else:
+                        if "permanent" not in tags: tags.append("permanent")
+                    
+                    self.tree_snaps.item(item, values=(values[0], ", ".join(tags)))
+                count = f" ({len(items)} snapshots)" if len(items) > 1 else ""
+                self.lbl_status.config(text=f"'permanent' tag {'removed' if is_removing else 'added'}{count}.")
             def on_failure(self_task, e): # type: ignore
                 messagebox.showerror("Error", f"Failed to update tag: {e}")
 
-        WorkerThread.submit_task(MyTagTask(self.env, snap_id, "permanent", remove=is_removing, no_lock=self.no_lock))
+        WorkerThread.submit_task(MyTagTask(self.env, snap_ids, "permanent", remove=is_removing, no_lock=self.no_lock))
 
     def restore_snapshot_action(self, flatten=False):
         selected = self.tree_snaps.selection()
@@ -369,6 +405,30 @@ class BrowseDialog(tk.Toplevel):
                 self.on_snap_select(None)
                 return
 
+class ChangesDialog(tk.Toplevel):
+    def __init__(self, parent, title, changes, counts):
+        super().__init__(parent)
+        self.title(title)
+
+        summary = ", ".join(f"{counts.get(m, 0)} {label}" for m, label in (("+", "added"), ("-", "removed"), ("M", "modified"), ("T", "type changed")))
+        if len(changes) < sum(counts.values()):
+            summary += f" (showing the first {len(changes)})"
+        ttk.Label(self, text=summary).pack(anchor=tk.W, padx=5, pady=5)
+        ttk.Label(self, text="Compared by size and modification time, see the bitrot check for content changes.",
+                  font=("Segoe UI", 8), foreground="#666666").pack(anchor=tk.W, padx=5)
+
+        frame = ttk.Frame(self)
+        frame.pack(fill=tk.BOTH, expand=True)
+        txt = tk.Text(frame, wrap=tk.NONE, font=("Consolas", 9))
+        sb = ttk.Scrollbar(frame, orient="vertical", command=txt.yview)
+        txt.configure(yscrollcommand=sb.set)
+        txt.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        sb.pack(side=tk.RIGHT, fill=tk.Y)
+        txt.insert("1.0", "\n".join(f"{c['modifier']}  {c['path']}" for c in changes))
+        txt.configure(state=tk.DISABLED)
+
+        Tools.center_window(self, 800, 500)
+
 class HistoryDialog(tk.Toplevel):
     def __init__(self, parent, snap_ids, on_select):
         super().__init__(parent)
@@ -0,0 +1,399 @@
+# encoding: utf-8
+import ctypes
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import piabackup.common as common
+from piabackup.iexclude_filter import IExcludeFilter
+
+
+class WatcherBackend:
+    """
+    Watches root directories recursively. Roots are identified by an arbitrary key. The callbacks are
+    called from the backend's threads:
+      on_ready(key, ts)   - changes after ts are guaranteed to be reported
+      on_change(key, path)
+      on_overflow(key)    - changes may have been lost, key None means all roots
+    """
+    def __init__(self, on_ready, on_change, on_overflow):
+        self.on_ready = on_ready
+        self.on_change = on_change
+        self.on_overflow = on_overflow
+
+    def add_root(self, key, path:str):
+        raise NotImplementedError()
+
+    def remove_root(self, key):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class InotifyBackend(WatcherBackend):
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, on_ready, on_change, on_overflow):
+        super().__init__(on_ready, on_change, on_overflow)
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._stop_r, self._stop_w = os.pipe()
+        self._lock = threading.RLock()
+        self._roots:dict = {}       # key -> root path
+        self._wd_paths:dict = {}    # wd -> dir path
+        self._wd_keys:dict = {}     # wd -> set of keys using the watch
+        self._closed = False
+        threading.Thread(target=self._read_loop, daemon=True, name="InotifyWatcher").start()
+
+    def add_root(self, key, path):
+        with self._lock:
+            self._roots[key] = path
+        threading.Thread(target=self._add_tree, args=(key, path, True), daemon=True, name="InotifyWatcherAdd").start()
+
+    def remove_root(self, key):
+        with self._lock:
+            self._roots.pop(key, None)
+            for wd, keys in list(self._wd_keys.items()):
+                keys.discard(key)
+                if not keys:
+                    self._libc.inotify_rm_watch(self._fd, wd)
+                    del self._wd_keys[wd]
+                    self._wd_paths.pop(wd, None)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        os.write(self._stop_w, b"x")
+
+    def _add_tree(self, key, path, initial=False):
+        stack = [path]
+        while stack:
+            d = stack.pop()
+            with self._lock:
+                if self._closed or key not in self._roots:
+                    return
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), self.WATCH_MASK)
+                err = ctypes.get_errno() if wd < 0 else 0
+                if wd >= 0:
+                    self._wd_paths[wd] = d
+                    self._wd_keys.setdefault(wd, set()).add(key)
+            if wd < 0:
+                if d == path or err not in (2, 13, 20): # ENOENT, EACCES, ENOTDIR
+                    # typically ENOSPC, ie. fs.inotify.max_user_watches is too low for this tree
+                    logging.warning(f"inotify_add_watch failed for {d}: {os.strerror(err)}")
+                    self.on_overflow(key)
+                    return
+                continue
+            try:
+                with os.scandir(d) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                pass
+        if initial:
+            self.on_ready(key, time.time())
+
+    def _keys_for(self, path):
+        with self._lock:
+            return [k for k, root in self._roots.items() if path == root or path.startswith(root.rstrip(os.sep) + os.sep)]
+
+    def _read_loop(self):
+        try:
+            while True:
+                r, _, _ = select.select([self._fd, self._stop_r], [], [])
+                if self._stop_r in r:
+                    break
+                try:
+                    data = os.read(self._fd, 65536)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+                    name = data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + name_len].rstrip(b"\0")
+                    offset += self.EVENT_HEADER.size + name_len
+                    self._handle_event(wd, mask, os.fsdecode(name))
+        except Exception:
+            logging.exception("inotify watcher failed")
+            self.on_overflow(None)
+        finally:
+            os.close(self._fd)
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            logging.warning("inotify event queue overflow")
+            self.on_overflow(None)
+            return
+        with self._lock:
+            d = self._wd_paths.get(wd)
+            if mask & self.IN_IGNORED:
+                self._wd_paths.pop(wd, None)
+                self._wd_keys.pop(wd, None)
+        if d is None:
+            return
+        path = os.path.join(d, name) if name else d
+        keys = self._keys_for(path)
+        for key in keys:
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED) and d == self._roots.get(key):
+                # the root itself is gone, nothing left to watch
+                self.on_overflow(key)
+            else:
+                self.on_change(key, path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._add_tree(key, path)
+
+
+class ReadDirectoryChangesBackend(WatcherBackend):
+    FILE_LIST_DIRECTORY = 0x0001
+    FILE_SHARE_ALL = 0x00000007
+    OPEN_EXISTING = 3
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    FILE_NOTIFY_FILTER = 0x00000001 | 0x00000002 | 0x00000008 | 0x00000010 | 0x00000040 # names, size, last write, creation
+    BUFFER_SIZE = 65536 # larger buffers fail on network shares
+
+    def __init__(self, on_ready, on_change, on_overflow):
+        super().__init__(on_ready, on_change, on_overflow)
+        from ctypes import wintypes
+        self._kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._kernel32.CreateFileW.restype = wintypes.HANDLE
+        self._kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+                                               wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+        self._kernel32.ReadDirectoryChangesW.restype = wintypes.BOOL
+        self._kernel32.ReadDirectoryChangesW.argtypes = [wintypes.HANDLE, wintypes.LPVOID, wintypes.DWORD, wintypes.BOOL,
+                                                         wintypes.DWORD, ctypes.POINTER(wintypes.DWORD), wintypes.LPVOID, wintypes.LPVOID]
+        self._kernel32.CancelIoEx.argtypes = [wintypes.HANDLE, wintypes.LPVOID]
+        self._kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        self._invalid_handle = wintypes.HANDLE(-1).value
+        self._lock = threading.Lock()
+        self._handles:dict = {} # key -> handle
+
+    def add_root(self, key, path):
+        threading.Thread(target=self._watch, args=(key, path), daemon=True, name=f"DirChangesWatcher-{key}").start()
+
+    def remove_root(self, key):
+        with self._lock:
+            handle = self._handles.pop(key, None)
+        if handle is not None:
+            self._kernel32.CancelIoEx(handle, None)
+
+    def close(self):
+        for key in list(self._handles):
+            self.remove_root(key)
+
+    def _watch(self, key, path):
+        from ctypes import wintypes
+        # synchronous handle, ReadDirectoryChangesW below blocks without an OVERLAPPED and CancelIoEx ends the wait
+        handle = self._kernel32.CreateFileW(path, self.FILE_LIST_DIRECTORY, self.FILE_SHARE_ALL, None, self.OPEN_EXISTING,
+                                            self.FILE_FLAG_BACKUP_SEMANTICS, None)
+        if handle == self._invalid_handle or handle is None:
+            logging.warning(f"Failed to open {path} for watching: {ctypes.WinError(ctypes.get_last_error())}")
+            self.on_overflow(key)
+            return
+        with self._lock:
+            self._handles[key] = handle
+        buf = ctypes.create_string_buffer(self.BUFFER_SIZE)
+        n_bytes = wintypes.DWORD()
+        # Changes are only queued once the first ReadDirectoryChangesW call is pending, leave it some time to get there.
+        self.on_ready(key, time.time() + 1.0)
+        try:
+            while True:
+                ok = self._kernel32.ReadDirectoryChangesW(handle, buf, len(buf), True, self.FILE_NOTIFY_FILTER, ctypes.byref(n_bytes), None, None)
+                if not ok:
+                    with self._lock:
+                        stopped = key not in self._handles
+                    if not stopped:
+                        logging.warning(f"Watching {path} failed: {ctypes.WinError(ctypes.get_last_error())}")
+                        self.on_overflow(key)
+                    break
+                if n_bytes.value == 0:
+                    # the system buffer overflowed, individual changes are lost
+                    self.on_overflow(key)
+                    continue
+                raw = buf.raw[:n_bytes.value]
+                offset = 0
+                while True:
+                    next_offset, _, name_len = struct.unpack_from("<III", raw, offset)
+                    name = raw[offset + 12:offset + 12 + name_len].decode('utf-16-le', 'surrogatepass')
+                    self.on_change(key, os.path.join(path, name))
+                    if next_offset == 0:
+                        break
+                    offset += next_offset
+        finally:
+            with self._lock:
+                self._handles.pop(key, None)
+            self._kernel32.CloseHandle(handle)
+
+
+class _WatchedRoot:
+    def __init__(self, path, iexclude):
+        self.path = path
+        self.iexclude = iexclude
+        self.filter = IExcludeFilter(iexclude, path)
+        self.ready_at = None    # changes after this point in time are reported
+        self.last_change = 0.0
+        self.overflow_at = 0.0  # changes before this point in time may have been lost
+        self.scanned_at = None  # start of the last prescan/backup that got persisted
+        self.dirty_reported = False
+
+
+class ChangeWatcher:
+    """
+    Keeps track of changes below the enabled backup directories so that BackupTask can skip the
+    prescan for directories that did not change since their last successful prescan/backup.
+    Anything uncertain (not ready yet, overflow, app restart, ...) makes a directory count as changed,
+    which falls back to the regular prescan.
+    """
+    _lock = threading.RLock()
+    _backend:WatcherBackend|None = None
+    _roots:dict[int, _WatchedRoot] = {}
+
+    @staticmethod
+    def create_backend() -> WatcherBackend|None:
+        callbacks = (ChangeWatcher._on_ready, ChangeWatcher._on_change, ChangeWatcher._on_overflow)
+        if sys.platform == "win32":
+            return ReadDirectoryChangesBackend(*callbacks)
+        if sys.platform.startswith("linux"):
+            return InotifyBackend(*callbacks)
+        return None
+
+    @staticmethod
+    def sync(dirs:list):
+        """ Subscribes to the given BackupDir entries and drops all others. An empty list stops the watcher. """
+        with ChangeWatcher._lock:
+            wanted = {d.id: str(d.path) for d in dirs if d.id is not None and d.path.is_dir()}
+            iexcludes = {d.id: d.iexclude for d in dirs}
+            if wanted and ChangeWatcher._backend is None:
+                try:
+                    ChangeWatcher._backend = ChangeWatcher.create_backend()
+                except Exception as e:
+                    logging.error(f"Failed to start change watcher: {e}")
+                if ChangeWatcher._backend is None:
+                    return
+                logging.info(f"Change watcher started ({type(ChangeWatcher._backend).__name__})")
+            backend = ChangeWatcher._backend
+            if backend is None:
+                return
+
+            for key, root in list(ChangeWatcher._roots.items()):
+                if wanted.get(key) != root.path:
+                    backend.remove_root(key)
+                    del ChangeWatcher._roots[key]
+            for key, path in wanted.items():
+                r = ChangeWatcher._roots.get(key)
+                if r is None:
+                    ChangeWatcher._roots[key] = _WatchedRoot(path, iexcludes[key])
+                    backend.add_root(key, path)
+                elif r.iexclude != iexcludes[key]:
+                    # the prescan result depends on the exclusions, so treat the directory as changed
+                    r.iexclude = iexcludes[key]
+                    r.filter = IExcludeFilter(r.iexclude, path)
+                    r.overflow_at = time.time()
+
+            if not wanted:
+                backend.close()
+                ChangeWatcher._backend = None
+                logging.info("Change watcher stopped")
+
+    @staticmethod
+    def shutdown():
+        ChangeWatcher.sync([])
+
+    @staticmethod
+    def is_clean(key) -> bool:
+        with ChangeWatcher._lock:
+            r = ChangeWatcher._roots.get(key)
+            if r is None or r.ready_at is None or r.scanned_at is None:
+                return False
+            return r.scanned_at >= r.ready_at and r.overflow_at < r.scanned_at and r.last_change < r.scanned_at
+
+    @staticmethod
+    def mark_scanned(key, ts):
+        """ Call on the UI thread after the state of the directory as of ts got persisted. """
+        with ChangeWatcher._lock:
+            r = ChangeWatcher._roots.get(key)
+            if r is None or r.ready_at is None or ts < r.ready_at:
+                return
+            r.scanned_at = ts
+            clean = r.last_change < ts and r.overflow_at < ts
+            if clean:
+                r.dirty_reported = False
+        if clean:
+            ChangeWatcher._save_state(key, False, r.last_change)
+
+    @staticmethod
+    def _on_ready(key, ts):
+        with ChangeWatcher._lock:
+            r = ChangeWatcher._roots.get(key)
+            if r is not None:
+                r.ready_at = ts
+                logging.debug(f"Watching {r.path}")
+
+    @staticmethod
+    def _on_change(key, path):
+        now = time.time()
+        with ChangeWatcher._lock:
+            r = ChangeWatcher._roots.get(key)
+            if r is None or r.filter.is_excluded(path):
+                return
+            r.last_change = now
+            if r.dirty_reported:
+                return
+            r.dirty_reported = True
+        logging.debug(f"Change detected: {path}")
+        ChangeWatcher._dispatch_ui(ChangeWatcher._save_state, key, True, now)
+
+    @staticmethod
+    def _on_overflow(key):
+        now = time.time()
+        with ChangeWatcher._lock:
+            keys = list(ChangeWatcher._roots) if key is None else [key]
+            for k in keys:
+                r = ChangeWatcher._roots.get(k)
+                if r is not None:
+                    r.overflow_at = now
+                    r.dirty_reported = True
+        for k in keys:
+            ChangeWatcher._dispatch_ui(ChangeWatcher._save_state, k, True, now)
+
+    @staticmethod
+    def _dispatch_ui(func, *args):
+        if common.root:
+            common.root.after(0, lambda: func(*args))
+
+    @staticmethod
+    def _save_state(key, dirty, changed_at):
+        try:
+            with common.db_conn as conn:
+                conn.execute("INSERT OR REPLACE INTO watch_state (backup_dir_id, dirty, changed_at) VALUES (?, ?, ?)", (key, 1 if dirty else 0, changed_at))
+        except Exception as e:
+            logging.error(f"Failed to save watch state: {e}")
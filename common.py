@@ -7,7 +7,6 @@ import sqlite3
 import stat
 import subprocess
 import sys
-import tempfile
 import time
 from contextlib import contextmanager
 from pathlib import Path
@@ -16,6 +15,7 @@ import tkinter as Tk
 from windows_toasts import WindowsToaster
 
 from piabackup import APPNAME
+from piabackup.backup_rules import BackupRules
 import ui.tools
 
 LAPPDATA_PATH = Path(os.environ.get('LOCALAPPDATA', os.path.join(os.path.expanduser('~'), 'AppData', 'Local')))
@@ -32,7 +32,9 @@ DB_PATH = CFG_DIR_PATH / 'sqlite.db'
 BIN_DL_DIR = CFG_DIR_PATH / 'dl'
 BIN_DL_DIR.mkdir(parents=True, exist_ok=True)
 
-MIN_FREQUENCY = 60
+SCAN_SNAPSHOT_DIR = CFG_DIR_PATH / 'scans'
+LS_CACHE_DIR = CFG_DIR_PATH / 'ls'
+
 DEFAULT_FREQ = 86400
 
 DEFAULT_CHECK_IVAL = 86400 * 7 # perform an intense check every N days 
@@ -43,6 +45,15 @@ MIN_UPDATE_CHECK_IVAL = 3600 * 3
 
 FULL_CHECK_SEGMENTS = 100
 
+DEFAULT_PRESCAN_WORKERS = 4
+PRESCAN_PROBE_IVAL = 86400 * 7 # re-measure the prescan of folders where it got disabled for being too slow
+DEFAULT_LS_CACHE_MB = 512
+DEFAULT_BITROT_WORKERS = 2
+PRUNE_RETRY_IVAL = 3600 # a failed prune runs again after this many seconds, if no other prune ran meanwhile
+DEFAULT_BACKUP_SLOTS = 1 # backups of different folders running at the same time
+DEFAULT_INTERACTIVE_WORKERS = 2 # threads for browsing, restores and other tasks the user waits for
+BACKUP_PROGRESS_FPS = 1 # restic's default for --json output is 60 status lines per second
+
 RESTIC_CACHE_DIR = LAPPDATA_PATH / "restic"
 
 IS_ADMIN = False
@@ -104,42 +115,18 @@ def quote_command(cmd_list:list[str]):
         # POSIX (Linux/macOS) shell style quoting
         return shlex.join(cmd_list)
 
-def format_restic_path(path: Path):
-    # Transform C:\Users\work to /C/Users/work
-    drive = path.drive
-    if drive:
-        return "/" + drive.replace(":", "") + path.as_posix().replace(drive, "")
-    return path.as_posix()
+def format_bytes(size):
+    unit = ""
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024.0:
+            break
+        size /= 1024.0
+    return f"{size:.1f} {unit}"
 
 @contextmanager
 def handle_iexclude_file(iexclude: str|None, backup_path: Path, is_rewrite: bool = False):
-    if not iexclude:
-        yield None
-        return
-
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8', suffix=".txt") as tmp:
-        absolute_exclusions = []
-        if sys.platform == "win32" and is_rewrite:
-            for line in iexclude.splitlines():
-                line = line.strip()
-                if line:
-                    absolute_exclusions.append(format_restic_path(backup_path.joinpath(line.lstrip('/\\'))))
-        else:
-            for line in iexclude.splitlines():
-                line = line.strip()
-                if line:
-                    absolute_exclusions.append(backup_path.joinpath(line.lstrip('/\\')).as_posix())
-
-        if ui.tools.IS_DEBUGGER_PRESENT:
-            logging.debug("iexclude file=" + "\n".join(absolute_exclusions))
-        
-        tmp.write("\n".join(absolute_exclusions))
-        tmp_path = tmp.name
-
-    try:
+    with BackupRules.iexclude_file(iexclude, backup_path, is_rewrite, debug=ui.tools.IS_DEBUGGER_PRESENT) as tmp_path:
         yield tmp_path
-    finally:
-        os.remove(tmp_path)
 
 def get_system_sleep_timeout():
     """
@@ -10,6 +10,7 @@ class Config:
         self.full_check_frequency = common.DEFAULT_CHECK_IVAL
         self.error_check_frequency = common.DEFAULT_ERROR_CHECK_IVAL
         self.bitrot_detection = False
+        self.bitrot_workers = common.DEFAULT_BITROT_WORKERS
         self.prune_enabled = False
         self.no_lock = False
         self.make_vanished_permanent = True
@@ -19,6 +20,18 @@ class Config:
         self.update_check_frequency = common.DEFAULT_UPDATE_CHECK_IVAL
         self.update_check_toast_interval = common.DEFAULT_UPDATE_TOAST_IVAL
         self.prescan_enabled = True
+        self.prescan_workers = common.DEFAULT_PRESCAN_WORKERS
+        self.prescan_budget = 0
+        self.prescan_processes = 0
+        self.prescan_autotune = True
+        self.prescan_index = False
+        self.change_watcher = False
+        self.scan_snapshots = False
+        self.ls_cache_mb = common.DEFAULT_LS_CACHE_MB
+        self.backup_slots = common.DEFAULT_BACKUP_SLOTS
+        self.rclone_serve = False
+        self.interactive_workers = common.DEFAULT_INTERACTIVE_WORKERS
+        self.interactive_no_lock = True
         self.wait_for_idle = True
         self.load()
 
@@ -32,6 +45,7 @@ class Config:
                 self.full_check_frequency = int(data.get("full_check_frequency", common.DEFAULT_CHECK_IVAL))
                 self.error_check_frequency = int(data.get("error_check_frequency", common.DEFAULT_ERROR_CHECK_IVAL))
                 self.bitrot_detection = bool(int(data.get("bitrot_detection", "1")))
+                self.bitrot_workers = int(data.get("bitrot_workers", common.DEFAULT_BITROT_WORKERS))
                 self.prune_enabled = bool(int(data.get("prune_enabled", "0")))
                 self.no_lock = bool(int(data.get("no_lock", "0")))
                 self.make_vanished_permanent = bool(int(data.get("make_vanished_permanent", "1")))
@@ -41,6 +55,18 @@ class Config:
                 self.update_check_frequency = int(data.get("update_check_frequency", common.DEFAULT_UPDATE_CHECK_IVAL))
                 self.update_check_toast_interval = int(data.get("update_check_toast_interval", common.DEFAULT_UPDATE_TOAST_IVAL))
                 self.prescan_enabled = bool(int(data.get("prescan_enabled", "1")))
+                self.prescan_workers = int(data.get("prescan_workers", common.DEFAULT_PRESCAN_WORKERS))
+                self.prescan_budget = int(data.get("prescan_budget", "0"))
+                self.prescan_processes = int(data.get("prescan_processes", "0"))
+                self.prescan_autotune = bool(int(data.get("prescan_autotune", "1")))
+                self.prescan_index = bool(int(data.get("prescan_index", "0")))
+                self.change_watcher = bool(int(data.get("change_watcher", "0")))
+                self.scan_snapshots = bool(int(data.get("scan_snapshots", "0")))
+                self.ls_cache_mb = int(data.get("ls_cache_mb", common.DEFAULT_LS_CACHE_MB))
+                self.backup_slots = int(data.get("backup_slots", common.DEFAULT_BACKUP_SLOTS))
+                self.rclone_serve = bool(int(data.get("rclone_serve", "0")))
+                self.interactive_workers = int(data.get("interactive_workers", common.DEFAULT_INTERACTIVE_WORKERS))
+                self.interactive_no_lock = bool(int(data.get("interactive_no_lock", "1")))
                 self.wait_for_idle = bool(int(data.get("wait_for_idle", "1")))
         except Exception as e:
             logging.error(f"Failed to load config: {e}")
@@ -53,6 +79,7 @@ class Config:
                 "full_check_frequency": str(self.full_check_frequency),
                 "error_check_frequency": str(self.error_check_frequency),
                 "bitrot_detection": "1" if self.bitrot_detection else "0",
+                "bitrot_workers": str(self.bitrot_workers),
                 "prune_enabled": "1" if self.prune_enabled else "0",
                 "no_lock": "1" if self.no_lock else "0",
                 "make_vanished_permanent": "1" if self.make_vanished_permanent else "0",
@@ -62,6 +89,18 @@ class Config:
                 "update_check_frequency": str(self.update_check_frequency),
                 "update_check_toast_interval": str(self.update_check_toast_interval),
                 "prescan_enabled": "1" if self.prescan_enabled else "0",
+                "prescan_workers": str(self.prescan_workers),
+                "prescan_budget": str(self.prescan_budget),
+                "prescan_processes": str(self.prescan_processes),
+                "prescan_autotune": "1" if self.prescan_autotune else "0",
+                "prescan_index": "1" if self.prescan_index else "0",
+                "change_watcher": "1" if self.change_watcher else "0",
+                "scan_snapshots": "1" if self.scan_snapshots else "0",
+                "ls_cache_mb": str(self.ls_cache_mb),
+                "backup_slots": str(self.backup_slots),
+                "rclone_serve": "1" if self.rclone_serve else "0",
+                "interactive_workers": str(self.interactive_workers),
+                "interactive_no_lock": "1" if self.interactive_no_lock else "0",
                 "wait_for_idle": "1" if self.wait_for_idle else "0"
             }
             with common.db_conn as conn:
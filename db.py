@@ -3,6 +3,11 @@ import sqlite3
 import time
 
 import piabackup.common as common
+from piabackup.backup_cost import BackupCost
+from piabackup.backup_progress import ThroughputLog
+from piabackup.fast_scan_index import FastScanIndex, PrescanCheckpoint
+from piabackup.prescan_stats import PrescanStats
+from piabackup.snapshot_catalog import SnapshotCatalog
 
 
 class DB:
@@ -11,12 +16,31 @@ class DB:
         with common.db_conn as conn:
             conn.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)")
             conn.execute("CREATE TABLE IF NOT EXISTS status (key TEXT PRIMARY KEY, value TEXT)")
-            conn.execute("CREATE TABLE IF NOT EXISTS backup_dirs (id INTEGER PRIMARY KEY, path TEXT, enabled TEXT, fastscan_fingerprint TEXT, error TEXT, last_run REAL, frequency INTEGER, next_run REAL, bitrot_snap TEXT, summary TEXT, n_backups_since_last_perm_tag INTEGER, iexclude TEXT, last_fullcheck REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS backup_dirs (id INTEGER PRIMARY KEY, path TEXT, enabled TEXT, fastscan_fingerprint TEXT, error TEXT, last_run REAL, frequency INTEGER, next_run REAL, bitrot_snap TEXT, summary TEXT, n_backups_since_last_perm_tag INTEGER, iexclude TEXT, last_fullcheck REAL, check_error TEXT DEFAULT '')")
+
+            conn.execute(FastScanIndex.SCHEMA)
+            conn.execute(PrescanCheckpoint.SCHEMA)
+            conn.execute(PrescanStats.SCHEMA)
+            conn.execute(ThroughputLog.SCHEMA)
+            conn.execute(BackupCost.SCHEMA)
+            for stmt in SnapshotCatalog.SCHEMA:
+                conn.execute(stmt)
+            conn.execute("CREATE TABLE IF NOT EXISTS watch_state (backup_dir_id INTEGER PRIMARY KEY, dirty INTEGER, changed_at REAL)")
+            # the change watcher starts from scratch on every app start
+            conn.execute("UPDATE watch_state SET dirty=1")
 
             try:
                 conn.execute("ALTER TABLE backup_dirs ADD COLUMN last_fullcheck REAL DEFAULT 0")
             except sqlite3.OperationalError:
                 pass
+            try:
+                conn.execute("ALTER TABLE backup_throughput ADD COLUMN files_unmodified INTEGER")
+            except sqlite3.OperationalError:
+                pass
+            try:
+                conn.execute("ALTER TABLE backup_dirs ADD COLUMN check_error TEXT DEFAULT ''")
+            except sqlite3.OperationalError:
+                pass
 
             # Default config
             defaults_config = {
@@ -24,6 +48,7 @@ class DB:
                 "full_check_frequency": str(common.DEFAULT_CHECK_IVAL),
                 "error_check_frequency": str(common.DEFAULT_ERROR_CHECK_IVAL),
                 "bitrot_detection": "1",
+                "bitrot_workers": str(common.DEFAULT_BITROT_WORKERS),
                 "prune_enabled": "0",
                 "no_lock": "0",
                 "make_vanished_permanent": "1",
@@ -33,6 +58,18 @@ class DB:
                 "update_check_frequency": str(common.DEFAULT_UPDATE_CHECK_IVAL),
                 "update_check_toast_interval": str(common.DEFAULT_UPDATE_TOAST_IVAL),
                 "prescan_enabled": "1",
+                "prescan_workers": str(common.DEFAULT_PRESCAN_WORKERS),
+                "prescan_budget": "0",
+                "prescan_processes": "0",
+                "prescan_autotune": "1",
+                "prescan_index": "0",
+                "change_watcher": "0",
+                "scan_snapshots": "0",
+                "ls_cache_mb": str(common.DEFAULT_LS_CACHE_MB),
+                "backup_slots": str(common.DEFAULT_BACKUP_SLOTS),
+                "rclone_serve": "0",
+                "interactive_workers": str(common.DEFAULT_INTERACTIVE_WORKERS),
+                "interactive_no_lock": "1",
                 "wait_for_idle": "1"
             }
             for k, v in defaults_config.items():
@@ -46,6 +83,11 @@ class DB:
             for k, v in defaults_status.items():
                 conn.execute("INSERT OR IGNORE INTO status (key, value) VALUES (?, ?)", (k, v))
 
+    # common.db_conn belongs to the UI thread. Code running in worker threads has to use its own connection.
+    @staticmethod
+    def connect() -> sqlite3.Connection:
+        return sqlite3.connect(common.DB_PATH, timeout=30)
+
     @staticmethod
     def full_check_due_in():
         with common.db_conn as conn:
@@ -1,27 +1,384 @@
 # encoding: utf-8
+import ctypes
 import hashlib
+import logging
 import os
+import platform
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from piabackup.iexclude_filter import IExcludeFilter
+
+
+class DirRecord:
+    __slots__ = ("digest", "mtime_ns", "n_entries", "subdirs", "files")
+
+    def __init__(self, digest, mtime_ns, n_entries, subdirs, files=None):
+        self.digest = digest        # sha256 over the files directly contained in this directory
+        self.mtime_ns = mtime_ns    # mtime of the directory itself
+        self.n_entries = n_entries  # number of files and subdirectories that are not excluded
+        self.subdirs = subdirs      # list of (name, mtime_ns, exclusion filter state)
+        self.files = files          # FileColumns if requested from scan_tree, else None
+
+
+class FileColumns:
+    __slots__ = ("names", "sizes", "mtimes_ns", "inodes")
+
+    def __init__(self):
+        self.names = []
+        self.sizes = array('q')
+        self.mtimes_ns = array('q')
+        self.inodes = array('Q')
+
+
+class ScanInterrupted(Exception):
+    pass
+
+
+class ScanBudget:
+    """
+    Limits the pace of a scan to files_per_sec directory entries per second, shared by all scan threads,
+    and lets the scan be stopped. on_checkpoint(records) is called about every checkpoint_interval seconds
+    from the thread running scan_tree.
+    """
+    BURST_SEC = 1.0
+
+    def __init__(self, files_per_sec, should_stop=None, on_checkpoint=None, checkpoint_interval=10.0):
+        self.files_per_sec = files_per_sec
+        self.should_stop = should_stop
+        self.on_checkpoint = on_checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+        self._last_checkpoint = time.monotonic()
+
+    def check(self):
+        if self.should_stop and self.should_stop():
+            raise ScanInterrupted()
+
+    def consume(self, n_entries):
+        if self.files_per_sec <= 0:
+            self.check()
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now - self.BURST_SEC) + n_entries / self.files_per_sec
+            delay = self._next - now
+        while True:
+            self.check()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, 0.5))
+            delay -= 0.5
+
+    def checkpoint(self, records, force=False):
+        now = time.monotonic()
+        if self.on_checkpoint and (force or now >= self._last_checkpoint + self.checkpoint_interval):
+            self._last_checkpoint = now
+            self.on_checkpoint(records)
+
 
 class FastScan:
+    THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+    IOPRIO_WHO_PROCESS = 1
+    IOPRIO_CLASS_IDLE = 3
+    IOPRIO_CLASS_SHIFT = 13
+    IOPRIO_SET_SYSCALL = {"x86_64": 251, "i686": 289, "aarch64": 30, "armv7l": 314}
+
+    @staticmethod
+    def directory_fingerprint(path, workers=1, iexclude=None):
+        return FastScan.fingerprint(FastScan.scan_tree(path, workers, iexclude))
+
     @staticmethod
-    def directory_fingerprint(path):
+    def fingerprint(records: dict[str, DirRecord]):
+        # Every directory gets its own digest and the digests are combined sorted by relative path,
+        # so the fingerprint neither depends on traversal order nor on the number of workers.
         hasher = hashlib.sha256()
-        stack = [path]
-        
-        while stack:
-            current_dir = stack.pop()
+        for rel_dir in sorted(records):
+            hasher.update(f"{rel_dir}\0{records[rel_dir].digest}\n".encode('utf-8', 'surrogatepass'))
+        return hasher.hexdigest()
+
+    @staticmethod
+    def merkle_aggregates(records: dict[str, DirRecord]) -> dict[str, str]:
+        """
+        Returns a dict mapping each directory to a digest over its own files and the aggregates
+        of all its subdirectories, ie. the aggregate changes iff something below it changed.
+        """
+        aggregates = {}
+        for rel_dir in sorted(records, key=FastScan.depth, reverse=True):
+            rec = records[rel_dir]
+            hasher = hashlib.sha256(rec.digest.encode('ascii'))
+            for name in sorted(s[0] for s in rec.subdirs):
+                child = aggregates.get(FastScan._rel_join(rel_dir, name))
+                if child is not None:
+                    hasher.update(f"{name}\0{child}\n".encode('utf-8', 'surrogatepass'))
+            aggregates[rel_dir] = hasher.hexdigest()
+        return aggregates
+
+    @staticmethod
+    def depth(rel_dir):
+        return rel_dir.count('/') + 1 if rel_dir else 0
+
+    @staticmethod
+    def scan_tree(path, workers=1, iexclude=None, with_files=False, budget:'ScanBudget|None'=None, records=None) -> dict[str, DirRecord]:
+        """
+        Returns a dict mapping each readable directory below path (relative, '/' separated,
+        '' for the root itself) to its DirRecord. Entries matched by the iexclude lines of the
+        backup directory are skipped and excluded directories are not descended into.
+        with_files additionally collects size, mtime and inode of every file.
+
+        With a budget the scan runs in low priority threads at the budget's pace and raises ScanInterrupted
+        when asked to stop. records may contain the directories of an interrupted scan to resume from, it is
+        filled in place so that it holds the progress made so far if the scan gets interrupted again.
+        """
+        records = {} if records is None else records
+        root = str(path)
+        try:
+            root_mtime_ns = os.stat(root).st_mtime_ns
+        except OSError:
+            root_mtime_ns = 0
+        flt = IExcludeFilter(iexclude, root) if iexclude else None
+        root_state = flt.root_state() if flt else None
+
+        todo = []
+        if records:
+            for rel_dir, rec in list(records.items()):
+                for name, child_mtime_ns, child_state in rec.subdirs:
+                    child_rel = FastScan._rel_join(rel_dir, name)
+                    if child_rel not in records:
+                        if flt and child_state is None:
+                            child_state = FastScan._filter_state(flt, child_rel)
+                        todo.append((os.path.join(root, *child_rel.split('/')), child_rel, child_mtime_ns, child_state))
+        else:
+            todo.append((root, "", root_mtime_ns, root_state))
+
+        if workers <= 1 and budget is None:
+            stack = todo
+            while stack:
+                abs_dir, rel_dir, mtime_ns, state = stack.pop()
+                rec = FastScan.scan_dir(abs_dir, mtime_ns, flt, state, with_files)
+                if rec is None:
+                    continue
+                records[rel_dir] = rec
+                for name, child_mtime_ns, child_state in rec.subdirs:
+                    stack.append((os.path.join(abs_dir, name), FastScan._rel_join(rel_dir, name), child_mtime_ns, child_state))
+            return records
+
+        # os.scandir and stat release the GIL, so listing several directories at once pays off
+        # on slow disks and network shares.
+        initializer = FastScan.lower_thread_priority if budget is not None else None
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="FastScan", initializer=initializer) as executor:
+            pending = {}
             try:
-                with os.scandir(current_dir) as it:
-                    for entry in it:
-                        if entry.is_dir(follow_symlinks=False):
-                            stack.append(entry.path)
-                        elif entry.is_file(follow_symlinks=False):
-                            try:
-                                st = entry.stat()
-                                hasher.update(f"{st.st_mtime} {entry.path}\0".encode('utf-8'))
-                            except OSError:
-                                pass
+                for abs_dir, rel_dir, mtime_ns, state in todo:
+                    pending[executor.submit(FastScan.scan_dir, abs_dir, mtime_ns, flt, state, with_files, budget)] = (abs_dir, rel_dir)
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        abs_dir, rel_dir = pending.pop(fut)
+                        rec = fut.result()
+                        if rec is None:
+                            continue
+                        records[rel_dir] = rec
+                        for name, child_mtime_ns, child_state in rec.subdirs:
+                            child = os.path.join(abs_dir, name)
+                            pending[executor.submit(FastScan.scan_dir, child, child_mtime_ns, flt, child_state, with_files, budget)] = (child, FastScan._rel_join(rel_dir, name))
+                    if budget is not None:
+                        budget.checkpoint(records)
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        return records
+
+    @staticmethod
+    def scan_roots(roots:dict, workers=1, with_files=False) -> dict[object, dict[str, DirRecord]]:
+        """
+        Scans several backup roots at once. roots maps a key to (path, iexclude), the result maps each key to what
+        scan_tree would return for that root. Directories below more than one root (nested roots) are listed only
+        once and the listing is evaluated for every root containing them with that root's exclusions.
+        """
+        results = {key: {} for key in roots}
+        filters = {key: IExcludeFilter(iexclude, str(path)) if iexclude else None for key, (path, iexclude) in roots.items()}
+        norm = {key: FastScan._norm(path) for key, (path, _) in roots.items()}
+        remaining = set(roots)
+        while remaining:
+            tops = {}
+            nested = {}
+            for key in remaining:
+                if any(FastScan._is_below(norm[key], norm[other]) for other in remaining):
+                    nested.setdefault(norm[key], []).append(key)
+                else:
+                    tops.setdefault(norm[key], []).append(key)
+            reached = FastScan._scan_shared_trees(roots, tops, nested, filters, results, workers, with_files)
+            # nested roots below directories excluded by all containing roots were not reached and get walked on their own
+            remaining -= reached | {key for keys in tops.values() for key in keys}
+        return results
+
+    @staticmethod
+    def _scan_shared_trees(roots, tops, nested, filters, results, workers, with_files) -> set:
+        def root_entries(keys):
+            return [(key, "", filters[key].root_state() if filters[key] else None) for key in keys]
+
+        todo = []
+        for keys in tops.values():
+            path = str(roots[keys[0]][0])
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
             except OSError:
-                continue
-        
-        return hasher.hexdigest()
+                mtime_ns = 0
+            todo.append((path, mtime_ns, root_entries(keys)))
+
+        reached = set()
+
+        def expand(abs_dir, dir_records):
+            children = {}
+            for key, rel_dir, rec in dir_records:
+                results[key][rel_dir] = rec
+                for name, child_mtime_ns, child_state in rec.subdirs:
+                    children.setdefault(name, (child_mtime_ns, []))[1].append((key, FastScan._rel_join(rel_dir, name), child_state))
+            for name, (child_mtime_ns, active) in children.items():
+                child = os.path.join(abs_dir, name)
+                keys = nested.get(FastScan._norm(child))
+                if keys:
+                    reached.update(keys)
+                    active = active + root_entries(keys)
+                yield child, child_mtime_ns, active
+
+        if workers <= 1:
+            stack = todo
+            while stack:
+                abs_dir, mtime_ns, active = stack.pop()
+                dir_records = FastScan._scan_shared_dir(abs_dir, mtime_ns, active, filters, with_files)
+                if dir_records is not None:
+                    stack.extend(expand(abs_dir, dir_records))
+            return reached
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="FastScan") as executor:
+            pending = {executor.submit(FastScan._scan_shared_dir, abs_dir, mtime_ns, active, filters, with_files): abs_dir for abs_dir, mtime_ns, active in todo}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    abs_dir = pending.pop(fut)
+                    dir_records = fut.result()
+                    if dir_records is None:
+                        continue
+                    for child, child_mtime_ns, active in expand(abs_dir, dir_records):
+                        pending[executor.submit(FastScan._scan_shared_dir, child, child_mtime_ns, active, filters, with_files)] = child
+        return reached
+
+    @staticmethod
+    def _scan_shared_dir(path, mtime_ns, active, filters, with_files):
+        listing = FastScan.list_dir(path, with_files)
+        if listing is None:
+            return None
+        return [(key, rel_dir, FastScan.make_record(listing, mtime_ns, filters[key], state, with_files)) for key, rel_dir, state in active]
+
+    @staticmethod
+    def is_nested(path, parent):
+        """ True if path is strictly below parent. """
+        return FastScan._is_below(FastScan._norm(path), FastScan._norm(parent))
+
+    @staticmethod
+    def _norm(path):
+        return os.path.normcase(os.path.abspath(str(path)))
+
+    @staticmethod
+    def _is_below(path, parent):
+        return path != parent and path.startswith(parent.rstrip(os.sep) + os.sep)
+
+    @staticmethod
+    def _filter_state(flt:IExcludeFilter, rel_dir):
+        state = flt.root_state()
+        for part in rel_dir.split('/'):
+            _, state = flt.child(state, part)
+        return state
+
+    @staticmethod
+    def lower_thread_priority():
+        """ Lowers CPU and I/O priority of the calling thread only, the UI and restic keep their priority. """
+        try:
+            if sys.platform == "win32":
+                kernel32 = ctypes.windll.kernel32
+                kernel32.SetThreadPriority(kernel32.GetCurrentThread(), FastScan.THREAD_MODE_BACKGROUND_BEGIN)
+            elif sys.platform.startswith("linux"):
+                # On Linux nice and ioprio of a thread id only affect that thread, unlike os.nice() which changes the whole process.
+                tid = threading.get_native_id()
+                os.setpriority(os.PRIO_PROCESS, tid, 19)
+                nr = FastScan.IOPRIO_SET_SYSCALL.get(platform.machine())
+                if nr is not None:
+                    ctypes.CDLL(None, use_errno=True).syscall(nr, FastScan.IOPRIO_WHO_PROCESS, tid, FastScan.IOPRIO_CLASS_IDLE << FastScan.IOPRIO_CLASS_SHIFT)
+        except (OSError, AttributeError) as e:
+            logging.debug(f"Failed to lower scan thread priority: {e}")
+
+    @staticmethod
+    def scan_dir(path, mtime_ns=0, flt:IExcludeFilter|None=None, state=None, with_files=False, budget:ScanBudget|None=None):
+        if budget is not None:
+            budget.check()
+        listing = FastScan.list_dir(path, with_files)
+        if listing is None:
+            return None
+        if budget is not None:
+            budget.consume(1 + len(listing[0]) + len(listing[1]))
+        return FastScan.make_record(listing, mtime_ns, flt, state, with_files)
+
+    @staticmethod
+    def list_dir(path, with_inodes=False):
+        """ Returns the files of path as (name, stat_result, inode) and its subdirectories as (name, mtime_ns), or None if path can't be listed. """
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        try:
+                            subdirs.append((entry.name, entry.stat(follow_symlinks=False).st_mtime_ns))
+                        except OSError:
+                            subdirs.append((entry.name, 0))
+                    elif entry.is_file(follow_symlinks=False):
+                        try:
+                            st = entry.stat()
+                            files.append((entry.name, st, entry.inode() if with_inodes else 0))
+                        except OSError:
+                            pass
+        except OSError:
+            return None
+        return files, subdirs
+
+    @staticmethod
+    def make_record(listing, mtime_ns=0, flt:IExcludeFilter|None=None, state=None, with_files=False) -> DirRecord:
+        """ Builds the DirRecord of a list_dir result as seen by the backup root the exclusion filter state belongs to. """
+        files, dirs = listing
+        lines = []
+        subdirs = []
+        columns = FileColumns() if with_files else None
+        for name, st, inode in files:
+            if state:
+                excluded, _ = flt.child(state, name)
+                if excluded:
+                    continue
+            lines.append(f"{st.st_mtime} {name}")
+            if columns is not None:
+                columns.names.append(name)
+                columns.sizes.append(st.st_size)
+                columns.mtimes_ns.append(st.st_mtime_ns)
+                columns.inodes.append(inode)
+        for name, child_mtime_ns in dirs:
+            child_state = None
+            if state:
+                excluded, child_state = flt.child(state, name)
+                if excluded:
+                    continue
+            subdirs.append((name, child_mtime_ns, child_state))
+
+        hasher = hashlib.sha256()
+        lines.sort()
+        for line in lines:
+            hasher.update(f"{line}\0".encode('utf-8', 'surrogatepass'))
+        return DirRecord(hasher.hexdigest(), mtime_ns, len(lines) + len(subdirs), subdirs, columns)
+
+    @staticmethod
+    def _rel_join(rel_dir, name):
+        return f"{rel_dir}/{name}" if rel_dir else name
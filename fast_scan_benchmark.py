@@ -1,12 +1,68 @@
 # encoding: utf-8
+import argparse
+import ctypes
+import json
 import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
 import sys
+import tempfile
 import time
+import tracemalloc
+from contextlib import closing
 
 # Ensure we can import from the package even if running this script directly
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from piabackup.fast_scan import FastScan
+from piabackup.fast_scan_index import FastScanIndex
+from piabackup.fast_scan_pool import FastScanPool
+from piabackup.scan_snapshot import ScanSnapshot
+
+
+class TreeGenerator:
+    """ Creates the same directory tree for the same parameters and seed, including file sizes and mtimes. """
+    NAME_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789_-"
+    MTIME_BASE = 1_600_000_000
+
+    def __init__(self, depth=4, fanout=6, files_per_dir=20, name_len=12, file_size=0, seed=1):
+        self.depth = depth
+        self.fanout = fanout
+        self.files_per_dir = files_per_dir
+        self.name_len = name_len
+        self.file_size = file_size
+        self.seed = seed
+
+    def params(self):
+        return {"depth": self.depth, "fanout": self.fanout, "files_per_dir": self.files_per_dir,
+                "name_len": self.name_len, "file_size": self.file_size, "seed": self.seed}
+
+    def _name(self, rnd:random.Random, suffix=""):
+        return "".join(rnd.choice(self.NAME_CHARS) for _ in range(self.name_len)) + suffix
+
+    def generate(self, root):
+        rnd = random.Random(self.seed)
+        os.makedirs(root, exist_ok=True)
+        stack = [(root, 0)]
+        while stack:
+            path, level = stack.pop()
+            for i in range(self.files_per_dir):
+                fn = os.path.join(path, self._name(rnd, f"_{i}.dat"))
+                with open(fn, 'wb') as f:
+                    if self.file_size:
+                        f.write(b"\0" * rnd.randint(0, self.file_size))
+                mtime = self.MTIME_BASE + rnd.randint(0, 10**8)
+                os.utime(fn, (mtime, mtime))
+            if level < self.depth:
+                for i in range(self.fanout):
+                    sub = os.path.join(path, self._name(rnd, f"_{i}"))
+                    os.mkdir(sub)
+                    stack.append((sub, level + 1))
+
 
 class Benchmark:
     @staticmethod
@@ -29,8 +85,131 @@ class Benchmark:
         return dir_count, file_count
 
     @staticmethod
-    def run(path):
-        print(f"Benchmarking FastScan on: {path}")
+    def drop_caches():
+        """ Drops the OS file system caches if permitted. Returns None on success, otherwise the reason why not. """
+        try:
+            if sys.platform.startswith("linux"):
+                os.sync()
+                with open("/proc/sys/vm/drop_caches", "w") as f:
+                    f.write("3\n")
+                return None
+            if sys.platform == "win32":
+                # NtSetSystemInformation(SystemMemoryListInformation, MemoryPurgeStandbyList), needs admin rights
+                command = ctypes.c_int(4)
+                status = ctypes.windll.ntdll.NtSetSystemInformation(80, ctypes.byref(command), ctypes.sizeof(command))
+                return None if status == 0 else f"NtSetSystemInformation failed: 0x{status & 0xffffffff:08x}"
+            if sys.platform == "darwin":
+                subprocess.run(["purge"], check=True, capture_output=True)
+                return None
+        except (OSError, subprocess.CalledProcessError) as e:
+            return str(e)
+        return f"not supported on {sys.platform}"
+
+    @staticmethod
+    def strategies(path, workers, processes, iexclude):
+        """ All prescan variants the app offers, as name -> callable returning the fingerprint. """
+        def index_scan():
+            with closing(sqlite3.connect(":memory:")) as conn:
+                conn.execute(FastScanIndex.SCHEMA)
+                return FastScanIndex(conn, 1).update(path, workers)[0]
+
+        def snapshot_scan():
+            records = FastScan.scan_tree(path, workers, with_files=True)
+            ScanSnapshot.from_records(records)
+            return FastScan.fingerprint(records)
+
+        def nested_batch():
+            subdirs = sorted(e.path for e in os.scandir(path) if e.is_dir(follow_symlinks=False))[:2]
+            roots = {0: (path, None)}
+            roots.update((i + 1, (p, None)) for i, p in enumerate(subdirs))
+            return FastScan.fingerprint(FastScan.scan_roots(roots, workers)[0])
+
+        def pool_scan():
+            return FastScanPool.submit(processes, {0: (path, None)}, workers).result()[0][0]
+
+        result = {
+            "sequential": lambda: FastScan.directory_fingerprint(path, 1),
+            "threads": lambda: FastScan.directory_fingerprint(path, workers),
+            "index": index_scan,
+            "file_list": snapshot_scan,
+            "nested_batch": nested_batch,
+            "process_pool": pool_scan,
+        }
+        if iexclude:
+            result["exclusions"] = lambda: FastScan.directory_fingerprint(path, workers, iexclude)
+        return result
+
+    @staticmethod
+    def measure(func, repeat, cold):
+        times = []
+        skipped = None
+        for _ in range(repeat):
+            if cold:
+                skipped = Benchmark.drop_caches()
+                if skipped:
+                    return {"skipped": skipped}
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+
+        # separate run, tracemalloc slows down the scan considerably
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"median": statistics.median(times), "min": min(times), "max": max(times), "runs": len(times), "peak_bytes": peak}
+
+    @staticmethod
+    def run_suite(path, workers, processes, repeat, only=None, iexclude=None):
+        dir_count, file_count = Benchmark.count_items(path)
+        print(f"Benchmarking {path}: {dir_count} directories, {file_count} files (workers: {workers}, processes: {processes})")
+        results = {}
+        strategies = Benchmark.strategies(path, workers, processes, iexclude)
+        try:
+            for name, func in strategies.items():
+                if only and name not in only:
+                    continue
+                # warm up, also starts the process pool
+                func()
+                for cache in ("warm", "cold"):
+                    r = Benchmark.measure(func, repeat, cache == "cold")
+                    results[f"{name}/{cache}"] = r
+                    if "skipped" in r:
+                        print(f"{name:>14} {cache}: skipped ({r['skipped']})")
+                    else:
+                        print(f"{name:>14} {cache}: median {r['median']:.4f}s, min {r['min']:.4f}s, "
+                              f"{(dir_count + file_count) / r['median']:.0f} items/s, peak {r['peak_bytes'] / 1024 / 1024:.1f} MB (app process)")
+        finally:
+            FastScanPool.shutdown()
+        return {"dirs": dir_count, "files": file_count, "workers": workers, "processes": processes, "results": results}
+
+    @staticmethod
+    def compare(report, baseline, threshold):
+        """
+        Returns the list of regressions: strategies whose median time or peak memory grew by more than threshold
+        (0.2 = 20%) against the baseline.
+        """
+        regressions = []
+        for key, r in report["results"].items():
+            b = baseline.get("results", {}).get(key)
+            if not b or "median" not in b or "median" not in r:
+                continue
+            ratio = r["median"] / b["median"] if b["median"] > 0 else 1.0
+            status = "REGRESSION" if ratio > 1.0 + threshold else "ok"
+            print(f"{key:>20}: {b['median']:.4f}s -> {r['median']:.4f}s ({(ratio - 1) * 100:+.1f}%) {status}")
+            if status != "ok":
+                regressions.append(key)
+            if b.get("peak_bytes") and "peak_bytes" in r:
+                ratio = r["peak_bytes"] / b["peak_bytes"]
+                status = "REGRESSION" if ratio > 1.0 + threshold else "ok"
+                print(f"{key + ' peak':>20}: {b['peak_bytes'] / 1024 / 1024:.1f} MB -> {r['peak_bytes'] / 1024 / 1024:.1f} MB ({(ratio - 1) * 100:+.1f}%) {status}")
+                if status != "ok":
+                    regressions.append(f"{key} peak")
+        return regressions
+
+    @staticmethod
+    def run(path, workers=1):
+        print(f"Benchmarking FastScan on: {path} (workers: {workers})")
         if not os.path.exists(path):
             print("Error: Path does not exist.")
             return
@@ -45,24 +224,90 @@ class Benchmark:
 
         iterations = 0
         start_time = time.time()
-        
+
         while True:
-            FastScan.directory_fingerprint(path)
+            FastScan.directory_fingerprint(path, workers)
             iterations += 1
             if time.time() - start_time >= 10.0:
                 break
 
         total_time = time.time() - start_time
-        
+
         print("-" * 40)
         print(f"Total time: {total_time:.4f}s")
         print(f"Iterations: {iterations}")
         print(f"Avg time per run: {total_time / iterations:.4f}s")
-        
+
         if total_time > 0:
             items_per_sec = (total_items * iterations) / total_time
             print(f"Traversed items per second: {items_per_sec:.2f}")
 
+    @staticmethod
+    def main(argv):
+        parser = argparse.ArgumentParser(description="FastScan benchmark. Without --suite it times the default prescan on a directory for 10 seconds.")
+        parser.add_argument("path", nargs="?", help="directory to scan (default: current directory, or a generated tree with --generate)")
+        parser.add_argument("workers", nargs="?", type=int, default=os.cpu_count() or 1, help="scan threads (default: number of CPUs)")
+        parser.add_argument("--workers", type=int, dest="workers_opt", help="same as the positional workers argument")
+        parser.add_argument("--suite", action="store_true", help="compare all prescan strategies with warm and cold caches")
+        parser.add_argument("--processes", type=int, default=2)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--only", nargs="*", help="strategies to run")
+        parser.add_argument("--iexclude", help="exclusion lines for the 'exclusions' strategy, separated by ';'")
+        parser.add_argument("--generate", action="store_true", help="benchmark a generated synthetic tree (implies --suite)")
+        parser.add_argument("--depth", type=int, default=4)
+        parser.add_argument("--fanout", type=int, default=6)
+        parser.add_argument("--files-per-dir", type=int, default=20)
+        parser.add_argument("--name-len", type=int, default=12)
+        parser.add_argument("--file-size", type=int, default=0, help="maximum file size in bytes")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--keep", action="store_true", help="don't delete the generated tree")
+        parser.add_argument("--json", help="write the results to this file")
+        parser.add_argument("--baseline", help="compare against the results in this JSON file")
+        parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth of time and peak memory against the baseline (default 0.2 = 20%%)")
+        args = parser.parse_args(argv)
+        if args.workers_opt is not None:
+            args.workers = args.workers_opt
+
+        if not args.suite and not args.generate:
+            Benchmark.run(args.path or os.getcwd(), args.workers)
+            return 0
+
+        workers = max(1, args.workers)
+        if workers == 1:
+            print("Warning: with 1 worker the 'threads' strategy is the same as 'sequential'.")
+        generated = None
+        path = args.path
+        report = {"machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()}}
+        try:
+            if args.generate:
+                gen = TreeGenerator(args.depth, args.fanout, args.files_per_dir, args.name_len, args.file_size, args.seed)
+                generated = tempfile.mkdtemp(prefix="fastscan_bench_", dir=path)
+                print(f"Generating tree in {generated}: {gen.params()}")
+                gen.generate(generated)
+                path = generated
+                report["tree"] = gen.params()
+            path = path or os.getcwd()
+            iexclude = "\n".join(args.iexclude.split(";")) if args.iexclude else None
+            report.update(Benchmark.run_suite(path, workers, args.processes, args.repeat, args.only, iexclude))
+        finally:
+            if generated and not args.keep:
+                shutil.rmtree(generated, ignore_errors=True)
+
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {args.json}")
+
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            if baseline.get("tree") != report.get("tree"):
+                print("Warning: baseline was measured on a different tree.")
+            regressions = Benchmark.compare(report, baseline, args.threshold)
+            if regressions:
+                print(f"{len(regressions)} regression(s) above {args.threshold * 100:.0f}%")
+                return 1
+        return 0
+
 if __name__ == "__main__":
-    target_dir = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
-    Benchmark.run(target_dir)
\ No newline at end of file
+    sys.exit(Benchmark.main(sys.argv[1:]))
@@ -0,0 +1,112 @@
+# encoding: utf-8
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+from piabackup.fast_scan import DirRecord, FastScan
+
+
+class FastScanIndex:
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS fastscan_index (backup_dir_id INTEGER, path TEXT, mtime_ns INTEGER, n_entries INTEGER, digest TEXT, "
+              "PRIMARY KEY (backup_dir_id, path))")
+
+    # Persistent per-directory Merkle index of the last prescan. 'digest' is the aggregate over the directory's
+    # own files and the aggregates of its subdirectories.
+    #
+    # The index does NOT allow to skip descending into subtrees whose directory mtime did not change: directory
+    # mtimes only change when entries are added, removed or renamed, not when a file inside is modified in place.
+    # The index is used to report where things changed and to keep the database writes proportional to the changes.
+    def __init__(self, conn:sqlite3.Connection, backup_dir_id:int):
+        self.conn = conn
+        self.backup_dir_id = backup_dir_id
+
+    def load(self) -> dict[str, tuple[int, int, str]]:
+        rows = self.conn.execute("SELECT path, mtime_ns, n_entries, digest FROM fastscan_index WHERE backup_dir_id=?", (self.backup_dir_id,)).fetchall()
+        return {r[0]: (r[1], r[2], r[3]) for r in rows}
+
+    def update(self, path, workers=1, iexclude=None, records=None) -> tuple[str, list[str]]:
+        """
+        Scans path (unless the result of FastScan.scan_tree is passed in), updates the index and returns the prescan
+        fingerprint together with the list of the deepest directories that changed since the previous scan (new, modified or removed).
+        """
+        if records is None:
+            records = FastScan.scan_tree(path, workers, iexclude)
+        aggregates = FastScan.merkle_aggregates(records)
+        old = self.load()
+
+        changed = set()
+        upserts = []
+        for rel_dir, agg in aggregates.items():
+            rec = records[rel_dir]
+            row = (rec.mtime_ns, rec.n_entries, agg)
+            if old.get(rel_dir) != row:
+                upserts.append((self.backup_dir_id, rel_dir, *row))
+                if old.get(rel_dir, (None, None, None))[2] != agg:
+                    changed.add(rel_dir)
+        removed = [rel_dir for rel_dir in old if rel_dir not in aggregates]
+        changed.update(removed)
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO fastscan_index (backup_dir_id, path, mtime_ns, n_entries, digest) VALUES (?, ?, ?, ?, ?)", upserts)
+            self.conn.executemany("DELETE FROM fastscan_index WHERE backup_dir_id=? AND path=?", [(self.backup_dir_id, r) for r in removed])
+        logging.debug(f"fastscan index for {path}: {len(upserts)} rows updated, {len(removed)} removed")
+
+        # A changed aggregate propagates up to the root, so only report the deepest changed directories.
+        parents = set()
+        for rel_dir in changed:
+            while rel_dir:
+                rel_dir = rel_dir.rpartition('/')[0]
+                if rel_dir in parents:
+                    break
+                parents.add(rel_dir)
+        leaves = sorted(d for d in changed if d not in parents)
+        return FastScan.fingerprint(records), leaves
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM fastscan_index WHERE backup_dir_id=?", (self.backup_dir_id,))
+
+
+class PrescanCheckpoint:
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS prescan_checkpoint (backup_dir_id INTEGER, path TEXT, mtime_ns INTEGER, n_entries INTEGER, digest TEXT, "
+              "subdirs TEXT, scope TEXT, saved_at REAL, PRIMARY KEY (backup_dir_id, path))")
+
+    # Directories scanned before the checkpoint may have changed in the meantime. Such changes are picked up by
+    # the next prescan, but don't resume from checkpoints that are too old to keep that delay bounded.
+    MAX_AGE = 6 * 3600
+
+    # Progress of an interrupted budgeted prescan: the DirRecords of all directories scanned so far.
+    def __init__(self, conn:sqlite3.Connection, backup_dir_id:int, path, iexclude):
+        self.conn = conn
+        self.backup_dir_id = backup_dir_id
+        self.scope = hashlib.sha256(f"{path}\0{iexclude or ''}".encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+        self._saved = set()
+
+    def load(self) -> dict[str, DirRecord]:
+        rows = self.conn.execute("SELECT path, mtime_ns, n_entries, digest, subdirs, scope, saved_at FROM prescan_checkpoint WHERE backup_dir_id=?", (self.backup_dir_id,)).fetchall()
+        if not rows:
+            return {}
+        if any(r[5] != self.scope for r in rows) or min(r[6] for r in rows) < time.time() - self.MAX_AGE:
+            self.clear()
+            return {}
+        records = {r[0]: DirRecord(r[3], r[1], r[2], [(name, mtime_ns, None) for name, mtime_ns in json.loads(r[4])]) for r in rows}
+        self._saved = set(records)
+        return records
+
+    def save(self, records:dict[str, DirRecord]):
+        now = time.time()
+        rows = [(self.backup_dir_id, rel_dir, rec.mtime_ns, rec.n_entries, rec.digest, json.dumps([[s[0], s[1]] for s in rec.subdirs]), self.scope, now)
+                for rel_dir, rec in list(records.items()) if rel_dir not in self._saved]
+        if not rows:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO prescan_checkpoint (backup_dir_id, path, mtime_ns, n_entries, digest, subdirs, scope, saved_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._saved.update(r[1] for r in rows)
+        logging.debug(f"prescan checkpoint: {len(self._saved)} folders")
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM prescan_checkpoint WHERE backup_dir_id=?", (self.backup_dir_id,))
+        self._saved = set()
@@ -0,0 +1,67 @@
+# encoding: utf-8
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from piabackup.fast_scan import FastScan
+from piabackup.scan_snapshot import ScanSnapshot
+
+
+def _scan_job(roots:dict, workers, with_records, with_files):
+    # Runs in a pool process. Only imports modules that don't depend on piabackup.common.
+    t0 = time.monotonic()
+    if len(roots) == 1:
+        key, (path, iexclude) = next(iter(roots.items()))
+        results = {key: FastScan.scan_tree(path, workers, iexclude, with_files)}
+    else:
+        results = FastScan.scan_roots(roots, workers, with_files)
+
+    scan_sec = time.monotonic() - t0
+    total_dirs = sum(len(r) for r in results.values())
+    out = {}
+    for key, records in results.items():
+        snapshot = ScanSnapshot.from_records(records) if with_files else None
+        fp = FastScan.fingerprint(records)
+        if with_records:
+            # the exclusion filter states are only needed during the walk
+            for rec in records.values():
+                rec.subdirs = [(name, mtime_ns, None) for name, mtime_ns, _ in rec.subdirs]
+        out[key] = (fp, records if with_records else None, snapshot, scan_sec * len(records) / max(1, total_dirs))
+    return out
+
+
+class FastScanPool:
+    """
+    Runs prescans in worker processes so that the GIL of the app process stays free for the UI. A job returns
+    (fingerprint, records, snapshot, share of the scan duration) per root. records and snapshot are only transferred
+    when asked for, since unpickling them costs time on the app side too.
+    """
+    _lock = threading.Lock()
+    _executor:ProcessPoolExecutor|None = None
+    _size = 0
+
+    @staticmethod
+    def _get(size) -> ProcessPoolExecutor:
+        with FastScanPool._lock:
+            if FastScanPool._executor is not None and FastScanPool._size != size:
+                FastScanPool._executor.shutdown(wait=False, cancel_futures=True)
+                FastScanPool._executor = None
+            if FastScanPool._executor is None:
+                FastScanPool._executor = ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context("spawn"))
+                FastScanPool._size = size
+                logging.info(f"Started prescan process pool with {size} processes")
+            return FastScanPool._executor
+
+    @staticmethod
+    def submit(size, roots:dict, workers=1, with_records=False, with_files=False) -> Future:
+        """ roots maps a key to (path, iexclude) like FastScan.scan_roots, the future's result maps each key to the tuple described above. """
+        return FastScanPool._get(size).submit(_scan_job, roots, workers, with_records, with_files)
+
+    @staticmethod
+    def shutdown():
+        with FastScanPool._lock:
+            if FastScanPool._executor is not None:
+                FastScanPool._executor.shutdown(wait=False, cancel_futures=True)
+                FastScanPool._executor = None
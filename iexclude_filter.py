@@ -0,0 +1,122 @@
+# encoding: utf-8
+import fnmatch
+import os
+import re
+from pathlib import Path
+
+
+class IExcludeFilter:
+    """
+    Matches paths against the exclusion lines of a BackupDir with the semantics restic applies to
+    the file written by common.handle_iexclude_file and passed via --iexclude-file:
+    - every line is anchored at the backup root and cleaned like filepath.Clean (a trailing '/' does
+      not restrict the pattern to directories),
+    - components are matched case-insensitively with '*', '?' and '[...]', '**' matches any number
+      of components,
+    - a pattern matching a directory excludes everything below it.
+
+    The filter keeps its state per directory, so a tree walk only pays for the patterns that can still
+    match below the current directory. Lines starting with '!' (negated patterns) may re-include paths
+    below excluded directories, which we don't emulate: if there are any, the filter excludes nothing.
+    """
+    DOUBLE_STAR = "**"
+
+    def __init__(self, iexclude:str|None, backup_path):
+        self.patterns:list[list] = []
+        self.enabled = True
+        self.backup_path = str(backup_path)
+        self.root_parts = self._split(Path(backup_path).as_posix())
+
+        for line in (iexclude or "").splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('!'):
+                self.enabled = False
+                continue
+            abs_pattern = Path(backup_path).joinpath(line.lstrip('/\\')).as_posix()
+            self.patterns.append([self._compile(p) for p in self._split(abs_pattern)])
+
+        if not self.enabled:
+            self.patterns = []
+
+        state = self._closure({(p, 0) for p in range(len(self.patterns))})
+        for part in self.root_parts:
+            _, state = self.child(state, part)
+        self._root_state = state
+
+    @staticmethod
+    def _split(path:str) -> list[str]:
+        parts = []
+        for p in path.replace('\\', '/').split('/'):
+            if p in ('', '.'):
+                continue
+            if p == '..':
+                if parts:
+                    parts.pop()
+                continue
+            parts.append(p.lower())
+        return parts
+
+    @staticmethod
+    def _compile(part:str):
+        if part == IExcludeFilter.DOUBLE_STAR:
+            return IExcludeFilter.DOUBLE_STAR
+        if not any(c in part for c in '*?['):
+            return part
+        return re.compile(fnmatch.translate(part.replace('[^', '[!')))
+
+    def _closure(self, states) -> frozenset:
+        # '**' may also match zero components
+        todo = list(states)
+        result = set(states)
+        while todo:
+            p, i = todo.pop()
+            pat = self.patterns[p]
+            if i < len(pat) and pat[i] is self.DOUBLE_STAR and (p, i + 1) not in result:
+                result.add((p, i + 1))
+                todo.append((p, i + 1))
+        return frozenset(result)
+
+    def root_state(self) -> frozenset:
+        return self._root_state
+
+    def child(self, state:frozenset, name:str) -> tuple[bool, frozenset]:
+        """ Returns whether the entry called name inside a directory with the given state is excluded, and the entry's state. """
+        if not state:
+            return False, state
+        name = name.lower()
+        nxt = set()
+        for p, i in state:
+            pat = self.patterns[p]
+            if i >= len(pat):
+                continue
+            comp = pat[i]
+            if comp is self.DOUBLE_STAR:
+                nxt.add((p, i))
+            elif comp == name if isinstance(comp, str) else comp.match(name):
+                nxt.add((p, i + 1))
+        nxt = self._closure(nxt)
+        for p, i in nxt:
+            if i == len(self.patterns[p]):
+                return True, frozenset()
+        return False, nxt
+
+    def is_excluded(self, path) -> bool:
+        """ Checks a path below the backup root including all its parent directories. """
+        state = self._root_state
+        if not state:
+            return False
+        try:
+            rel = os.path.relpath(path, self.backup_path)
+        except ValueError:
+            return False
+        if rel == '..' or rel.startswith('..' + os.sep):
+            return False
+        for part in self._split(rel):
+            excluded, state = self.child(state, part)
+            if excluded:
+                return True
+            if not state:
+                return False
+        return False
@@ -0,0 +1,286 @@
+# encoding: utf-8
+import datetime
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from array import array
+
+
+class LsListing:
+    """
+    Contents of a snapshot as reported by restic ls, in columns: parent node index, index into a table of
+    interned names, type, size and mtime_ns. The nodes keep restic's order, so parents come before their children.
+    Listings loaded from the cache are memory mapped and only decoded where they get accessed.
+    """
+    MAGIC = b"PIALS001"
+    HEADER = struct.Struct("<8sQQQ")  # magic, nodes, names, length of the names blob
+    FILE, DIR, SYMLINK, OTHER = range(4)
+    TYPES = {"file": FILE, "dir": DIR, "symlink": SYMLINK}
+
+    _MTIME_RX = re.compile(r"^(.*T\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$")
+
+    def __init__(self, sizes=None, mtimes_ns=None, name_offsets=None, parents=None, names=None, types=None, names_blob=b"", mm=None):
+        self.sizes = sizes if sizes is not None else array('q')
+        self.mtimes_ns = mtimes_ns if mtimes_ns is not None else array('q')
+        self.name_offsets = name_offsets if name_offsets is not None else array('Q', [0])  # name k is names_blob[name_offsets[k]:name_offsets[k+1]]
+        self.parents = parents if parents is not None else array('i')      # -1 for nodes directly below the root
+        self.names = names if names is not None else array('I')
+        self.types = types if types is not None else array('B')
+        self.names_blob = names_blob
+        self._mm = mm
+
+    def __len__(self):
+        return len(self.parents)
+
+    @staticmethod
+    def parse_mtime(s:str|None) -> int:
+        """ restic's RFC 3339 timestamps carry nanoseconds, more than datetime can hold. """
+        m = LsListing._MTIME_RX.match(s or "")
+        if not m:
+            return 0
+        base, frac, tz = m.groups()
+        if not tz or tz == "Z":
+            tz = "+00:00"
+        try:
+            sec = int(datetime.datetime.fromisoformat(base + tz).timestamp())
+        except ValueError:
+            return 0
+        return sec * 1_000_000_000 + int((frac or "0")[:9].ljust(9, "0"))
+
+    @staticmethod
+    def from_nodes(nodes) -> 'LsListing':
+        """ Builds the listing from the node messages of 'restic ls --json' without keeping them. """
+        listing = LsListing()
+        name_ids = {}
+        dir_ids = {}
+        blob = bytearray()
+        for node in nodes:
+            path = node.get("path")
+            if not path:
+                continue
+            parent_path, _, name = path.rpartition("/")
+            parent = dir_ids.get(parent_path, -1)
+            if parent < 0 and parent_path:
+                # parent not listed, keep the full path as name
+                name = path.lstrip("/")
+            name_id = name_ids.get(name)
+            if name_id is None:
+                name_id = name_ids[name] = len(name_ids)
+                blob += name.encode('utf-8', 'surrogatepass')
+                listing.name_offsets.append(len(blob))
+            node_type = LsListing.TYPES.get(node.get("type"), LsListing.OTHER)
+            if node_type == LsListing.DIR:
+                dir_ids[path] = len(listing.parents)
+            listing.parents.append(parent)
+            listing.names.append(name_id)
+            listing.types.append(node_type)
+            listing.sizes.append(node.get("size", 0))
+            listing.mtimes_ns.append(LsListing.parse_mtime(node.get("mtime")))
+        listing.names_blob = bytes(blob)
+        return listing
+
+    def name(self, i) -> str:
+        k = self.names[i]
+        return bytes(self.names_blob[self.name_offsets[k]:self.name_offsets[k + 1]]).decode('utf-8', 'surrogatepass')
+
+    def path(self, i) -> str:
+        parts = []
+        while i >= 0:
+            parts.append(self.name(i))
+            i = self.parents[i]
+        return "/" + "/".join(reversed(parts))
+
+    def is_dir(self, i) -> bool:
+        return self.types[i] == LsListing.DIR
+
+    def sorted_keys(self) -> list:
+        """ (path components, node index) of all nodes, in the order of 'restic diff'. """
+        keys = []
+        dir_keys = {}
+        for i in range(len(self)):
+            parent = self.parents[i]
+            key = (dir_keys[parent] if parent >= 0 else ()) + tuple(self.name(i).split("/"))
+            if self.types[i] == LsListing.DIR:
+                dir_keys[i] = key
+            keys.append((key, i))
+        # restic lists trees depth first with names in order, so this is usually a no-op
+        keys.sort()
+        return keys
+
+    @staticmethod
+    def diff(old:'LsListing', new:'LsListing'):
+        """
+        Compares two listings as sorted streams and yields change messages like 'restic diff --json' does, at file level:
+        '+' added, '-' removed, 'T' type changed, 'M' size or mtime changed. restic ls doesn't report content IDs,
+        so contents that changed without a metadata change ('?') can't be detected here.
+        """
+        def change(listing, i, key, modifier):
+            path = "/" + "/".join(key) + ("/" if listing.types[i] == LsListing.DIR else "")
+            return {"message_type": "change", "path": path, "modifier": modifier}
+
+        a, b = old.sorted_keys(), new.sorted_keys()
+        i = j = 0
+        while i < len(a) and j < len(b):
+            (ka, ia), (kb, ib) = a[i], b[j]
+            if ka == kb:
+                if old.types[ia] != new.types[ib]:
+                    yield change(new, ib, kb, "T")
+                elif new.types[ib] != LsListing.DIR and (old.sizes[ia] != new.sizes[ib] or old.mtimes_ns[ia] != new.mtimes_ns[ib]):
+                    yield change(new, ib, kb, "M")
+                i += 1
+                j += 1
+            elif ka < kb:
+                yield change(old, ia, ka, "-")
+                i += 1
+            else:
+                yield change(new, ib, kb, "+")
+                j += 1
+        for ka, ia in a[i:]:
+            yield change(old, ia, ka, "-")
+        for kb, ib in b[j:]:
+            yield change(new, ib, kb, "+")
+
+    def close(self):
+        if self._mm is not None:
+            mm, view = self._mm
+            for col in self._columns() + (self.names_blob, view):
+                if isinstance(col, memoryview):
+                    col.release()
+            mm.close()
+            self._mm = None
+
+    def _columns(self):
+        return (self.sizes, self.mtimes_ns, self.name_offsets, self.parents, self.names, self.types)
+
+    @staticmethod
+    def load(file) -> 'LsListing|None':
+        try:
+            with open(file, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        view = None
+        cols = []
+        try:
+            magic, n, n_names, blob_len = LsListing.HEADER.unpack_from(mm, 0)
+            if magic != LsListing.MAGIC:
+                raise ValueError("bad magic")
+            view = memoryview(mm)
+            pos = LsListing.HEADER.size
+            # 8 byte columns first, so every column stays aligned
+            for typecode, count in (('q', n), ('q', n), ('Q', n_names + 1), ('i', n), ('I', n), ('B', n)):
+                size = array(typecode).itemsize * count
+                if pos + size > len(mm):
+                    raise ValueError("truncated")
+                if sys.byteorder == 'little':
+                    cols.append(view[pos:pos + size].cast(typecode))
+                else:
+                    col = array(typecode, view[pos:pos + size].tobytes())
+                    col.byteswap()
+                    cols.append(col)
+                pos += size
+            if pos + blob_len > len(mm):
+                raise ValueError("truncated")
+            names_blob = view[pos:pos + blob_len]
+            return LsListing(*cols, names_blob, (mm, view))
+        except (ValueError, TypeError, struct.error):
+            # the map can only be closed once no view holds it
+            for col in cols:
+                if isinstance(col, memoryview):
+                    col.release()
+            if view is not None:
+                view.release()
+            mm.close()
+            return None
+
+    def save(self, file):
+        directory = os.path.dirname(file)
+        os.makedirs(directory, exist_ok=True)
+        # a temp file of its own, two threads may cache the same snapshot at once
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(LsListing.HEADER.pack(LsListing.MAGIC, len(self), len(self.name_offsets) - 1, len(self.names_blob)))
+                for col in self._columns():
+                    if sys.byteorder != 'little':
+                        col = array(col.typecode, col)
+                        col.byteswap()
+                    f.write(bytes(col))
+                f.write(self.names_blob)
+            os.replace(tmp, file)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+
+class LsCache:
+    """
+    Snapshot listings on disk, one file per snapshot ID. Snapshots never change, so an entry stays valid until
+    the snapshot is forgotten. The least recently used entries get removed when the total size exceeds max_bytes.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _file(self, snap_id):
+        return os.path.join(self.directory, f"{snap_id}.ls")
+
+    def get(self, snap_id) -> LsListing|None:
+        file = self._file(snap_id)
+        listing = LsListing.load(file)
+        if listing is not None:
+            try:
+                # the file mtime is the LRU clock
+                os.utime(file)
+            except OSError:
+                pass
+        return listing
+
+    def put(self, snap_id, listing:LsListing):
+        try:
+            listing.save(self._file(snap_id))
+        except OSError as e:
+            logging.error(f"Failed to cache listing of snapshot {snap_id}: {e}")
+            return
+        self.evict()
+
+    def drop(self, snap_ids):
+        for snap_id in snap_ids:
+            try:
+                os.unlink(self._file(snap_id))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # still mapped by a listing in use
+                logging.debug(f"Failed to drop cached listing of {snap_id}: {e}")
+
+    def evict(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith(".ls")]
+        except OSError:
+            return
+        stats = []
+        for e in entries:
+            try:
+                st = e.stat()
+            except OSError:
+                # removed meanwhile by another thread
+                continue
+            stats.append((st.st_mtime, st.st_size, e.path))
+        entries = stats
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,72 @@
+# encoding: utf-8
+import json
+import sqlite3
+
+
+class PrescanStats:
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS prescan_stats (backup_dir_id INTEGER PRIMARY KEY, scan_sec REAL, scan_samples INTEGER, "
+              "backup_sec REAL, backup_samples INTEGER, unchanged_sec REAL, unchanged_samples INTEGER, probe_at REAL)")
+
+    ALPHA = 0.3          # weight of the newest sample in the moving averages
+    MIN_SAMPLES = 5
+    DISABLE_RATIO = 1.0  # disable when the prescan takes at least as long as a restic run that finds nothing to do
+    ENABLE_RATIO = 0.5   # re-enable only when it got clearly cheaper again, so the decision doesn't flap
+
+    # Moving averages of the prescan duration and of restic's 'total_duration' per backup dir. A restic run that finds
+    # no new or changed files is what --skip-if-unchanged costs without a prescan, so that is what the prescan
+    # has to beat. As long as there is no such sample, any backup duration serves as (upper bound) reference.
+    def __init__(self, conn:sqlite3.Connection, backup_dir_id:int):
+        self.backup_dir_id = backup_dir_id
+        row = conn.execute("SELECT scan_sec, scan_samples, backup_sec, backup_samples, unchanged_sec, unchanged_samples, probe_at FROM prescan_stats WHERE backup_dir_id=?",
+                           (backup_dir_id,)).fetchone()
+        (self.scan_sec, self.scan_samples, self.backup_sec, self.backup_samples,
+         self.unchanged_sec, self.unchanged_samples, self.probe_at) = row if row else (0.0, 0, 0.0, 0, 0.0, 0, 0.0)
+
+    @staticmethod
+    def _ewma(avg, n, sample):
+        return sample if n == 0 else avg + PrescanStats.ALPHA * (sample - avg)
+
+    def add_scan(self, sec, restart=False):
+        if restart:
+            # a probe after the prescan was disabled, the old samples may be outdated
+            self.scan_samples = 0
+        self.scan_sec = self._ewma(self.scan_sec, self.scan_samples, sec)
+        self.scan_samples += 1
+
+    def add_backup(self, summary:str|None):
+        if not summary:
+            return
+        js = json.loads(summary)
+        sec = float(js.get('total_duration', 0.0))
+        if sec <= 0:
+            return
+        self.backup_sec = self._ewma(self.backup_sec, self.backup_samples, sec)
+        self.backup_samples += 1
+        if js.get('files_new', 0) == 0 and js.get('files_changed', 0) == 0:
+            self.unchanged_sec = self._ewma(self.unchanged_sec, self.unchanged_samples, sec)
+            self.unchanged_samples += 1
+
+    def reference_sec(self) -> float|None:
+        if self.unchanged_samples:
+            return self.unchanged_sec
+        if self.backup_samples:
+            return self.backup_sec
+        return None
+
+    def should_disable(self) -> bool:
+        ref = self.reference_sec()
+        return ref is not None and self.scan_samples >= self.MIN_SAMPLES and self.scan_sec >= ref * self.DISABLE_RATIO
+
+    def should_enable(self) -> bool:
+        ref = self.reference_sec()
+        return ref is None or self.scan_sec < ref * self.ENABLE_RATIO
+
+    def probe_due(self, now) -> bool:
+        return now >= self.probe_at
+
+    def save(self, conn:sqlite3.Connection):
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO prescan_stats (backup_dir_id, scan_sec, scan_samples, backup_sec, backup_samples, unchanged_sec, unchanged_samples, probe_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (self.backup_dir_id, self.scan_sec, self.scan_samples, self.backup_sec, self.backup_samples,
+                          self.unchanged_sec, self.unchanged_samples, self.probe_at))
@@ -0,0 +1,192 @@
+# encoding: utf-8
+import logging
+import os
+import secrets
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+class RcloneServer:
+    """
+    A long running 'rclone serve restic' on localhost for rclone: repositories. Without it every restic call
+    starts its own rclone process that logs in to the remote and lists it again. restic reaches the server as
+    rest: backend, with random credentials so other local users can't use it.
+    A background thread starts, checks and restarts the server, apply() only uses what it published and never
+    waits for rclone, it's called on the UI thread.
+    """
+    ORIGIN_ENV = "PIABACKUP_RCLONE_REPOSITORY"  # the configured rclone: repository, rest: URLs change with the port
+    STARTUP_TIMEOUT = 10
+    HEALTH_IVAL = 15  # seconds between health checks
+
+    _lock = threading.Lock()
+    _wake = threading.Event()
+    _thread:threading.Thread|None = None
+    _wanted:str|None = None  # the remote the thread serves, None stops the server
+    # published by the thread, a restart for the same remote keeps URL and credentials so running restic calls reconnect
+    _remote:str|None = None
+    _url:str|None = None
+    _user = ""
+    _password = ""
+    _ready = False
+    # the process, only touched with _proc_lock held
+    _proc_lock = threading.Lock()
+    _proc:subprocess.Popen|None = None
+    _port = 0
+
+    @staticmethod
+    def request(env:dict, enabled:bool):
+        """ Starts or stops the server in the background for the repository in env. """
+        repo = env.get("RESTIC_REPOSITORY", "")
+        remote = repo[len("rclone:"):] if enabled and repo.startswith("rclone:") else None
+        with RcloneServer._lock:
+            if remote == RcloneServer._wanted:
+                return
+            RcloneServer._wanted = remote
+            if RcloneServer._thread is None:
+                RcloneServer._thread = threading.Thread(target=RcloneServer._run, daemon=True, name="RcloneServer")
+                RcloneServer._thread.start()
+        RcloneServer._wake.set()
+
+    @staticmethod
+    def apply(env:dict, enabled:bool):
+        """ Points restic at the server if the repository in env is an rclone: one. Falls back to restic's own rclone. """
+        RcloneServer.request(env, enabled)
+        repo = env.get("RESTIC_REPOSITORY", "")
+        if not enabled or not repo.startswith("rclone:"):
+            return
+        with RcloneServer._lock:
+            if not RcloneServer._ready or RcloneServer._remote != repo[len("rclone:"):]:
+                logging.info("rclone server not ready, restic starts rclone itself")
+                return
+            env[RcloneServer.ORIGIN_ENV] = repo
+            env["RESTIC_REPOSITORY"] = "rest:" + RcloneServer._url
+            env["RESTIC_REST_USERNAME"] = RcloneServer._user
+            env["RESTIC_REST_PASSWORD"] = RcloneServer._password
+
+    @staticmethod
+    def _run():
+        while True:
+            RcloneServer._wake.wait(RcloneServer.HEALTH_IVAL)
+            RcloneServer._wake.clear()
+            try:
+                with RcloneServer._proc_lock:
+                    with RcloneServer._lock:
+                        remote = RcloneServer._wanted
+                    if remote is None:
+                        RcloneServer._stop()
+                    elif RcloneServer._remote != remote or not RcloneServer._healthy():
+                        RcloneServer._stop()
+                        RcloneServer._start(remote)
+            except Exception as e:
+                logging.exception(f"rclone server error: {e}")
+
+    @staticmethod
+    def _healthy() -> bool:
+        if RcloneServer._proc is None or RcloneServer._proc.poll() is not None:
+            return False
+        if not RcloneServer._ping(5):
+            logging.warning("rclone server stopped responding")
+            return False
+        return True
+
+    @staticmethod
+    def _ping(timeout) -> bool:
+        # without credentials the server answers 401 right away, a liveness check that doesn't touch the remote
+        try:
+            with urllib.request.urlopen(RcloneServer._url, timeout=timeout):
+                return True
+        except urllib.error.HTTPError:
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _free_port(port=0) -> int:
+        """ port if it can be bound, otherwise any free one. """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.bind(("127.0.0.1", port))
+            except OSError:
+                s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    @staticmethod
+    def _start(remote):
+        if remote == RcloneServer._remote and RcloneServer._port:
+            port = RcloneServer._free_port(RcloneServer._port)
+        else:
+            port = RcloneServer._free_port()
+        if remote != RcloneServer._remote or port != RcloneServer._port:
+            with RcloneServer._lock:
+                RcloneServer._remote = remote
+                RcloneServer._url = f"http://127.0.0.1:{port}/"
+                RcloneServer._user = secrets.token_hex(8)
+                RcloneServer._password = secrets.token_hex(16)
+            RcloneServer._port = port
+        # --b2-hard-delete is what restic passes to the rclone it starts itself
+        cmd = ["rclone", "serve", "restic", remote, "--addr", f"127.0.0.1:{port}", "--b2-hard-delete"]
+        # the credentials go through the environment, the command line is visible to all local users
+        env = dict(os.environ)
+        env["RCLONE_USER"] = RcloneServer._user
+        env["RCLONE_PASS"] = RcloneServer._password
+        logging.info(f"starting rclone server for {remote} on port {port}")
+
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        try:
+            RcloneServer._proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                                  text=True, env=env, startupinfo=startupinfo)
+        except OSError as e:
+            logging.error(f"failed to start rclone: {e}")
+            return
+        threading.Thread(target=RcloneServer._log_output, args=(RcloneServer._proc,), daemon=True, name="RcloneServerLog").start()
+
+        deadline = time.time() + RcloneServer.STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if RcloneServer._proc.poll() is not None:
+                logging.error(f"rclone server exited with code {RcloneServer._proc.returncode}")
+                break
+            if RcloneServer._ping(1):
+                with RcloneServer._lock:
+                    RcloneServer._ready = True
+                logging.info("rclone server ready")
+                return
+            time.sleep(0.1)
+        RcloneServer._stop()
+
+    @staticmethod
+    def _log_output(proc:subprocess.Popen):
+        for line in proc.stderr:
+            logging.info(f"rclone: {line.rstrip()}")
+
+    @staticmethod
+    def _stop():
+        with RcloneServer._lock:
+            RcloneServer._ready = False
+        proc = RcloneServer._proc
+        RcloneServer._proc = None
+        if proc is None or proc.poll() is not None:
+            return
+        logging.info("stopping rclone server")
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    @staticmethod
+    def pid() -> int|None:
+        proc = RcloneServer._proc
+        return proc.pid if proc is not None and proc.poll() is None else None
+
+    @staticmethod
+    def stop():
+        """ Stops the server and waits for it, for the app exit. """
+        with RcloneServer._lock:
+            RcloneServer._wanted = None
+        with RcloneServer._proc_lock:
+            RcloneServer._stop()
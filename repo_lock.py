@@ -0,0 +1,52 @@
+# encoding: utf-8
+import threading
+from contextlib import contextmanager
+
+
+class RepoLock:
+    """
+    In-process counterpart of restic's repository locks. Backups take restic's non-exclusive lock and may run
+    side by side, forget --prune, check, unlock and tag need the repository alone, so they wait until all shared
+    holders are done. New shared holders wait for queued exclusive ones so those don't starve, except threads that
+    already hold a share: the exclusive waiter waits for them anyway.
+    """
+    _cond = threading.Condition()
+    _shared = 0
+    _exclusive = False
+    _exclusive_waiting = 0
+    _local = threading.local()  # shares held by the current thread
+
+    @staticmethod
+    @contextmanager
+    def shared():
+        depth = getattr(RepoLock._local, "depth", 0)
+        with RepoLock._cond:
+            while RepoLock._exclusive or (RepoLock._exclusive_waiting and depth == 0):
+                RepoLock._cond.wait()
+            RepoLock._shared += 1
+        RepoLock._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            RepoLock._local.depth = depth
+            with RepoLock._cond:
+                RepoLock._shared -= 1
+                RepoLock._cond.notify_all()
+
+    @staticmethod
+    @contextmanager
+    def exclusive():
+        with RepoLock._cond:
+            RepoLock._exclusive_waiting += 1
+            try:
+                while RepoLock._exclusive or RepoLock._shared:
+                    RepoLock._cond.wait()
+            finally:
+                RepoLock._exclusive_waiting -= 1
+            RepoLock._exclusive = True
+        try:
+            yield
+        finally:
+            with RepoLock._cond:
+                RepoLock._exclusive = False
+                RepoLock._cond.notify_all()
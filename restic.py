@@ -1,129 +1,202 @@
 # encoding: utf-8
+import collections
+import concurrent.futures
 import contextlib
-import datetime
+import itertools
 import json
 import logging
 import os
 import re
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
 
 import piabackup.common as common
 import ui.tools
+from piabackup.backup_rules import BackupRules
 from piabackup.config import Config
+from piabackup.db import DB
+from piabackup.ls_cache import LsCache, LsListing
+from piabackup.repo_lock import RepoLock
+from piabackup.snapshot_catalog import SnapshotCatalog
+
+
+class ResticOutput:
+    """
+    Runs a restic command and hands out its output line by line while it runs, so large ls, diff or restore outputs
+    are never held in memory as a whole. stderr is drained by a thread to keep the process from blocking on a full pipe.
+    """
+    def __init__(self, cmd, env, encoding=None):
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
+        self.p = subprocess.Popen(cmd, text=True, encoding=encoding, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo, bufsize=1)
+        self.stderr_lines = []
+        self.returncode = None
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
 
+    def _drain_stderr(self):
+        for line in self.p.stderr: # type: ignore
+            self.stderr_lines.append(line.rstrip("\r\n"))
 
-class Restic:
-    def __init__(self):
-        self.backup_default_cmd = ["restic",
-                    "backup",
-                    #"--files-from", str(rootsfn.absolute()),
-                    #"--iexclude-file", str(excludesfn.absolute()),
-                    "--compression", "max",
-                    "--no-scan",
-                    "--skip-if-unchanged",
-                    #"--read-concurrency", "2", # makes it slower
-                    ]
-        if common.IS_ADMIN:
-            self.backup_default_cmd.append("--use-fs-snapshot")
+    @staticmethod
+    def parse(line:str):
+        """ The parsed JSON message or None for lines that aren't JSON. """
+        if line.startswith("{") or line.startswith("["):
+            try:
+                return json.loads(line)
+            except json.JSONDecodeError:
+                return None
+        return None
+
+    def messages(self):
+        """ Yields (line, parsed JSON or None) for each stdout line. """
+        for line in self.p.stdout: # type: ignore
+            line = line.rstrip("\r\n")
+            yield line, self.parse(line)
+
+    def stderr_messages(self):
+        """ Like messages() for stderr, available once stdout is consumed. """
+        self._stderr_thread.join()
+        for line in self.stderr_lines:
+            yield line, self.parse(line)
+
+    @property
+    def stderr(self) -> str:
+        self._stderr_thread.join()
+        return "\n".join(self.stderr_lines)
+
+    def kill(self):
+        if self.p.poll() is None:
+            self.p.kill()
+
+    def wait(self) -> int:
+        if self.returncode is None:
+            self._stderr_thread.join()
+            self.returncode = self.p.wait()
+        return self.returncode
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # the caller stopped reading early, don't leave restic running
+        self.kill()
+        self.p.stdout.close() # type: ignore
+        self.wait()
+        return False
 
-    def list_snapshots(self, cfg:Config, env, tag, latest_n=None) -> list:
-        if tag is None:
-            raise Exception("tag param is required for listing snapshots")
-        cmd = ["restic",
-                "snapshots",
-                "--json",
-                "--tag", tag,
-                ]
-        if latest_n is not None and int(latest_n) > 0:
-            cmd.extend(["--latest", str(latest_n)])
-        if cfg.no_lock:
-            cmd.append("--no-lock")
+
+class Restic:
+    def _run_json(self, cmd, env):
         logging.info(f"running: {' '.join(cmd)}")
-        
+
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        rc = p.wait()
+        # reads hold a share, so an in-process prune or cache cleanup doesn't remove packs from under them
+        with RepoLock.shared():
+            p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
+            stdout, stderr = p.communicate()
+            rc = p.wait()
         if rc != 0:
             raise Exception(f"cmd failed: rc = {rc}, stderr = {stderr}")
         if ui.tools.IS_DEBUGGER_PRESENT:
             logging.debug(stdout)
-        js = json.loads(stdout.splitlines()[0])
-        if ui.tools.IS_DEBUGGER_PRESENT:
-            logging.debug(json.dumps(js, indent=4))
-        logging.info("successful")
-        for s in js:
-            s['_time'] = datetime.datetime.fromisoformat(s['time']).timestamp()
-        #js.sort(key=lambda x: x['_time'])
-        for i in range(0,len(js)-1):
-            if js[i]['_time'] > js[i+1]['_time']:
-                raise Exception(f"snapshot times are not in ascending order")
-        return js
+        return stdout
+
+    def list_snapshot_ids(self, env, no_lock=False) -> list[str]:
+        cmd = ["restic", "list", "snapshots"]
+        if no_lock:
+            cmd.append("--no-lock")
+        return [l.strip() for l in self._run_json(cmd, env).splitlines() if l.strip()]
+
+    def fetch_snapshots(self, env, snap_ids:list[str]|None=None, no_lock=False) -> list:
+        cmd = ["restic", "snapshots", "--json"]
+        if no_lock:
+            cmd.append("--no-lock")
+        if snap_ids:
+            cmd.extend(snap_ids)
+        return json.loads(self._run_json(cmd, env).splitlines()[0])
+
+    def snapshot_catalog(self, conn, env, no_lock=False) -> SnapshotCatalog:
+        catalog = SnapshotCatalog(conn, env)
+        removed = catalog.sync(self, no_lock)
+        if removed:
+            LsCache(common.LS_CACHE_DIR, 0).drop(removed)
+        return catalog
+
+    @staticmethod
+    def catalog_changed():
+        with contextlib.closing(DB.connect()) as conn:
+            SnapshotCatalog.invalidate(conn)
+
+    def list_snapshots(self, cfg:Config, env, tag, latest_n=None) -> list:
+        if tag is None:
+            raise Exception("tag param is required for listing snapshots")
+        with contextlib.closing(DB.connect()) as conn:
+            return self.snapshot_catalog(conn, env, cfg.no_lock).snapshots(tag, latest_n)
 
     def tag_snapshot(self, env, snap_id, tag, remove=False, no_lock=False):
         if snap_id is None or not isinstance(snap_id, str) or len(snap_id) == 0:
             raise Exception("snap_id param is required for tagging")
+        self.tag_snapshots(env, [snap_id], tag, remove, no_lock)
+
+    def tag_snapshots(self, env, snap_ids:list[str], tag, remove=False, no_lock=False):
+        """ Adds the tag to or removes it from all given snapshots, with one restic call per batch of IDs. """
+        if any(not isinstance(i, str) or len(i) == 0 for i in snap_ids):
+            raise Exception("snapshot IDs must not be empty")
         if tag is None or not isinstance(tag, str) or len(tag) == 0:
             raise Exception("tag param is required for tagging")
-        
-        cmd = ["restic", "tag", snap_id]
-        if remove:
-            cmd.extend(["--remove", tag])
-        else:
-            cmd.extend(["--add", tag])
-        
-        if no_lock:
-            cmd.append("--no-lock")
-            
-        logging.info(f"running: {' '.join(cmd)}")
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        
-        if p.returncode != 0:
-            raise Exception(f"tag failed: {stderr}")
-        logging.info("tag successful")
+        if not snap_ids:
+            return
+
+        try:
+            for i in range(0, len(snap_ids), SnapshotCatalog.FETCH_BATCH):
+                cmd = ["restic", "tag"] + snap_ids[i:i + SnapshotCatalog.FETCH_BATCH]
+                if remove:
+                    cmd.extend(["--remove", tag])
+                else:
+                    cmd.extend(["--add", tag])
+                
+                if no_lock:
+                    cmd.append("--no-lock")
+                    
+                logging.info(f"running: {' '.join(cmd)}")
+                startupinfo = subprocess.STARTUPINFO()
+                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+                
+                with RepoLock.exclusive():
+                    p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
+                    stdout, stderr = p.communicate()
+                
+                if p.returncode != 0:
+                    raise Exception(f"tag failed: {stderr}")
+        finally:
+            # a failed batch may still have rewritten some snapshots
+            self.catalog_changed()
+        logging.info(f"tag successful ({len(snap_ids)} snapshots)")
 
     def get_all_paths(self, env, no_lock=False) -> set[Path]:
-        cmd = ["restic",
-                "snapshots",
-                "--json",
-                ]
-        if no_lock:
-            cmd.append("--no-lock")
-        logging.info(f"running: {' '.join(cmd)}")
-        
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        rc = p.wait()
-        if rc != 0:
-            raise Exception(f"cmd failed: rc = {rc}, stderr = {stderr}")
-        
-        js = json.loads(stdout)
+        with contextlib.closing(DB.connect()) as conn:
+            snaps = self.snapshot_catalog(conn, env, no_lock).snapshots()
         paths = set()
-        for s in js:
+        for s in snaps:
             if 'paths' in s:
                 for p in s['paths']:
                     paths.add(Path(p))
         return paths
 
-    def check_bitrot(self, cfg:Config, env, tag:str, bitrot_snap:str) -> str:
+    def check_bitrot(self, cfg:Config, env, tag:str, bitrot_snap:str, snaps:list|None=None) -> str:
         if tag is None:
             raise Exception("tag param is required for bitrot check")
         if bitrot_snap is None:
             raise Exception("bitrot_snap param is required for bitrot check")
 
-        snaps = self.list_snapshots(cfg, env, tag)
+        if snaps is None:
+            snaps = self.list_snapshots(cfg, env, tag)
 
         start_index = 1
         for i in range(0,len(snaps)):
@@ -133,34 +206,68 @@ class Restic:
                 break
 
         last_checked_snap = bitrot_snap
-        for i in range(start_index, len(snaps)):
-            prev = snaps[i-1]
-            curr = snaps[i]
+        pairs = [(snaps[i-1], snaps[i]) for i in range(start_index, len(snaps))]
+        workers = max(1, min(cfg.bitrot_workers, len(pairs)))
+        # the diffs are independent, run some ahead but only advance over the checked prefix
+        window = 1 if workers == 1 else workers * 2
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bitrot")
+        pending = collections.deque()
+        # the diffs still running when the check ends early, killed before the caller releases the repository
+        running = set()
+        running_lock = threading.Lock()
+        try:
+            for prev, curr in itertools.islice(pairs, window):
+                pending.append((curr, pool.submit(self._count_bitrot, cfg, env, prev, curr, running, running_lock)))
+            next_pair = len(pending)
+            while pending:
+                curr, fut = pending.popleft()
+                if fut.result() > 0:
+                    # if cmdline_args.check_bitrot_ignore and cmdline_args.check_bitrot_ignore == curr['id']:
+                    #     logging.error(f"bit rot detected but ignoring because of command line argument")
+                    # else:
+                    raise Exception(f"bit rot detected, aborting")
+
+                last_checked_snap = curr['id']
+                if common.shutdown_requested: break
+                if next_pair < len(pairs):
+                    prev, nxt = pairs[next_pair]
+                    pending.append((nxt, pool.submit(self._count_bitrot, cfg, env, prev, nxt, running, running_lock)))
+                    next_pair += 1
+        finally:
+            with running_lock:
+                for out in running:
+                    out.kill()
+                running.add(None)  # diffs that didn't start yet don't start anymore
+            pool.shutdown(wait=True, cancel_futures=True)
 
-            cmd = ["restic",
-                    "diff", prev['id'], curr['id'],
-                    "--json",
-                    ]
-            if cfg.no_lock:
-                cmd.append("--no-lock")
+        logging.info("successful")
+        return last_checked_snap
 
-            logging.info(f"running: {' '.join(cmd)} ({curr['time']})")
-            
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    def _count_bitrot(self, cfg:Config, env, prev, curr, running:set|None=None, running_lock=None) -> int:
+        """
+        Number of files with changed content but unchanged metadata between two snapshots. The running diff is in
+        running while it runs, None in running means the check is over.
+        """
+        if prev.get('tree') and prev['tree'] == curr.get('tree'):
+            # same root tree, so the same contents down to every blob
+            logging.info(f"skipping diff of {prev['short_id']} and {curr['short_id']}, identical trees")
+            return 0
+        cmd = ["restic",
+                "diff", prev['id'], curr['id'],
+                "--json",
+                ]
+        if cfg.no_lock:
+            cmd.append("--no-lock")
 
-            p = subprocess.Popen(cmd, encoding='utf-8', text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-            stdout, stderr = p.communicate()
-            rc = p.wait()
-            if rc != 0:
-                raise Exception(f"cmd failed: rc = {rc}, stderr={stderr}")
-            
+        logging.info(f"running: {' '.join(cmd)} ({curr['time']})")
+
+        n_found = 0
+        # a prune waits for the running diff only, not for the whole check that can take hours
+        with RepoLock.shared(), ResticOutput(cmd, env, 'utf-8') as out, self._tracked(out, running, running_lock):
             li = 0
-            n_found = 0
-            for l in stdout.splitlines():
+            for l, js in out.messages():
                 li = li + 1
-                if l.startswith("{"):
-                    js = json.loads(l)
+                if js is not None:
                     if js['message_type'] == 'statistics':
                         logging.debug(l)
                     # {"message_type":"change","path":"/C/Jts/knkeabmblimgifcdgaicnbbhgdgecimiohobcbll/Tue.trd","modifier":"M"}
@@ -172,79 +279,84 @@ class Restic:
                         raise Exception(f"unexpected line data {l} in line {li}")
                 elif li != 1:
                     raise Exception(f"unexpected line data {l} in line {li}")
-                
-            if n_found > 0:
-                # if cmdline_args.check_bitrot_ignore and cmdline_args.check_bitrot_ignore == curr['id']:
-                #     logging.error(f"bit rot detected but ignoring because of command line argument")
-                # else:
-                raise Exception(f"bit rot detected, aborting")
-            
-            last_checked_snap = curr['id']
-            if common.shutdown_requested: break
-
-        logging.info("successful")
-        return last_checked_snap
-
-    def run_backup_cmd(self, backup_path:Path, env, docheck=False, no_lock=False, iexclude:str|None=None):
+            rc = out.wait()
+            if rc != 0:
+                raise Exception(f"cmd failed: rc = {rc}, stderr={out.stderr}")
+        return n_found
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _tracked(out:ResticOutput, running:set|None, running_lock):
+        if running is None or running_lock is None:
+            yield
+            return
+        with running_lock:
+            if None in running:
+                out.kill()
+                raise Exception("bitrot check ended")
+            running.add(out)
+        try:
+            yield
+        finally:
+            with running_lock:
+                running.discard(out)
+
+    def run_backup_cmd(self, backup_path:Path, env, docheck=False, no_lock=False, iexclude:str|None=None, on_status=None, on_snapshot=None):
+        """
+        on_status gets restic's status messages while the backup runs, on_snapshot gets the summary line as soon as
+        the snapshot exists, while the backup still holds its repository lock.
+        """
         if backup_path is None:
             raise Exception("no backup_path defined")
         if env is None:
             raise Exception("no env param defined")
-        cmd = self.backup_default_cmd.copy()
-        if no_lock:
-            cmd.append("--no-lock")
-        cmd.append("--json")
-        cmd.append("--quiet")
-        if docheck:
-            cmd.append("--force")
-            cmd.append("--no-cache")
-        cmd.extend(["--tag", backup_path.as_posix()])
+        if on_status is not None:
+            env = dict(env)
+            env["RESTIC_PROGRESS_FPS"] = str(common.BACKUP_PROGRESS_FPS)
         
         with common.handle_iexclude_file(iexclude, backup_path) as iexclude_path:
-            if iexclude_path:
-                cmd.extend(["--iexclude-file", iexclude_path])
-
-            cmd.append(str(backup_path))
+            cmd = BackupRules.backup_cmd(["restic"], backup_path, iexclude_path, no_lock=no_lock, docheck=docheck,
+                                         quiet=on_status is None, fs_snapshot=common.IS_ADMIN)
 
             logging.info(f"running: {common.quote_command(cmd)}")
-    
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-    
-            p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-            stdout, stderr = p.communicate()
-            
+
             summary = None
             err = False
-            for l in stdout.splitlines() + stderr.splitlines():
-                if l.startswith("{"):
-                    js = json.loads(l)
-                    if js['message_type'] == 'summary':
-                        logging.info(l)
-                        summary = l
-                    # elif js['message_type'] == 'exit_error':
-                    #     logging.warning(l)
-                    elif js['message_type'] == 'error':
-                        # if js['error']['message'].startswith("incomplete metadata for "):
+            # backups take restic's shared lock, several of them can run at once
+            with RepoLock.shared(), ResticOutput(cmd, env) as out:
+                for l, js in itertools.chain(out.messages(), out.stderr_messages()):
+                    if l.startswith("{"):
+                        if js is not None and js['message_type'] == 'summary':
+                            logging.info(l)
+                            summary = l
+                            if on_snapshot is not None:
+                                on_snapshot(l)
+                        elif js is not None and js['message_type'] == 'status' and on_status is not None:
+                            on_status(js)
+                        # elif js['message_type'] == 'exit_error':
                         #     logging.warning(l)
-                        # this is to 'support' (or rather ignore) the cygin symlinks issue... instead please just don't use them
-                        # elif js['error']['message'].endswith(": unsupported file type \"irregular\""):
-                        #     logging.warning(l)
-                        # elif js['error']['message'].startswith("failed to create snapshot for "):
-                        #     logging.warning(l)
-                        # else:
-                        logging.error(l)
-                        err = True
-                    else:
-                        logging.error(f"unexpected output: {l}")
-                        err = True
-
-            rc = p.wait()
+                        elif js is not None and js['message_type'] == 'error':
+                            # if js['error']['message'].startswith("incomplete metadata for "):
+                            #     logging.warning(l)
+                            # this is to 'support' (or rather ignore) the cygin symlinks issue... instead please just don't use them
+                            # elif js['error']['message'].endswith(": unsupported file type \"irregular\""):
+                            #     logging.warning(l)
+                            # elif js['error']['message'].startswith("failed to create snapshot for "):
+                            #     logging.warning(l)
+                            # else:
+                            logging.error(l)
+                            err = True
+                        else:
+                            logging.error(f"unexpected output: {l}")
+                            err = True
+
+                rc = out.wait()
             #if (rc != 0 and rc != 3) or err:
             if rc or err:
                 raise Exception(f"backup failed: rc = {rc}")
             if summary is None:
                 raise Exception("backup failed: no summary found in output")
+            self.catalog_changed()
             logging.info("backup successful")
             return summary
 
@@ -265,8 +377,9 @@ class Restic:
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
         
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
+        with RepoLock.exclusive():
+            p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
+            stdout, stderr = p.communicate()
         
         rx = re.compile(("error for tree [0-9a-f]+:"
                         "|  tree [0-9a-f]+: node \".*\" with invalid type \"irregular\""
@@ -287,34 +400,45 @@ class Restic:
             raise Exception(f"check failed: rc = {rc}")
         logging.info("check successful")
 
-    def forget_some(self, tag:str, env):
-        if tag is None:
+    def forget_tags(self, tags:list[str], env):
+        """
+        Applies the retention policy to the snapshots of all given tags and prunes the repository once. The caller
+        holds RepoLock.exclusive(), no backup may add a snapshot of the tags between choosing them and the prune.
+        """
+        if not tags or any(not t for t in tags):
             raise Exception("tag param is required for pruning")
-        cmd = ["restic",
-                "forget",
-                "--keep-hourly", "72",
-                "--keep-daily", "72",
-                "--keep-weekly", "72",
-                "--keep-monthly", "72",
-                "--keep-yearly", "72",
-                "--keep-tag", "permanent",
-                "--prune",
-                "--compression", "max",
-                "--tag", tag,
-                ]
-        logging.info(f"running: {' '.join(cmd)}")
-        
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-        p = subprocess.Popen(cmd, text=True, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        rc = p.wait()
-        if rc != 0:
-            logging.info(stdout)
-            logging.info(stderr)
-            raise Exception(f"cmd failed: rc = {rc}")
-        logging.info("successful")
+        # restic groups by host and paths, so each folder keeps its own snapshots as with one call per tag
+        batches = [tags[i:i + SnapshotCatalog.FETCH_BATCH] for i in range(0, len(tags), SnapshotCatalog.FETCH_BATCH)]
+        try:
+            for n, batch in enumerate(batches):
+                cmd = ["restic",
+                        "forget",
+                        "--keep-hourly", "72",
+                        "--keep-daily", "72",
+                        "--keep-weekly", "72",
+                        "--keep-monthly", "72",
+                        "--keep-yearly", "72",
+                        "--keep-tag", "permanent",
+                        ]
+                if n == len(batches) - 1:
+                    cmd.extend(["--prune", "--compression", "max"])
+                for tag in batch:
+                    cmd.extend(["--tag", tag])
+                logging.info(f"running: {' '.join(cmd)}")
+
+                startupinfo = subprocess.STARTUPINFO()
+                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+                p = subprocess.Popen(cmd, text=True, env=env, startupinfo=startupinfo)
+                stdout, stderr = p.communicate()
+                rc = p.wait()
+                if rc != 0:
+                    logging.info(stdout)
+                    logging.info(stderr)
+                    raise Exception(f"cmd failed: rc = {rc}")
+        finally:
+            self.catalog_changed()
+        logging.info(f"successful ({len(tags)} folders)")
 
     def unlock(self, env, remove_all=False):
         cmd = ["restic", "unlock"]
@@ -325,38 +449,55 @@ class Restic:
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
         
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
+        with RepoLock.exclusive():
+            p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
+            stdout, stderr = p.communicate()
         
         if p.returncode != 0:
             raise Exception(f"unlock failed: {stderr}")
         logging.info("unlock successful")
 
-    def ls(self, env, snapshot_id, no_lock=False):
+    def ls_nodes(self, env, snapshot_id, no_lock=False):
+        """ Yields the nodes of the snapshot while restic lists them. """
         cmd = ["restic", "ls", "--json", snapshot_id]
         if no_lock:
             cmd.append("--no-lock")
         
         logging.info(f"running: {' '.join(cmd)}")
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        
-        if p.returncode != 0:
-            raise Exception(f"ls failed: {stderr}")
-            
-        results = []
-        for line in stdout.splitlines():
+        with RepoLock.shared(), ResticOutput(cmd, env) as out:
+            for _, item in out.messages():
+                if isinstance(item, dict) and item.get("struct_type") == "node":
+                    yield item
+            if out.wait() != 0:
+                raise Exception(f"ls failed: {out.stderr}")
+
+    def ls(self, env, snapshot_id, no_lock=False, fields=None):
+        """ The nodes of the snapshot, reduced to the given keys when fields is set. """
+        if fields:
+            return [{k: item[k] for k in fields if k in item} for item in self.ls_nodes(env, snapshot_id, no_lock)]
+        return list(self.ls_nodes(env, snapshot_id, no_lock))
+
+    def ls_listing(self, env, snapshot_id, no_lock=False, cache:LsCache|None=None) -> LsListing:
+        listing = cache.get(snapshot_id) if cache else None
+        if listing is not None:
+            logging.info(f"using cached listing of snapshot {snapshot_id}")
+            return listing
+        listing = LsListing.from_nodes(self.ls_nodes(env, snapshot_id, no_lock))
+        if cache:
+            cache.put(snapshot_id, listing)
+        return listing
+
+    def local_diff(self, env, id1, id2, no_lock=False, cache:LsCache|None=None):
+        """ Yields file level changes between two snapshots, computed from their (cached) listings. See LsListing.diff. """
+        old = self.ls_listing(env, id1, no_lock, cache)
+        try:
+            new = self.ls_listing(env, id2, no_lock, cache)
             try:
-                if not line.startswith("{"): continue
-                item = json.loads(line)
-                if item.get("struct_type") == "node":
-                    results.append(item)
-            except:
-                pass
-        return results
+                yield from LsListing.diff(old, new)
+            finally:
+                new.close()
+        finally:
+            old.close()
 
     def restore(self, env, snapshot_id, target, include=None, no_lock=False):
         cmd = ["restic", "restore", snapshot_id, "--target", str(target), "--json", "--overwrite", "never"]
@@ -366,19 +507,18 @@ class Restic:
             cmd.append("--no-lock")
             
         logging.info(f"running: {' '.join(cmd)}")
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        
-        p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        
+
         summary = None
         errmsgs = []
         err = False
-        for l in stdout.splitlines() + stderr.splitlines():
-            if l.startswith("{"):
-                js = json.loads(l)
-                if js['message_type'] == 'summary':
+        with RepoLock.shared(), ResticOutput(cmd, env) as out:
+            for l, js in itertools.chain(out.messages(), out.stderr_messages()):
+                if not l.startswith("{"):
+                    continue
+                if js is None:
+                    logging.error(f"unexpected output: {l}")
+                    err = True
+                elif js['message_type'] == 'summary':
                     logging.info(l)
                     summary = l
                 elif js['message_type'] == 'status':
@@ -396,9 +536,10 @@ class Restic:
                     logging.error(f"unexpected output: {l}")
                     err = True
 
-        rc = p.wait()
+            rc = out.wait()
+            stderr = out.stderr
         if (rc != 0 and rc != 1) or err:
-            if stderr is not None:
+            if stderr:
                 logging.error(stderr.rstrip())
             raise Exception(f"restore failed: rc = {rc}")
         if summary is None:
@@ -412,41 +553,29 @@ class Restic:
             cmd.append("--no-lock")
             
         logging.info(f"running: {' '.join(cmd)}")
-        
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-        p = subprocess.Popen(cmd, text=True, encoding='utf-8', stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        
-        if p.returncode != 0:
-            raise Exception(f"find failed: {stderr}")
-            
         results = []
-        for line in stdout.splitlines():
-            try:
-                if not line.startswith("["): continue
-                items = json.loads(line)
+        with RepoLock.shared(), ResticOutput(cmd, env, 'utf-8') as out:
+            for line, items in out.messages():
+                if not line.startswith("[") or not isinstance(items, list):
+                    continue
                 for item in items:
                     if "snapshot" in item:
                         results.append(item)
-            except:
-                pass
+            if out.wait() != 0:
+                raise Exception(f"find failed: {out.stderr}")
         return results
 
     def diff(self, env, id1, id2, no_lock=False):
+        """ Yields the JSON messages of 'restic diff' while it runs. """
         cmd = ["restic", "diff", id1, id2, "--json"]
         if no_lock:
             cmd.append("--no-lock")
             
         logging.info(f"running: {' '.join(cmd)}")
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        
-        p = subprocess.Popen(cmd, text=True, encoding='utf-8', stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env, startupinfo=startupinfo)
-        stdout, stderr = p.communicate()
-        
-        if p.returncode != 0:
-            raise Exception(f"diff failed: {stderr}")
-            
-        return stdout
+        with RepoLock.shared(), ResticOutput(cmd, env, 'utf-8') as out:
+            for _, js in out.messages():
+                if js is not None:
+                    yield js
+            if out.wait() != 0:
+                raise Exception(f"diff failed: {out.stderr}")
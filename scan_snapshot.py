@@ -0,0 +1,181 @@
+# encoding: utf-8
+import hashlib
+import os
+import struct
+import sys
+from array import array
+
+from piabackup.fast_scan import DirRecord, FastScan
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ScanDelta:
+    def __init__(self):
+        self.added = []         # relative paths
+        self.removed = []
+        self.modified = []
+        self.added_bytes = 0
+        self.removed_bytes = 0
+        self.modified_bytes = 0 # new size of the modified files
+
+    @property
+    def upload_bytes(self):
+        # upper bound, restic's deduplication and compression will usually upload less
+        return self.added_bytes + self.modified_bytes
+
+    def is_empty(self):
+        return not (self.added or self.removed or self.modified)
+
+
+class ScanSnapshot:
+    """
+    Columnar list of all files found by a prescan: one row per file with a 64 bit path id, size,
+    mtime_ns and inode, each column stored as a flat array and sorted by path id. The relative paths
+    are kept in a separate string table and only decoded for the rows that show up in a delta.
+    """
+    MAGIC = b"PIASCAN1"
+    HEADER = struct.Struct("<8sQQ")
+
+    def __init__(self, ids=None, sizes=None, mtimes_ns=None, inodes=None, offsets=None, paths=b""):
+        self.ids = ids if ids is not None else array('Q')
+        self.sizes = sizes if sizes is not None else array('q')
+        self.mtimes_ns = mtimes_ns if mtimes_ns is not None else array('q')
+        self.inodes = inodes if inodes is not None else array('Q')
+        self.offsets = offsets if offsets is not None else array('Q', [0])  # row i's path is paths[offsets[i]:offsets[i+1]]
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def path_id(rel_path:str) -> int:
+        return int.from_bytes(hashlib.blake2b(rel_path.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+    @staticmethod
+    def from_records(records:dict[str, DirRecord]) -> 'ScanSnapshot':
+        """ Builds the snapshot from FastScan.scan_tree(..., with_files=True). Consumes the per-directory file columns. """
+        rows = []
+        for rel_dir, rec in records.items():
+            cols = rec.files
+            if cols is None:
+                continue
+            for i, name in enumerate(cols.names):
+                rel_path = FastScan._rel_join(rel_dir, name)
+                rows.append((ScanSnapshot.path_id(rel_path), rel_path, cols.sizes[i], cols.mtimes_ns[i], cols.inodes[i]))
+            rec.files = None
+        rows.sort()
+
+        snap = ScanSnapshot()
+        blob = bytearray()
+        for path_id, rel_path, size, mtime_ns, inode in rows:
+            snap.ids.append(path_id)
+            snap.sizes.append(size)
+            snap.mtimes_ns.append(mtime_ns)
+            snap.inodes.append(inode)
+            blob += rel_path.encode('utf-8', 'surrogatepass')
+            snap.offsets.append(len(blob))
+        snap.paths = bytes(blob)
+        return snap
+
+    def path(self, i) -> str:
+        return self.paths[self.offsets[i]:self.offsets[i + 1]].decode('utf-8', 'surrogatepass')
+
+    def total_bytes(self) -> int:
+        return sum(self.sizes)
+
+    @staticmethod
+    def load(file) -> 'ScanSnapshot|None':
+        try:
+            with open(file, 'rb') as f:
+                magic, n, blob_len = ScanSnapshot.HEADER.unpack(f.read(ScanSnapshot.HEADER.size))
+                if magic != ScanSnapshot.MAGIC:
+                    return None
+                snap = ScanSnapshot(array('Q'), array('q'), array('q'), array('Q'), array('Q'))
+                for col, count in ((snap.ids, n), (snap.sizes, n), (snap.mtimes_ns, n), (snap.inodes, n), (snap.offsets, n + 1)):
+                    col.fromfile(f, count)
+                    if sys.byteorder != 'little':
+                        col.byteswap()
+                snap.paths = f.read(blob_len)
+                if len(snap.paths) != blob_len:
+                    return None
+                return snap
+        except (OSError, EOFError, struct.error):
+            return None
+
+    def save(self, file):
+        tmp = f"{file}.tmp"
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(ScanSnapshot.HEADER.pack(ScanSnapshot.MAGIC, len(self.ids), len(self.paths)))
+            for col in (self.ids, self.sizes, self.mtimes_ns, self.inodes, self.offsets):
+                if sys.byteorder != 'little':
+                    col = array(col.typecode, col)
+                    col.byteswap()
+                col.tofile(f)
+            f.write(self.paths)
+        os.replace(tmp, file)
+
+    @staticmethod
+    def delta(old:'ScanSnapshot', new:'ScanSnapshot') -> ScanDelta:
+        """ Compares two snapshots by merging their sorted path id columns. A file counts as modified if size, mtime or inode differ. """
+        if np is not None:
+            return ScanSnapshot._delta_numpy(old, new)
+
+        d = ScanDelta()
+        o_ids, n_ids = old.ids, new.ids
+        i = j = 0
+        n_old, n_new = len(o_ids), len(n_ids)
+        while i < n_old and j < n_new:
+            a, b = o_ids[i], n_ids[j]
+            if a == b:
+                if old.sizes[i] != new.sizes[j] or old.mtimes_ns[i] != new.mtimes_ns[j] or old.inodes[i] != new.inodes[j]:
+                    d.modified.append(new.path(j))
+                    d.modified_bytes += new.sizes[j]
+                i += 1
+                j += 1
+            elif a < b:
+                d.removed.append(old.path(i))
+                d.removed_bytes += old.sizes[i]
+                i += 1
+            else:
+                d.added.append(new.path(j))
+                d.added_bytes += new.sizes[j]
+                j += 1
+        for i in range(i, n_old):
+            d.removed.append(old.path(i))
+            d.removed_bytes += old.sizes[i]
+        for j in range(j, n_new):
+            d.added.append(new.path(j))
+            d.added_bytes += new.sizes[j]
+        return d
+
+    @staticmethod
+    def _delta_numpy(old:'ScanSnapshot', new:'ScanSnapshot') -> ScanDelta:
+        def cols(s):
+            return (np.frombuffer(s.ids, dtype=np.uint64), np.frombuffer(s.sizes, dtype=np.int64),
+                    np.frombuffer(s.mtimes_ns, dtype=np.int64), np.frombuffer(s.inodes, dtype=np.uint64))
+        o_ids, o_sizes, o_mtimes, o_inodes = cols(old)
+        n_ids, n_sizes, n_mtimes, n_inodes = cols(new)
+
+        _, oi, ni = np.intersect1d(o_ids, n_ids, assume_unique=True, return_indices=True)
+        removed = np.ones(len(o_ids), dtype=bool)
+        removed[oi] = False
+        added = np.ones(len(n_ids), dtype=bool)
+        added[ni] = False
+        changed = (o_sizes[oi] != n_sizes[ni]) | (o_mtimes[oi] != n_mtimes[ni]) | (o_inodes[oi] != n_inodes[ni])
+        modified = np.sort(ni[changed])
+
+        d = ScanDelta()
+        removed_idx = np.flatnonzero(removed)
+        added_idx = np.flatnonzero(added)
+        d.removed = [old.path(int(i)) for i in removed_idx]
+        d.added = [new.path(int(j)) for j in added_idx]
+        d.modified = [new.path(int(j)) for j in modified]
+        d.removed_bytes = int(o_sizes[removed_idx].sum())
+        d.added_bytes = int(n_sizes[added_idx].sum())
+        d.modified_bytes = int(n_sizes[modified].sum())
+        return d
@@ -0,0 +1,76 @@
+# encoding: utf-8
+import heapq
+import itertools
+import time
+
+
+class Scheduler:
+    """
+    Due times of the work the app starts on its own, as a min-heap of (due, seq, kind, key). Rescheduling an event
+    pushes a new heap entry and leaves the old one behind, stale entries get dropped when they reach the top.
+    Scheduling and popping an event costs O(log n), so thousands of backup folders are no problem.
+    The clock is a parameter, nothing here knows about Tk or threads.
+    """
+    BACKUP = "backup"          # key: backup dir id
+    CHECK = "check"            # next segment of the full repository check
+    DISCOVERY = "discovery"
+    ERRORS = "errors"          # error toast
+    RELOAD = "reload"          # read settings and backup folders again
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._heap = []
+        self._due = {}  # (kind, key) -> due time
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._due)
+
+    def clear(self):
+        self._heap.clear()
+        self._due.clear()
+
+    def schedule(self, kind, key, due:float):
+        self._due[(kind, key)] = due
+        heapq.heappush(self._heap, (due, next(self._seq), kind, key))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._compact()
+
+    def cancel(self, kind, key=None):
+        self._due.pop((kind, key), None)
+
+    def due(self, kind, key=None) -> float|None:
+        return self._due.get((kind, key))
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if self._due.get((e[2], e[3])) == e[0]]
+        heapq.heapify(self._heap)
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and self._due.get((heap[0][2], heap[0][3])) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_due(self) -> float|None:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None) -> list[tuple]:
+        """ Removes and returns (kind, key) of all events due at now, earliest first. """
+        now = self.clock() if now is None else now
+        result = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return result
+            _, _, kind, key = heapq.heappop(self._heap)
+            del self._due[(kind, key)]
+            result.append((kind, key))
+
+    def delay(self, now=None, max_delay=3600.0) -> float:
+        """ Seconds until the next event, at most max_delay. """
+        now = self.clock() if now is None else now
+        due = self.next_due()
+        if due is None:
+            return max_delay
+        return min(max_delay, max(0.0, due - now))
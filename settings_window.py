@@ -20,7 +20,9 @@ import piabackup.common as common
 from piabackup.auto_detect_dialog import AutoDetectDialog
 from piabackup.autostart import (is_auto_start, is_running_in_sandbox,
                                  toggle_auto_start)
+from piabackup.backup_cost import BackupCost
 from piabackup.backup_dir import BackupDir
+from piabackup.backup_progress import BackupProgress
 from piabackup.bitrot_window import BitrotWindow
 from piabackup.browse_dialog import BrowseDialog
 from piabackup.config import Config
@@ -29,6 +31,7 @@ from piabackup.exclusion_editor import ExclusionEditor
 from piabackup.frequency import format_frequency, parse_frequency
 from piabackup.help_window import HelpWindow
 from piabackup.password_dialog import PasswordDialog
+from piabackup.rclone_server import RcloneServer
 from piabackup.rewrite_window import RewriteWindow
 from piabackup.worker_thread import GetAllPathsTask, UnlockTask, WorkerThread
 from ui.github_update_checker import GithubUpdateChecker
@@ -53,13 +56,26 @@ class SettingsWindow(tk.Toplevel):
         self.var_err_freq = tk.StringVar(value=format_frequency(self.config.error_check_frequency))
         self.var_bitrot = tk.BooleanVar(value=self.config.bitrot_detection)
         self.var_prune_enabled = tk.BooleanVar(value=self.config.prune_enabled)
+        self.var_bitrot_workers = tk.StringVar(value=str(self.config.bitrot_workers))
         self.var_no_lock = tk.BooleanVar(value=self.config.no_lock)
+        self.var_rclone_serve = tk.BooleanVar(value=self.config.rclone_serve)
         self.var_auto_discovery = tk.BooleanVar(value=self.config.auto_discovery)
         self.var_make_vanished_permanent = tk.BooleanVar(value=self.config.make_vanished_permanent)
         self.var_update_enabled = tk.BooleanVar(value=self.config.update_check_enabled)
         self.var_update_freq = tk.StringVar(value=format_frequency(self.config.update_check_frequency))
         self.var_update_toast_freq = tk.StringVar(value=format_frequency(self.config.update_check_toast_interval))
         self.var_prescan_enabled = tk.BooleanVar(value=self.config.prescan_enabled)
+        self.var_prescan_workers = tk.StringVar(value=str(self.config.prescan_workers))
+        self.var_prescan_budget = tk.StringVar(value=str(self.config.prescan_budget))
+        self.var_prescan_processes = tk.StringVar(value=str(self.config.prescan_processes))
+        self.var_prescan_autotune = tk.BooleanVar(value=self.config.prescan_autotune)
+        self.var_prescan_index = tk.BooleanVar(value=self.config.prescan_index)
+        self.var_change_watcher = tk.BooleanVar(value=self.config.change_watcher)
+        self.var_scan_snapshots = tk.BooleanVar(value=self.config.scan_snapshots)
+        self.var_ls_cache_mb = tk.StringVar(value=str(self.config.ls_cache_mb))
+        self.var_backup_slots = tk.StringVar(value=str(self.config.backup_slots))
+        self.var_interactive_workers = tk.StringVar(value=str(self.config.interactive_workers))
+        self.var_interactive_no_lock = tk.BooleanVar(value=self.config.interactive_no_lock)
         self.var_wait_for_idle = tk.BooleanVar(value=self.config.wait_for_idle)
         
         main_frame = ttk.Frame(self)
@@ -122,7 +138,21 @@ class SettingsWindow(tk.Toplevel):
 
         ttk.Checkbutton(frame, text="Make vanished root folders' latest backups permanent", variable=self.var_make_vanished_permanent).pack(anchor=tk.W)
         
-        ttk.Checkbutton(frame, text="Enable Prescan", variable=self.var_prescan_enabled).pack(anchor=tk.W)
+        prescan_frame = ttk.Frame(frame)
+        prescan_frame.pack(fill=tk.X)
+        ttk.Checkbutton(prescan_frame, text="Enable Prescan", variable=self.var_prescan_enabled).pack(side=tk.LEFT)
+        ttk.Label(prescan_frame, text="Workers:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(prescan_frame, textvariable=self.var_prescan_workers, width=4).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(prescan_frame, text="Processes:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(prescan_frame, textvariable=self.var_prescan_processes, width=4).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Checkbutton(prescan_frame, text="Keep index (log changed folders)", variable=self.var_prescan_index).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Checkbutton(prescan_frame, text="Keep file list (log changed files)", variable=self.var_scan_snapshots).pack(side=tk.LEFT, padx=(10, 0))
+        budget_frame = ttk.Frame(frame)
+        budget_frame.pack(fill=tk.X)
+        ttk.Label(budget_frame, text="Background prescan, max. files/s (0 = off):").pack(side=tk.LEFT)
+        ttk.Entry(budget_frame, textvariable=self.var_prescan_budget, width=8).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Checkbutton(budget_frame, text="Disable prescan where it doesn't pay off", variable=self.var_prescan_autotune).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Checkbutton(frame, text="Watch folders for changes (skip prescan of unchanged folders)", variable=self.var_change_watcher).pack(anchor=tk.W)
         ttk.Checkbutton(frame, text="Wait for user idle before backing up", variable=self.var_wait_for_idle).pack(anchor=tk.W)
 
         err_frame = ttk.Frame(frame)
@@ -153,6 +183,17 @@ class SettingsWindow(tk.Toplevel):
                   font=("Segoe UI", 8), foreground="#666666", wraplength=760).pack(anchor=tk.W, pady=(0, 5))
         
         ttk.Checkbutton(frame, text="Use --no-lock (unsafe, YOU HAVE BEEN WARNED!!!)", variable=self.var_no_lock).pack(anchor=tk.W, pady=(0, 5))
+        ttk.Checkbutton(frame, text="Keep a local rclone server running for rclone: repositories", variable=self.var_rclone_serve).pack(anchor=tk.W, pady=(0, 5))
+
+        ls_cache_frame = ttk.Frame(frame)
+        ls_cache_frame.pack(fill=tk.X, pady=(0, 5))
+        ttk.Label(ls_cache_frame, text="Snapshot listing cache, MB (0 = off):").pack(side=tk.LEFT)
+        ttk.Entry(ls_cache_frame, textvariable=self.var_ls_cache_mb, width=8).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(ls_cache_frame, text="Parallel backups:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(ls_cache_frame, textvariable=self.var_backup_slots, width=4).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(ls_cache_frame, text="Interactive tasks:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(ls_cache_frame, textvariable=self.var_interactive_workers, width=4).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Checkbutton(ls_cache_frame, text="Read without locks", variable=self.var_interactive_no_lock).pack(side=tk.LEFT, padx=(10, 0))
         
         check_frame = ttk.Frame(frame)
         check_frame.pack(fill=tk.X, pady=(5, 0))
@@ -167,6 +208,8 @@ class SettingsWindow(tk.Toplevel):
         ttk.Checkbutton(prune_frame, text="Enable Prune", variable=self.var_prune_enabled).pack(side=tk.LEFT, padx=(0, 5))
         self.chk_bitrot = ttk.Checkbutton(prune_frame, text="Enable Bitrot Detection", variable=self.var_bitrot)
         self.chk_bitrot.pack(side=tk.LEFT, padx=(50, 5))
+        ttk.Label(prune_frame, text="Parallel diffs:").pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Entry(prune_frame, textvariable=self.var_bitrot_workers, width=4).pack(side=tk.LEFT, padx=(5, 0))
 
         ttk.Separator(frame, orient='horizontal').pack(fill='x', pady=15)
         
@@ -230,6 +273,25 @@ class SettingsWindow(tk.Toplevel):
         self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
         self.on_tree_select(None)
 
+        ttk.Separator(frame, orient='horizontal').pack(fill='x', pady=15)
+
+        # Running Tasks Section
+        tasks_header_frame = ttk.Frame(frame)
+        tasks_header_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Label(tasks_header_frame, text="Running Tasks", font=("Segoe UI", 10, "bold")).pack(side=tk.LEFT)
+        self.lbl_queued = ttk.Label(tasks_header_frame, text="")
+        self.lbl_queued.pack(side=tk.LEFT, padx=(10, 0))
+
+        self.tasks_tree = ttk.Treeview(frame, columns=("task", "progress", "current"), show="headings", height=3)
+        self.tasks_tree.heading("task", text="Task")
+        self.tasks_tree.heading("progress", text="Progress")
+        self.tasks_tree.heading("current", text="Current File")
+        self.tasks_tree.column("task", width=250)
+        self.tasks_tree.column("progress", width=250)
+        self.tasks_tree.column("current", width=300)
+        self.tasks_tree.pack(fill=tk.X)
+        self.refresh_running_tasks()
+
         # Buttons
         btn_frame = ttk.Frame(frame)
         btn_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=10)
@@ -248,6 +310,25 @@ class SettingsWindow(tk.Toplevel):
         
         Tools.center_window(self, target_width, target_height)
 
+    def refresh_running_tasks(self):
+        if not self.winfo_exists():
+            return
+        self.tasks_tree.delete(*self.tasks_tree.get_children())
+        now = time.time()
+        for task in WorkerThread.running_tasks():
+            progress = task.progress if isinstance(task.progress, dict) else None
+            text = BackupProgress.format(progress)
+            if not text and task.run_started_at:
+                text = f"running for {format_frequency(int(now - task.run_started_at)) or '<1m'}"
+            self.tasks_tree.insert("", tk.END, values=(task.description, text, (progress or {}).get('current_file') or ""))
+        queued = WorkerThread.queued_count()
+        done_at = BackupCost.queue_done_at
+        if queued and done_at > now:
+            self.lbl_queued.config(text=f"({queued} queued, backups done around {time.strftime('%H:%M', time.localtime(done_at))})")
+        else:
+            self.lbl_queued.config(text=f"({queued} queued)" if queued else "")
+        self.after(1000, self.refresh_running_tasks)
+
     def check_updates_now(self):
         uc = GithubUpdateChecker.get_instance()
         if uc:
@@ -293,6 +374,8 @@ class SettingsWindow(tk.Toplevel):
             with common.db_conn as conn:
                 conn.execute("INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)", ("last_full_check", "0"))
                 conn.execute("INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)", ("last_full_check_segment", "-1"))
+            if self.on_trigger_run:
+                self.on_trigger_run()
             messagebox.showinfo(APPNAME, "Full check triggered.\nBackups have priority.")
         except Exception as e:
             logging.error(f"Failed to trigger full check: {e}")
@@ -350,6 +433,7 @@ class SettingsWindow(tk.Toplevel):
         elif "RESTIC_REPOSITORY" not in env:
             messagebox.showerror(APPNAME, "Repository not configured.")
             return
+        RcloneServer.apply(env, self.var_rclone_serve.get())
 
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
@@ -386,12 +470,7 @@ class SettingsWindow(tk.Toplevel):
 
     @staticmethod
     def format_bytes(size):
-        unit = ""
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if size < 1024.0:
-                break
-            size /= 1024.0
-        return f"{size:.1f} {unit}"
+        return common.format_bytes(size)
 
     def hide_tooltip(self):
         if self.tooltip_window:
@@ -490,7 +569,7 @@ class SettingsWindow(tk.Toplevel):
         elif col == "next_run":
             key = lambda d: d.next_run
         elif col == "error":
-            key = lambda d: d.error.lower()
+            key = lambda d: d.errors.lower()
         elif col == "summary":
             def summary_key(d):
                 try:
@@ -532,7 +611,7 @@ class SettingsWindow(tk.Toplevel):
             iexclude_count = len([line for line in d.iexclude.splitlines() if line.strip()]) if d.iexclude else 0
             iexclude_str = str(iexclude_count) if iexclude_count > 0 else "None"
 
-            self.tree.insert("", tk.END, iid=str(i), values=(str(d.path), d.enabled, iexclude_str, freq_str, last_run_str, next_run_str, summary_str, d.error), tags=tags)
+            self.tree.insert("", tk.END, iid=str(i), values=(str(d.path), d.enabled, iexclude_str, freq_str, last_run_str, next_run_str, summary_str, d.errors), tags=tags)
 
     def import_from_repo(self):
         repo = self.var_repo.get().strip()
@@ -553,6 +632,7 @@ class SettingsWindow(tk.Toplevel):
         elif "RESTIC_REPOSITORY" not in env:
             messagebox.showerror(APPNAME, "Repository not configured.")
             return
+        RcloneServer.apply(env, self.var_rclone_serve.get())
 
         self.btn_import.state(['disabled'])
         self.progress_window = tk.Toplevel(self)
@@ -748,6 +828,7 @@ class SettingsWindow(tk.Toplevel):
         elif "RESTIC_REPOSITORY" not in env:
             messagebox.showerror(APPNAME, "Repository not configured.")
             return
+        RcloneServer.apply(env, self.var_rclone_serve.get())
 
         RewriteWindow(self, entry, env, self.var_no_lock.get())
 
@@ -808,6 +889,7 @@ class SettingsWindow(tk.Toplevel):
         elif "RESTIC_REPOSITORY" not in env:
             messagebox.showerror(APPNAME, "Repository not configured.")
             return
+        RcloneServer.apply(env, self.var_rclone_serve.get())
 
         dlg = tk.Toplevel(self)
         dlg.title("Unlock Repository")
@@ -833,11 +915,13 @@ class SettingsWindow(tk.Toplevel):
             if not var_force.get():
                 try:
                     running = []
+                    # our own rclone server doesn't hold locks
+                    own_pid = f'"{RcloneServer.pid()}"'
                     for proc in ["restic.exe", "rclone.exe"]:
                         startupinfo = subprocess.STARTUPINFO()
                         startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                         res = subprocess.run(['tasklist', '/FI', f'IMAGENAME eq {proc}', '/FO', 'CSV', '/NH'], capture_output=True, text=True, startupinfo=startupinfo)
-                        if f'"{proc}"' in res.stdout:
+                        if any(l.startswith(f'"{proc}"') and l.split(",")[1] != own_pid for l in res.stdout.splitlines()):
                             running.append(proc)
                             
                     if running:
@@ -895,8 +979,9 @@ class SettingsWindow(tk.Toplevel):
         elif "RESTIC_REPOSITORY" not in env:
             messagebox.showerror(APPNAME, "Repository not configured.")
             return
+        RcloneServer.apply(env, self.var_rclone_serve.get())
             
-        BrowseDialog(self, entry, env, self.var_no_lock.get())
+        BrowseDialog(self, entry, env, self.var_no_lock.get(), self.config.ls_cache_mb)
 
     def open_bitrot_window(self):
         selected = self.tree.selection()
@@ -915,6 +1000,7 @@ class SettingsWindow(tk.Toplevel):
                 return
             env["RESTIC_REPOSITORY"] = repo
             env["RESTIC_PASSWORD"] = password
+        RcloneServer.apply(env, self.var_rclone_serve.get())
             
         BitrotWindow(self, entry, env, self.var_no_lock.get())
 
@@ -979,6 +1065,7 @@ class SettingsWindow(tk.Toplevel):
             self.config.bitrot_detection = self.var_bitrot.get()
             self.config.prune_enabled = self.var_prune_enabled.get()
             self.config.no_lock = self.var_no_lock.get()
+            self.config.rclone_serve = self.var_rclone_serve.get()
             self.config.auto_discovery = self.var_auto_discovery.get()
             self.config.make_vanished_permanent = self.var_make_vanished_permanent.get()
             self.config.update_check_enabled = self.var_update_enabled.get()
@@ -986,13 +1073,61 @@ class SettingsWindow(tk.Toplevel):
             self.config.update_check_toast_interval = parse_frequency(self.var_update_toast_freq.get())
             
             self.config.prescan_enabled = self.var_prescan_enabled.get()
+            self.config.prescan_index = self.var_prescan_index.get()
+            self.config.change_watcher = self.var_change_watcher.get()
+            self.config.scan_snapshots = self.var_scan_snapshots.get()
+            self.config.prescan_autotune = self.var_prescan_autotune.get()
             self.config.wait_for_idle = self.var_wait_for_idle.get()
         except Exception as e:
             messagebox.showerror(APPNAME, f"Invalid frequency: {e}")
             return
 
+        try:
+            self.config.prescan_workers = max(1, int(self.var_prescan_workers.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid number of prescan workers: {e}")
+            return
+
+        try:
+            self.config.prescan_processes = max(0, int(self.var_prescan_processes.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid number of prescan processes: {e}")
+            return
+
+        try:
+            self.config.prescan_budget = max(0, int(self.var_prescan_budget.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid prescan files/s limit: {e}")
+            return
+
+        try:
+            self.config.bitrot_workers = max(1, int(self.var_bitrot_workers.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid number of parallel bitrot diffs: {e}")
+            return
+
+        try:
+            self.config.ls_cache_mb = max(0, int(self.var_ls_cache_mb.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid snapshot listing cache size: {e}")
+            return
+
+        try:
+            self.config.backup_slots = max(1, int(self.var_backup_slots.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid number of parallel backups: {e}")
+            return
+
+        try:
+            self.config.interactive_workers = max(1, int(self.var_interactive_workers.get()))
+        except ValueError as e:
+            messagebox.showerror(APPNAME, f"Invalid number of interactive tasks: {e}")
+            return
+        self.config.interactive_no_lock = self.var_interactive_no_lock.get()
+
         self.config.repo = self.var_repo.get()
         self.config.save()
+        WorkerThread.configure(self.config)
         
         # Update running checker
         uc = GithubUpdateChecker.get_instance()
@@ -1016,4 +1151,6 @@ class SettingsWindow(tk.Toplevel):
             logging.error(f"Failed to save backup dirs: {e}")
             messagebox.showerror(APPNAME, f"Failed to save backup directories: {e}")
             
+        if self.on_trigger_run:
+            self.on_trigger_run()
         self.destroy()
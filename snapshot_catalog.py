@@ -0,0 +1,110 @@
+# encoding: utf-8
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from piabackup.rclone_server import RcloneServer
+
+
+class SnapshotCatalog:
+    """
+    Local copy of the repository's snapshot list. Snapshot IDs are immutable (restic tag rewrites a snapshot
+    under a new ID), so a sync only needs the cheap 'restic list snapshots' and fetches the details of
+    IDs it hasn't seen yet. Within MAX_AGE the catalog is used without asking restic at all; our own
+    backup, tag and forget calls mark it stale so their results show up right away.
+    """
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS snapshot_catalog (id TEXT PRIMARY KEY, time REAL, json TEXT)",
+              "CREATE TABLE IF NOT EXISTS snapshot_catalog_tags (tag TEXT, id TEXT, PRIMARY KEY (tag, id))"]
+
+    MAX_AGE = 600
+    FETCH_BATCH = 200  # snapshot IDs per 'restic snapshots' call, keeps the command line short enough for Windows
+
+    _lock = threading.Lock()
+
+    def __init__(self, conn:sqlite3.Connection, env):
+        self.conn = conn
+        self.env = env
+        self.repo = env.get(RcloneServer.ORIGIN_ENV) or env.get("RESTIC_REPOSITORY") or env.get("RESTIC_REPOSITORY_FILE") or ""
+
+    def _status(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM status WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_status(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @staticmethod
+    def invalidate(conn:sqlite3.Connection):
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO status (key, value) VALUES ('snapshot_catalog_synced_at', '0')")
+
+    def is_fresh(self, now=None) -> bool:
+        if self._status('snapshot_catalog_repo') != self.repo:
+            return False
+        synced_at = float(self._status('snapshot_catalog_synced_at', 0))
+        return (now or time.time()) - synced_at < self.MAX_AGE
+
+    def sync(self, restic, no_lock=False, force=False) -> set:
+        """ Returns the IDs of the snapshots that disappeared from the repository. """
+        with SnapshotCatalog._lock:
+            if not force and self.is_fresh():
+                return set()
+            now = time.time()
+            with self.conn:
+                if self._status('snapshot_catalog_repo') != self.repo:
+                    logging.info("snapshot catalog: repository changed, starting over")
+                    self.conn.execute("DELETE FROM snapshot_catalog")
+                    self.conn.execute("DELETE FROM snapshot_catalog_tags")
+                    self._set_status('snapshot_catalog_repo', self.repo)
+
+            ids = set(restic.list_snapshot_ids(self.env, no_lock))
+            known = {row[0] for row in self.conn.execute("SELECT id FROM snapshot_catalog")}
+            new_ids = sorted(ids - known)
+            removed = known - ids
+
+            if len(new_ids) > self.FETCH_BATCH:
+                # initial sync or lots of foreign activity: one full listing is cheaper
+                snaps = [s for s in restic.fetch_snapshots(self.env, None, no_lock) if s['id'] in ids]
+            else:
+                snaps = []
+                for i in range(0, len(new_ids), self.FETCH_BATCH):
+                    snaps.extend(restic.fetch_snapshots(self.env, new_ids[i:i + self.FETCH_BATCH], no_lock))
+
+            with self.conn:
+                self.conn.executemany("DELETE FROM snapshot_catalog WHERE id=?", ((i,) for i in removed))
+                self.conn.executemany("DELETE FROM snapshot_catalog_tags WHERE id=?", ((i,) for i in removed))
+                self.add([s for s in snaps if s['id'] not in known])
+                self._set_status('snapshot_catalog_synced_at', now)
+            logging.info(f"snapshot catalog synced: {len(ids)} snapshots, {len(snaps)} fetched, {len(removed)} removed")
+            return removed
+
+    @staticmethod
+    def snapshot_time(s) -> float:
+        return datetime.datetime.fromisoformat(s['time']).timestamp()
+
+    def add(self, snaps:list):
+        """ Stores snapshots in 'restic snapshots --json' format, the caller handles the transaction. """
+        for s in snaps:
+            self.conn.execute("INSERT OR REPLACE INTO snapshot_catalog (id, time, json) VALUES (?, ?, ?)",
+                              (s['id'], self.snapshot_time(s), json.dumps(s)))
+            self.conn.executemany("INSERT OR IGNORE INTO snapshot_catalog_tags (tag, id) VALUES (?, ?)",
+                                  ((tag, s['id']) for tag in s.get('tags') or []))
+
+    def snapshots(self, tag=None, latest_n=None) -> list:
+        """ Same format as 'restic snapshots --json' plus the '_time' timestamp, in ascending time order. """
+        if tag is None:
+            rows = self.conn.execute("SELECT json, time FROM snapshot_catalog ORDER BY time, id").fetchall()
+        else:
+            rows = self.conn.execute("SELECT c.json, c.time FROM snapshot_catalog c JOIN snapshot_catalog_tags t ON t.id = c.id "
+                                     "WHERE t.tag=? ORDER BY c.time, c.id", (tag,)).fetchall()
+        if latest_n is not None and int(latest_n) > 0:
+            rows = rows[-int(latest_n):]
+        result = []
+        for js, t in rows:
+            s = json.loads(js)
+            s['_time'] = t
+            result.append(s)
+        return result
@@ -1,4 +1,5 @@
 # encoding: utf-8
+import copy
 import json
 import logging
 import os
@@ -8,28 +9,65 @@ import subprocess
 import tempfile
 import threading
 import time
+from contextlib import closing, nullcontext
 from pathlib import PurePosixPath
 
 from windows_toasts import Toast
 
 import piabackup.common as common
+from piabackup.backup_cost import BackupCost
 from piabackup.backup_dir import BackupDir
+from piabackup.backup_progress import BackupProgress, ThroughputLog
+from piabackup.change_watcher import ChangeWatcher
 from piabackup.config import Config
+from piabackup.db import DB
 from piabackup.default_dirs_scanner import DefaultDirsScanner
-from piabackup.fast_scan import FastScan
+from piabackup.fast_scan import FastScan, ScanBudget, ScanInterrupted
+from piabackup.fast_scan_index import FastScanIndex, PrescanCheckpoint
+from piabackup.fast_scan_pool import FastScanPool
+from piabackup.ls_cache import LsCache
+from piabackup.prescan_stats import PrescanStats
+from piabackup.repo_lock import RepoLock
 from piabackup.restic import Restic
+from piabackup.scan_snapshot import ScanSnapshot
+from piabackup.snapshot_catalog import SnapshotCatalog
 from piabackup.sleep_inhibitor import SleepInhibitor
 
 
 class WorkerTask:
+    MAINTENANCE = "maintenance"
+    INTERACTIVE = "interactive"
+    BACKGROUND = "background"
+
+    # maintenance tasks run one after another in the order they were submitted, interactive ones are read-only
+    # tasks the user waits for, they have their own threads and don't queue up behind backups. Background tasks
+    # are long read-only checks nobody waits for, one at a time in a thread of their own.
+    lane = MAINTENANCE
+    # parallel tasks may run in one of the backup slots, next to other parallel tasks and the serial queue
+    parallel = False
+    # read-only interactive and background tasks run restic with --no-lock when reads without locks are enabled
+    read_only = False
+
     def __init__(self, **kwargs):
         tid = kwargs.get("task_id", None)
         self._task_id: str | None = str(tid) if tid is not None else None
+        self.progress = None
+        self.run_started_at = None
 
     @property
     def task_id(self):
         return self._task_id
 
+    @property
+    def description(self) -> str:
+        return self._task_id or type(self).__name__
+
+    # Can be called from run(). Keeps the latest progress for the running tasks view and passes it to on_progress.
+    def report_progress(self, progress):
+        self.progress = progress
+        if common.root:
+            common.root.after(0, lambda: self.on_progress(progress))
+
     # The on_* methods always run on the main UI thread where also the database connection lives.
     # Don't block the UI here!!
     def on_success(self, res):
@@ -51,6 +89,8 @@ class WorkerTask:
 
 
 class StreamingResticTask(WorkerTask):
+    MODIFYING_COMMANDS = ("backup", "forget", "rewrite", "tag")
+
     def __init__(self, env, no_lock, *args, iexclude, backup_path, **kwargs):
         super().__init__(**kwargs)
         self.env = env
@@ -62,6 +102,13 @@ class StreamingResticTask(WorkerTask):
     def on_output(self, line):
         pass
 
+    def repo_lock(self):
+        if self.command[0] == "backup":
+            return RepoLock.shared()
+        if self.command[0] in self.MODIFYING_COMMANDS:
+            return RepoLock.exclusive()
+        return nullcontext()
+
     def run(self):
         cmd = ["restic"] + self.command
         if self.no_lock:
@@ -77,25 +124,31 @@ class StreamingResticTask(WorkerTask):
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-            p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env, startupinfo=startupinfo, bufsize=1, universal_newlines=True)
-            
-            if p.stdout:
-                for line in p.stdout:
-                    logging.info(line.strip())
-                    self.on_output(line)
-            
-            stderr_output = ""
-            if p.stderr:
-                for line in p.stderr:
-                    stderr_output += line
-                    logging.error(line.strip())
-                    self.on_output(line)
-
-            rc = p.wait()
+            with self.repo_lock():
+                p = subprocess.Popen(cmd, text=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env, startupinfo=startupinfo, bufsize=1, universal_newlines=True)
+                
+                if p.stdout:
+                    for line in p.stdout:
+                        logging.info(line.strip())
+                        self.on_output(line)
+                
+                stderr_output = ""
+                if p.stderr:
+                    for line in p.stderr:
+                        stderr_output += line
+                        logging.error(line.strip())
+                        self.on_output(line)
+
+                rc = p.wait()
+            if self.command[0] in self.MODIFYING_COMMANDS:
+                Restic.catalog_changed()
             if rc != 0:
                 raise Exception(f"Command failed with exit code {rc}:\n{stderr_output}")
 			
 class ListSnapshotsTask(WorkerTask):
+    lane = WorkerTask.INTERACTIVE
+    read_only = True
+
     def __init__(self, env, tag, no_lock, **kwargs):
         super().__init__(**kwargs)
         self.env = env
@@ -110,17 +163,50 @@ class ListSnapshotsTask(WorkerTask):
         return r.list_snapshots(MockConfig(self.no_lock), self.env, self.tag) # type: ignore
 
 class LsTask(WorkerTask):
-    def __init__(self, env, snap_id, no_lock, **kwargs):
+    lane = WorkerTask.INTERACTIVE
+    read_only = True
+
+    def __init__(self, env, snap_id, no_lock, cache_mb=0, **kwargs):
         super().__init__(**kwargs)
         self.env = env
         self.snap_id = snap_id
         self.no_lock = no_lock
+        self.cache_mb = cache_mb
+
+    def run(self):
+        r = Restic()
+        cache = LsCache(common.LS_CACHE_DIR, self.cache_mb * 1024 * 1024) if self.cache_mb > 0 else None
+        return r.ls_listing(self.env, self.snap_id, self.no_lock, cache)
+
+class LocalDiffTask(WorkerTask):
+    MAX_CHANGES = 10000
+    lane = WorkerTask.INTERACTIVE
+    read_only = True
+
+    def __init__(self, env, id1, id2, no_lock, cache_mb=0, **kwargs):
+        super().__init__(**kwargs)
+        self.env = env
+        self.id1 = id1
+        self.id2 = id2
+        self.no_lock = no_lock
+        self.cache_mb = cache_mb
 
     def run(self):
+        """ Returns (first MAX_CHANGES changes, number of changes per modifier). """
         r = Restic()
-        return r.ls(self.env, self.snap_id, self.no_lock)
+        cache = LsCache(common.LS_CACHE_DIR, self.cache_mb * 1024 * 1024) if self.cache_mb > 0 else None
+        changes = []
+        counts = {}
+        for c in r.local_diff(self.env, self.id1, self.id2, self.no_lock, cache):
+            counts[c['modifier']] = counts.get(c['modifier'], 0) + 1
+            if len(changes) < self.MAX_CHANGES:
+                changes.append(c)
+        return changes, counts
 
 class FindTask(WorkerTask):
+    lane = WorkerTask.INTERACTIVE
+    read_only = True
+
     def __init__(self, env, search_path, no_lock, **kwargs):
         super().__init__(**kwargs)
         self.env = env
@@ -132,6 +218,8 @@ class FindTask(WorkerTask):
         return r.find(self.env, self.search_path, self.no_lock)
 
 class RestoreTask(WorkerTask):
+    lane = WorkerTask.INTERACTIVE
+
     def __init__(self, env, snap_id, target_dir, include_path, no_lock, flatten, backup_dir_parts, **kwargs):
         super().__init__(**kwargs)
         self.env = env
@@ -187,18 +275,18 @@ class RestoreTask(WorkerTask):
                     shutil.move(os.path.join(tmpname, leaf_name), self.target_dir)
         return summary, errmsgs
 
-class TagSnapshotTask(WorkerTask):
-    def __init__(self, env, snap_id, tag, remove, no_lock, **kwargs):
+class TagSnapshotsTask(WorkerTask):
+    def __init__(self, env, snap_ids:list[str], tag, remove, no_lock, **kwargs):
         super().__init__(**kwargs)
         self.env = env
-        self.snap_id = snap_id
+        self.snap_ids = snap_ids
         self.tag = tag
         self.remove = remove
         self.no_lock = no_lock
 
     def run(self):
         r = Restic()
-        r.tag_snapshot(self.env, self.snap_id, self.tag, remove=self.remove, no_lock=self.no_lock)
+        r.tag_snapshots(self.env, self.snap_ids, self.tag, remove=self.remove, no_lock=self.no_lock)
 
 class UnlockTask(WorkerTask):
     def __init__(self, env, remove_all, **kwargs):
@@ -211,6 +299,9 @@ class UnlockTask(WorkerTask):
         r.unlock(self.env, self.remove_all)
 
 class GetAllPathsTask(WorkerTask):
+    lane = WorkerTask.INTERACTIVE
+    read_only = True
+
     def __init__(self, env, no_lock, **kwargs):
         super().__init__(**kwargs)
         self.env = env
@@ -220,15 +311,275 @@ class GetAllPathsTask(WorkerTask):
         r = Restic()
         return r.get_all_paths(self.env, self.no_lock)
 
+class PrescanBatch:
+    """
+    Shared prescan for the BackupTasks submitted in one scheduler cycle. Due folders that contain or are contained
+    in another due folder get scanned together by the first task that needs one of them, so directories below
+    several backup roots are listed once per cycle instead of once per root.
+    With prescan processes configured, all due folders are submitted to the process pool at once and get scanned
+    concurrently while the tasks run one after another.
+    """
+    # don't hand out scan results that got older than this while other backups ran
+    MAX_AGE = 600
+
+    def __init__(self, entries:list[BackupDir], cfg:Config):
+        candidates = []
+        if cfg.prescan_enabled and cfg.prescan_budget <= 0:
+            # budgeted prescans run on their own so they can be interrupted and resumed per folder
+            candidates = [e for e in entries if e.fastscan_fingerprint != "0" and not (cfg.change_watcher and ChangeWatcher.is_clean(e.id))]
+        self.roots = {e.id: (e.path, e.iexclude) for e in candidates
+                      if cfg.prescan_processes > 0 or any(FastScan.is_nested(e.path, o.path) or FastScan.is_nested(o.path, e.path) for o in candidates if o is not e)}
+        self.cfg = cfg
+        self._lock = threading.Lock()
+        self._results = None
+        self._futures = None
+        self._scanned_at = 0.0
+
+    def discard(self, backup_dir_id):
+        with self._lock:
+            if self._results is None and self._futures is None:
+                self.roots.pop(backup_dir_id, None)
+
+    def _groups(self) -> list[dict]:
+        groups = []
+        for key, root in self.roots.items():
+            joined = [g for g in groups if any(FastScan.is_nested(root[0], p) or FastScan.is_nested(p, root[0]) for p, _ in g.values())]
+            merged = {key: root}
+            for g in joined:
+                merged.update(g)
+                groups.remove(g)
+            groups.append(merged)
+        return groups
+
+    def take(self, backup_dir_id):
+        """
+        Returns ((fingerprint, records, snapshot), scan start time, scan duration) for the given folder or None if it has to be
+        scanned on its own. records is None if a pool process only returned the fingerprint.
+        """
+        cfg = self.cfg
+        with self._lock:
+            if backup_dir_id not in self.roots:
+                return None
+            if cfg.prescan_processes > 0:
+                if self._futures is None:
+                    self._scanned_at = time.time()
+                    self._futures = {}
+                    for group in self._groups():
+                        fut = FastScanPool.submit(cfg.prescan_processes, group, cfg.prescan_workers, cfg.prescan_index, cfg.scan_snapshots)
+                        self._futures.update((key, fut) for key in group)
+                    logging.info(f"Submitted pre-scan of {len(self.roots)} folders to {cfg.prescan_processes} processes")
+                fut = self._futures.pop(backup_dir_id, None)
+            elif self._results is None:
+                self._scanned_at = time.time()
+                results = FastScan.scan_roots(self.roots, cfg.prescan_workers, cfg.scan_snapshots)
+                scan_sec = time.time() - self._scanned_at
+                total_dirs = sum(len(r) for r in results.values())
+                # split the duration by the number of directories each root contains
+                self._results = {key: BackupTask.prescan_result(records, cfg, scan_sec * len(records) / max(1, total_dirs)) for key, records in results.items()}
+                logging.info(f"Pre-scanned {len(self.roots)} nested folders in {scan_sec:.1f}s")
+
+        if cfg.prescan_processes > 0:
+            if fut is None:
+                return None
+            fp, records, snapshot, scan_sec = fut.result()[backup_dir_id]
+            result = (fp, records, snapshot), scan_sec
+        else:
+            with self._lock:
+                result = self._results.pop(backup_dir_id, None)
+            if result is None:
+                return None
+        if time.time() > self._scanned_at + self.MAX_AGE:
+            return None
+        return result[0], self._scanned_at, result[1]
+
+
+class PermanentTagBatch:
+    """
+    Latest snapshots of folders found vanished in one scheduler cycle. They get the 'permanent' tag in one restic call
+    by a TagVanishedTask once every BackupTask of the cycle got past its check whether the folder still exists.
+    """
+    def __init__(self, entries:list[BackupDir]):
+        self._cond = threading.Condition()
+        self._pending = {e.id for e in entries}
+        self._snaps = {}        # backup_dir_id -> (tag, snapshot id)
+        # only touched on the UI thread
+        self._finalized = set()
+        self._tagged = set()
+
+    def add(self, backup_dir_id, tag, snap_id):
+        with self._cond:
+            self._snaps[backup_dir_id] = (tag, snap_id)
+
+    def checked(self, backup_dir_id):
+        """ The folder won't be added anymore, also called for tasks that didn't get submitted. """
+        with self._cond:
+            self._pending.discard(backup_dir_id)
+            self._cond.notify_all()
+
+    def wait(self) -> dict:
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+            return dict(self._snaps)
+
+    def finalize(self, entry:BackupDir):
+        """ Called from BackupTask.on_final before the entry gets saved. """
+        self._finalized.add(entry.id)
+        if entry.id in self._tagged:
+            entry.n_backups_since_last_perm_tag = 0
+
+    def tagged(self, backup_dir_ids) -> list:
+        """ Returns the folders whose BackupTask already saved its result, their counters need a reset in the database. """
+        self._tagged.update(backup_dir_ids)
+        return [i for i in backup_dir_ids if i in self._finalized]
+
+
+class TagVanishedTask(WorkerTask):
+    def __init__(self, env, batch:PermanentTagBatch, snapshot_listing:'SnapshotListing|None', no_lock, **kwargs):
+        super().__init__(**kwargs)
+        self.env = env
+        self.batch = batch
+        self.snapshot_listing = snapshot_listing
+        self.no_lock = no_lock
+
+    def run(self):
+        snaps = self.batch.wait()
+        if not snaps:
+            return []
+        logging.info(f"Tagging the latest snapshots of {len(snaps)} vanished folders as permanent.")
+        Restic().tag_snapshots(self.env, [snap_id for _, snap_id in snaps.values()], "permanent", no_lock=self.no_lock)
+        if self.snapshot_listing:
+            for tag, _ in snaps.values():
+                self.snapshot_listing.discard(tag)
+        return list(snaps)
+
+    def on_success(self, res):
+        ids = self.batch.tagged(res)
+        with common.db_conn as conn:
+            conn.executemany("UPDATE backup_dirs SET n_backups_since_last_perm_tag=0 WHERE id=?", ((i,) for i in ids))
+
+    def on_failure(self, e):
+        logging.error(f"Failed to tag snapshots of vanished folders: {e}")
+
+
+class SnapshotListing:
+    """
+    Snapshots of the whole repository, read from the catalog once per scheduler cycle and partitioned by tag,
+    so the BackupTasks of a cycle don't list their own tags one by one. Snapshots of our own backups get added,
+    tags whose snapshots our tag or forget calls replaced are read again.
+    """
+    def __init__(self, env, no_lock):
+        self.env = env
+        self.no_lock = no_lock
+        self._lock = threading.Lock()
+        self._by_tag:dict[str, list]|None = None
+        self._stale = set()
+
+    def _load(self):
+        with closing(DB.connect()) as conn:
+            snaps = Restic().snapshot_catalog(conn, self.env, self.no_lock).snapshots()
+        by_tag = {}
+        for s in snaps:
+            for tag in s.get('tags') or []:
+                by_tag.setdefault(tag, []).append(s)
+        logging.info(f"Snapshot listing for this cycle: {len(snaps)} snapshots, {len(by_tag)} tags")
+        return by_tag
+
+    def snapshots(self, tag, latest_n=None) -> list:
+        with self._lock:
+            if self._by_tag is None:
+                self._by_tag = self._load()
+            if tag in self._stale:
+                with closing(DB.connect()) as conn:
+                    self._by_tag[tag] = Restic().snapshot_catalog(conn, self.env, self.no_lock).snapshots(tag)
+                self._stale.discard(tag)
+            snaps = self._by_tag.get(tag, [])
+        if latest_n is not None and int(latest_n) > 0:
+            return snaps[-int(latest_n):]
+        return list(snaps)
+
+    def discard(self, tag):
+        with self._lock:
+            self._stale.add(tag)
+
+    def add_backup(self, summary:str|None):
+        """ Adds the snapshot a backup created, without waiting for the next catalog sync. """
+        snap_id = json.loads(summary).get('snapshot_id') if summary else None
+        if not snap_id:
+            # --skip-if-unchanged didn't create one
+            return
+        try:
+            snaps = Restic().fetch_snapshots(self.env, [snap_id], self.no_lock)
+        except Exception as e:
+            logging.error(f"Failed to read new snapshot {snap_id}: {e}")
+            return
+        with closing(DB.connect()) as conn, conn:
+            catalog = SnapshotCatalog(conn, self.env)
+            catalog.add(snaps)
+        with self._lock:
+            for s in snaps:
+                s['_time'] = SnapshotCatalog.snapshot_time(s)
+                if self._by_tag is None:
+                    continue
+                for tag in s.get('tags') or []:
+                    lst = self._by_tag.setdefault(tag, [])
+                    if all(x['id'] != s['id'] for x in lst):
+                        lst.append(s)
+                        lst.sort(key=lambda x: (x['_time'], x['id']))
+
+
 class BackupTask(WorkerTask):
-    def __init__(self, env, backup_dir:BackupDir, config, **kwargs):
+    # ids of backup dirs with changes found by a prescan_only run or an interrupted prescan, their backup is still due
+    deferred_ids = set()
+    parallel = True
+
+    def __init__(self, env, backup_dir:BackupDir, config, prescan_only=False, prescan_batch:PrescanBatch|None=None,
+                 snapshot_listing:SnapshotListing|None=None, tag_batch:PermanentTagBatch|None=None, **kwargs):
         super().__init__(**kwargs)
         self.env = env
         self.backup_dir = backup_dir
         self.config = config
+        self.prescan_only = prescan_only
+        self.prescan_batch = prescan_batch
+        self.snapshot_listing = snapshot_listing
+        self.tag_batch = tag_batch
+        self.started_at = None
+        self.deferred = False
+        self.prescan_sec = None
+        self.prescan_stats = None
+        self.backup_progress = None
+        self.backup_summary = None
+        self.full_check = False
+
+    @property
+    def description(self) -> str:
+        return f"{'Prescan' if self.prescan_only else 'Backup'} {self.backup_dir.path}"
 
     def on_final(self):
+        if self.tag_batch is not None:
+            self.tag_batch.checked(self.backup_dir.id)
+            self.tag_batch.finalize(self.backup_dir)
+        if self.prescan_stats is not None:
+            self.prescan_stats.save(common.db_conn)
+        if self.backup_progress is not None:
+            ThroughputLog.save(common.db_conn, self.backup_dir.id, self.backup_progress, self.backup_summary)
+        if self.backup_summary is not None and not self.full_check:
+            # full checks rehash everything, they say nothing about the next backup
+            BackupCost(common.db_conn).add(common.db_conn, self.backup_dir.id, self.backup_summary)
+        if self.deferred:
+            BackupTask.deferred_ids.add(self.backup_dir.id)
+            return
+        BackupTask.deferred_ids.discard(self.backup_dir.id)
         self.backup_dir.save_backup_result()
+        if self.started_at is not None and not self.backup_dir.error:
+            ChangeWatcher.mark_scanned(self.backup_dir.id, self.started_at)
+        if self.backup_summary is not None and not self.backup_dir.error:
+            # the backup is saved, checking and pruning run on their own
+            if self.config.bitrot_detection:
+                BitrotCheckTask.submit(self.env, self.backup_dir, self.config, self.snapshot_listing)
+            elif self.config.prune_enabled:
+                logging.warning("Pruning with disabled bitrot detection is not recommended.")
+                PruneTask.add(self.env, self.backup_dir, self.config, self.snapshot_listing)
 
     def run(self):
         restic = Restic()
@@ -236,21 +587,31 @@ class BackupTask(WorkerTask):
         cfg:Config = self.config
         env = self.env
         now = time.time()
+        self.started_at = now
 
         try:
             entry.error = ""
-            if not entry.path.exists():
-                if cfg.make_vanished_permanent and entry.n_backups_since_last_perm_tag > 0:
-                    try:
-                        snaps = restic.list_snapshots(cfg, env, entry.get_tag(), latest_n=1)
-                        if snaps:
-                            latest = snaps[-1]
+            vanished = not entry.path.exists()
+            if vanished and cfg.make_vanished_permanent and entry.n_backups_since_last_perm_tag > 0:
+                try:
+                    snaps = self.list_snapshots(restic, entry.get_tag(), latest_n=1)
+                    if snaps:
+                        latest = snaps[-1]
+                        if self.tag_batch is not None:
+                            logging.info(f"Path {entry.path} vanished. Snapshot {latest['short_id']} gets tagged as permanent with the others of this cycle.")
+                            self.tag_batch.add(entry.id, entry.get_tag(), latest['id'])
+                        else:
                             logging.info(f"Path {entry.path} vanished. Tagging snapshot {latest['short_id']} as permanent.")
                             restic.tag_snapshot(env, latest['id'], "permanent", no_lock=cfg.no_lock)
+                            if self.snapshot_listing:
+                                self.snapshot_listing.discard(entry.get_tag())
                             entry.n_backups_since_last_perm_tag = 0
-                    except Exception as e:
-                        logging.error(f"Failed to tag vanished snapshot for {entry.path}: {e}")
+                except Exception as e:
+                    logging.error(f"Failed to tag vanished snapshot for {entry.path}: {e}")
+            if self.tag_batch is not None:
+                self.tag_batch.checked(entry.id)
 
+            if vanished:
                 if entry.enabled == 'yes':
                     raise Exception("Directory not found")
                 if entry.fastscan_fingerprint == "0":
@@ -258,30 +619,68 @@ class BackupTask(WorkerTask):
                 return entry
 
             should_run = True
-            if entry.fastscan_fingerprint == "0":
+            scan_snapshot = None
+            new_fp = None
+            stats = None
+            if cfg.prescan_autotune:
+                with closing(DB.connect()) as conn:
+                    stats = self.prescan_stats = PrescanStats(conn, entry.id)
+            # the prescan of this folder got disabled for being too slow, measure it again from time to time
+            probe = entry.fastscan_fingerprint == "0" and cfg.prescan_enabled and stats is not None and stats.probe_due(now)
+            if entry.fastscan_fingerprint == "0" and not probe:
                 should_run = True
             else:
                 if not cfg.prescan_enabled:
                     should_run = True
+                elif cfg.change_watcher and ChangeWatcher.is_clean(entry.id):
+                    logging.info(f"Change watcher reported no changes for {entry.path}.")
+                    should_run = False
                 else:
                     try:
-                        fp = FastScan.directory_fingerprint(entry.path)
+                        fp, records, scan_snapshot = self.prescan(entry, cfg)
+                        if cfg.prescan_index and records is not None:
+                            with closing(DB.connect()) as conn:
+                                fp, changed_dirs = FastScanIndex(conn, entry.id).update(entry.path, records=records)
+                            if changed_dirs:
+                                logging.info(f"Pre-scan of {entry.path} found changes below: {', '.join(d or '.' for d in changed_dirs[:20])}"
+                                             + (f" (+{len(changed_dirs) - 20} more)" if len(changed_dirs) > 20 else ""))
                         
-                        if fp is None:
+                        if stats is not None and self.prescan_sec is not None:
+                            stats.add_scan(self.prescan_sec, restart=probe)
+                            ref = stats.reference_sec()
+                            if probe:
+                                if stats.should_enable():
+                                    logging.info(f"Re-enabling pre-scan for '{entry.path}' (took {self.prescan_sec:.1f}s, restic ~{ref or 0:.1f}s).")
+                                    probe = False
+                                    entry.fastscan_fingerprint = ""
+                                else:
+                                    stats.probe_at = now + common.PRESCAN_PROBE_IVAL
+                            elif stats.should_disable():
+                                logging.info(f"Pre-scan of '{entry.path}' takes {stats.scan_sec:.1f}s on average, not faster than restic (~{ref:.1f}s).")
+                                fp = None
+                                stats.probe_at = now + common.PRESCAN_PROBE_IVAL
+
+                        if probe:
+                            should_run = True
+                        elif fp is None:
                             entry.fastscan_fingerprint = "0"
                             should_run = True
                             logging.info(f"Disabling pre-scan for '{entry.path}'.")
                         else:
                             if fp != entry.fastscan_fingerprint:
                                 should_run = True
-                                entry.fastscan_fingerprint = fp
+                                new_fp = fp
                             else:
                                 should_run = False
+                    except ScanInterrupted:
+                        logging.info(f"Pre-scan of {entry.path} interrupted, will resume later.")
+                        self.deferred = True
+                        return entry
                     except Exception as e:
                         logging.error(f"Scan failed for {entry.path}: {e}")
                         should_run = True
             
-            full_check = now >= entry.last_fullcheck + cfg.full_check_frequency
+            full_check = self.full_check = now >= entry.last_fullcheck + cfg.full_check_frequency
 
             if full_check:
                 should_run = True
@@ -290,18 +689,37 @@ class BackupTask(WorkerTask):
                 logging.info(f"Skipping {entry.path}: No changes detected during pre-scan.")
                 return entry
 
-            entry.summary = restic.run_backup_cmd(entry.path, env, full_check, cfg.no_lock, entry.iexclude)
+            if self.prescan_only:
+                logging.info(f"Changes detected in {entry.path}, backup waits for user idle.")
+                self.deferred = True
+                return entry
+
+            # only now, a deferred backup must still see the changes when its prescan runs again
+            if new_fp is not None:
+                entry.fastscan_fingerprint = new_fp
+
+            if scan_snapshot is not None:
+                self.log_scan_delta(entry, scan_snapshot)
+
+            # the previous summary is the estimate for the totals, restic doesn't count them with --no-scan
+            progress = self.backup_progress = BackupProgress(entry.summary)
+            # the new snapshot isn't checked yet, a prune must not go ahead for the folder once the backup releases the repository
+            entry.summary = self.backup_summary = restic.run_backup_cmd(entry.path, env, full_check, cfg.no_lock, entry.iexclude,
+                                                                        on_status=lambda js: self.report_progress(progress.update(js)),
+                                                                        on_snapshot=lambda _: PruneTask.discard(entry.id))
+            if self.snapshot_listing:
+                self.snapshot_listing.add_backup(entry.summary)
+            if stats is not None and not full_check:
+                # full checks rehash everything and would distort the average
+                stats.add_backup(entry.summary)
+
+            if scan_snapshot is not None:
+                # the baseline for the next delta is the state that got backed up
+                try:
+                    scan_snapshot.save(entry.scan_snapshot_path())
+                except OSError as e:
+                    logging.error(f"Failed to save file list for {entry.path}: {e}")
             
-            if cfg.bitrot_detection:
-                logging.info(f"Checking for bitrot for {entry.path}...")
-                entry.bitrot_snap = restic.check_bitrot(cfg, env, entry.get_tag(), entry.bitrot_snap)
-
-            if cfg.prune_enabled:
-                logging.info(f"Pruning repository for {entry.path}... (not recommended on consumer grade hw)")
-                if not cfg.bitrot_detection:
-                    logging.warning("Pruning with disabled bitrot detection is not recommended.")
-                restic.forget_some(entry.get_tag(), env)
-                
             entry.n_backups_since_last_perm_tag += 1
             if full_check:
                 entry.last_fullcheck = now
@@ -311,6 +729,202 @@ class BackupTask(WorkerTask):
 
         return entry
 
+    def list_snapshots(self, restic:Restic, tag, latest_n=None) -> list:
+        if self.snapshot_listing:
+            return self.snapshot_listing.snapshots(tag, latest_n)
+        return restic.list_snapshots(self.config, self.env, tag, latest_n)
+
+    def prescan(self, entry:BackupDir, cfg:Config):
+        """ Returns (fingerprint, records or None, ScanSnapshot or None). """
+        if cfg.prescan_budget <= 0:
+            shared = self.prescan_batch.take(entry.id) if self.prescan_batch else None
+            if shared is not None:
+                result, self.started_at, self.prescan_sec = shared
+                return result
+            t0 = time.monotonic()
+            if cfg.prescan_processes > 0:
+                roots = {entry.id: (entry.path, entry.iexclude)}
+                fp, records, snapshot, _ = FastScanPool.submit(cfg.prescan_processes, roots, cfg.prescan_workers, cfg.prescan_index, cfg.scan_snapshots).result()[entry.id]
+                self.prescan_sec = time.monotonic() - t0
+                return fp, records, snapshot
+            records = FastScan.scan_tree(entry.path, cfg.prescan_workers, entry.iexclude, with_files=cfg.scan_snapshots)
+            self.prescan_sec = time.monotonic() - t0
+            return BackupTask.prescan_result(records, cfg)[0]
+
+        # budgeted prescans are slow on purpose, their duration says nothing about their cost
+        with closing(DB.connect()) as conn:
+            checkpoint = PrescanCheckpoint(conn, entry.id, entry.path, entry.iexclude)
+            # resumed directories carry no per-file data, so the file list needs a complete scan
+            records = {} if cfg.scan_snapshots else checkpoint.load()
+            if records:
+                logging.info(f"Resuming pre-scan of {entry.path} ({len(records)} folders already scanned)")
+            budget = ScanBudget(cfg.prescan_budget, should_stop=lambda: common.shutdown_requested or common.system_suspended,
+                                on_checkpoint=None if cfg.scan_snapshots else checkpoint.save)
+            try:
+                FastScan.scan_tree(entry.path, cfg.prescan_workers, entry.iexclude, cfg.scan_snapshots, budget, records)
+            except ScanInterrupted:
+                budget.checkpoint(records, force=True)
+                raise
+            checkpoint.clear()
+            return BackupTask.prescan_result(records, cfg)[0]
+
+    @staticmethod
+    def prescan_result(records, cfg:Config, scan_sec=None):
+        snapshot = ScanSnapshot.from_records(records) if cfg.scan_snapshots else None
+        return (FastScan.fingerprint(records), records, snapshot), scan_sec
+
+    @staticmethod
+    def log_scan_delta(entry:BackupDir, snapshot:ScanSnapshot):
+        baseline = ScanSnapshot.load(entry.scan_snapshot_path())
+        if baseline is None:
+            logging.info(f"Pre-scan of {entry.path}: {len(snapshot)} files, {common.format_bytes(snapshot.total_bytes())} (no previous file list)")
+            return
+        delta = ScanSnapshot.delta(baseline, snapshot)
+        fmt = common.format_bytes
+        logging.info(f"Pre-scan of {entry.path}: {len(delta.added)} added ({fmt(delta.added_bytes)}), {len(delta.removed)} removed ({fmt(delta.removed_bytes)}), "
+                     f"{len(delta.modified)} modified ({fmt(delta.modified_bytes)}) files, expected upload at most {fmt(delta.upload_bytes)}")
+        for label, paths in (("added", delta.added), ("removed", delta.removed), ("modified", delta.modified)):
+            for p in sorted(paths)[:20]:
+                logging.debug(f"  {label}: {p}")
+            if len(paths) > 20:
+                logging.debug(f"  ... +{len(paths) - 20} more {label}")
+
+class BitrotCheckTask(WorkerTask):
+    """
+    Compares the new snapshots of a backup folder with their predecessors. Runs in the background lane next to the
+    backups, the backup result is already saved. Only a folder whose check passed gets pruned.
+    """
+    lane = WorkerTask.BACKGROUND
+    read_only = True
+    _lock = threading.Lock()
+    _recheck = set()  # backup dir ids with a backup the running or queued check may not have seen
+
+    def __init__(self, env, backup_dir:BackupDir, config:Config, snapshot_listing:SnapshotListing|None=None, **kwargs):
+        super().__init__(**kwargs)
+        self.env = env
+        self.backup_dir = backup_dir
+        self.config = config
+        self.snapshot_listing = snapshot_listing
+        self.no_lock = config.no_lock
+
+    @staticmethod
+    def submit(env, backup_dir:BackupDir, config:Config, snapshot_listing:SnapshotListing|None=None):
+        with BitrotCheckTask._lock:
+            BitrotCheckTask._recheck.add(backup_dir.id)
+        # a check of the folder that is already queued or running covers this backup too
+        WorkerThread.submit_task(BitrotCheckTask(env, backup_dir, config, snapshot_listing, task_id=f"bitrot_{backup_dir.id}"))
+
+    @property
+    def description(self) -> str:
+        return f"Bitrot check {self.backup_dir.path}"
+
+    def run(self):
+        restic = Restic()
+        entry = self.backup_dir
+        cfg = copy.copy(self.config)
+        cfg.no_lock = self.no_lock
+        tag = entry.get_tag()
+        # the entry may be older than the last check of the folder
+        with closing(DB.connect()) as conn:
+            row = conn.execute("SELECT bitrot_snap FROM backup_dirs WHERE id=?", (entry.id,)).fetchone()
+        bitrot_snap = (row[0] if row else entry.bitrot_snap) or ""
+        snaps = self.snapshot_listing.snapshots(tag) if self.snapshot_listing else None
+        while True:
+            with BitrotCheckTask._lock:
+                BitrotCheckTask._recheck.discard(entry.id)
+            logging.info(f"Checking for bitrot for {entry.path}...")
+            # the folder isn't pending for a prune while its check runs, each diff holds the repository lock itself
+            bitrot_snap = restic.check_bitrot(cfg, self.env, tag, bitrot_snap, snaps)
+            with BitrotCheckTask._lock:
+                if entry.id not in BitrotCheckTask._recheck:
+                    return bitrot_snap
+            # another backup finished meanwhile, its snapshot isn't in the listing
+            snaps = None
+
+    def on_success(self, bitrot_snap):
+        entry = self.backup_dir
+        entry.bitrot_snap = bitrot_snap
+        entry.check_error = ""
+        with common.db_conn as conn:
+            conn.execute("UPDATE backup_dirs SET bitrot_snap=?, check_error='' WHERE id=?", (bitrot_snap, entry.id))
+        if self.config.prune_enabled:
+            PruneTask.add(self.env, entry, self.config, self.snapshot_listing)
+
+    def on_failure(self, e):
+        entry = self.backup_dir
+        logging.error(f"Bitrot check failed for {entry.path}: {e}")
+        # stays until a check passes, backups of the folder don't clear it
+        entry.check_error = f"Bitrot check failed: {e}"
+        with common.db_conn as conn:
+            conn.execute("UPDATE backup_dirs SET check_error=? WHERE id=?", (entry.check_error, entry.id))
+
+
+class PruneTask(WorkerTask):
+    """
+    forget --prune for all folders whose bitrot check passed since the last prune, with a single prune of the
+    repository. Queued behind the backups that are already waiting, only one of it is queued at a time.
+    """
+    _lock = threading.Lock()
+    _pending = {}  # backup dir id -> (tag, SnapshotListing or None)
+    _discarded = set()  # ids discarded while a prune runs
+
+    def __init__(self, env, config:Config, **kwargs):
+        super().__init__(**kwargs)
+        self.env = env
+        self.config = config
+        self.pruned = {}
+
+    @staticmethod
+    def add(env, backup_dir:BackupDir, config:Config, snapshot_listing:SnapshotListing|None=None):
+        with PruneTask._lock:
+            PruneTask._pending[backup_dir.id] = (backup_dir.get_tag(), snapshot_listing)
+        WorkerThread.submit_task(PruneTask(env, config, task_id="prune"))
+
+    @staticmethod
+    def discard(backup_dir_id):
+        """ The folder has a snapshot whose bitrot check is still outstanding. """
+        with PruneTask._lock:
+            PruneTask._pending.pop(backup_dir_id, None)
+            PruneTask._discarded.add(backup_dir_id)
+
+    @property
+    def description(self) -> str:
+        return "Prune"
+
+    def run(self):
+        # the backups running meanwhile discard their folders until they release the repository
+        with RepoLock.exclusive():
+            with PruneTask._lock:
+                self.pruned = PruneTask._pending
+                PruneTask._pending = {}
+                PruneTask._discarded.clear()
+            if not self.pruned:
+                return
+            logging.info(f"Pruning repository for {len(self.pruned)} folders... (not recommended on consumer grade hw)")
+            Restic().forget_tags([tag for tag, _ in self.pruned.values()], self.env)
+
+    def on_success(self, res):
+        for tag, listing in self.pruned.values():
+            if listing:
+                listing.discard(tag)
+
+    def on_failure(self, e):
+        logging.error(f"Prune failed: {e}")
+        # like a failed backup, in the folder list and the error toast until the next backup of the folder
+        with common.db_conn as conn:
+            conn.executemany("UPDATE backup_dirs SET error=? WHERE id=?", [(f"Prune failed: {e}", id) for id in self.pruned])
+        retry = False
+        with PruneTask._lock:
+            # again with the next prune, unless a newer backup is waiting for its check
+            for id, pending in self.pruned.items():
+                if id not in PruneTask._discarded:
+                    PruneTask._pending.setdefault(id, pending)
+                    retry = True
+        if retry and common.root:
+            # a prune for another folder may take them along earlier, then this one finds nothing to do
+            common.root.after(common.PRUNE_RETRY_IVAL * 1000, lambda: WorkerThread.submit_task(PruneTask(self.env, self.config, task_id="prune")))
+
+
 class AutoDiscoveryTask(WorkerTask):
     def run(self):
         scanner = DefaultDirsScanner()
@@ -356,9 +970,11 @@ class RepoFullCheckTask(WorkerTask):
                 
     def run(self):
         if self.segment == 0:
-            if common.RESTIC_CACHE_DIR.exists():
-                shutil.rmtree(common.RESTIC_CACHE_DIR)
-                logging.info("Restic cache cleared")
+            # parallel backups use the cache
+            with RepoLock.exclusive():
+                if common.RESTIC_CACHE_DIR.exists():
+                    shutil.rmtree(common.RESTIC_CACHE_DIR)
+                    logging.info("Restic cache cleared")
             return 0
         
         restic = Restic()
@@ -368,8 +984,19 @@ class RepoFullCheckTask(WorkerTask):
 class WorkerThread(threading.Thread):
     _task_queue:queue.Queue[WorkerTask|None] = queue.Queue()
     _task_id_set:set[str] = set()
+    _running:list[WorkerTask] = []
     _singleton:threading.Thread|None = None
     _lock = threading.RLock()
+    _slots_changed = threading.Condition(_lock)
+    _slots = 1
+    _slots_busy = 0
+    _interactive_queue:queue.Queue[WorkerTask|None] = queue.Queue()
+    _interactive_threads:list[threading.Thread] = []
+    _interactive_idle = 0
+    _interactive_limit = common.DEFAULT_INTERACTIVE_WORKERS
+    _interactive_no_lock = True
+    _background_queue:queue.Queue[WorkerTask|None] = queue.Queue()
+    _background_thread:threading.Thread|None = None
     _shutdown_requested = False
 
     @staticmethod
@@ -388,13 +1015,33 @@ class WorkerThread(threading.Thread):
             if task._task_id is None or not WorkerThread.have_task_id(task):
                 if task._task_id is not None:
                     WorkerThread._task_id_set.add(task._task_id)
-                WorkerThread._task_queue.put(task)
-                WorkerThread.start_worker_thread()
+                if task.lane != WorkerTask.MAINTENANCE and WorkerThread._interactive_no_lock and task.read_only:
+                    # reads don't need to wait for restic's locks, don't leave stale ones and save the lock file roundtrips
+                    task.no_lock = True
+                if task.lane == WorkerTask.INTERACTIVE:
+                    WorkerThread._interactive_queue.put(task)
+                    WorkerThread._start_interactive_worker()
+                elif task.lane == WorkerTask.BACKGROUND:
+                    WorkerThread._background_queue.put(task)
+                    WorkerThread._start_background_worker()
+                else:
+                    WorkerThread._task_queue.put(task)
+                    WorkerThread.start_worker_thread()
                 return True
             return False
 
-    def __init__(self, name):
+    @staticmethod
+    def configure(cfg:Config):
+        """ Concurrency limits of the lanes. With one backup slot, backups run in the worker thread itself like all other maintenance tasks. """
+        with WorkerThread._lock:
+            WorkerThread._slots = max(1, int(cfg.backup_slots))
+            WorkerThread._slots_changed.notify_all()
+            WorkerThread._interactive_limit = max(1, int(cfg.interactive_workers))
+            WorkerThread._interactive_no_lock = cfg.interactive_no_lock
+
+    def __init__(self, name, lane=WorkerTask.MAINTENANCE):
         super().__init__(daemon=True, name=name)
+        self.lane = lane
 
     def _dispatch_ui(self, func, *args):
         if not func:
@@ -404,41 +1051,151 @@ class WorkerThread(threading.Thread):
         else:
             logging.error(f"no root_tk, in shutdown? self={self}")
 
+    def _execute(self, task:WorkerTask, task_queue:queue.Queue, in_slot=False):
+        try:
+            try:
+                task.run_started_at = time.time()
+                res = task.run()
+                self._dispatch_ui(task.on_success, res)
+            except Exception as e:
+                self._dispatch_ui(task.on_failure, e)
+            finally:
+                self._dispatch_ui(task.on_final)
+        finally:
+            with WorkerThread._lock:
+                WorkerThread._running.remove(task)
+                if task._task_id is not None:
+                    self._task_id_set.remove(task._task_id)
+                if in_slot:
+                    WorkerThread._slots_busy -= 1
+                    WorkerThread._slots_changed.notify_all()
+            task_queue.task_done()
+
+    def _start_in_slot(self, task:WorkerTask) -> bool:
+        """ Waits for a free slot while the others are busy. False if the task should run in the worker thread. """
+        with WorkerThread._lock:
+            if WorkerThread._slots <= 1 and WorkerThread._slots_busy == 0:
+                return False
+            while WorkerThread._slots_busy >= WorkerThread._slots:
+                WorkerThread._slots_changed.wait()
+            WorkerThread._slots_busy += 1
+            WorkerThread._running.append(task)
+        threading.Thread(target=self._execute, args=(task, self._task_queue, True), daemon=True, name="WorkerSlot").start()
+        return True
+
+    def _wait_for_slots(self):
+        with WorkerThread._lock:
+            while WorkerThread._slots_busy > 0:
+                WorkerThread._slots_changed.wait()
+
     def run(self):
-        logging.debug("Worker thread started loop")
+        logging.debug(f"{self.name} started loop")
         with SleepInhibitor():
-            while True:
-                try:
-                    task = self._task_queue.get(timeout=5)
-                except queue.Empty:
-                    with WorkerThread._lock:
-                        if self._task_queue.empty():
-                            WorkerThread._singleton = None
-                            break
-                        continue
-                except:
-                    break
-                
-                if task is None:
-                    with WorkerThread._lock:
+            if self.lane == WorkerTask.INTERACTIVE:
+                self._run_interactive()
+            elif self.lane == WorkerTask.BACKGROUND:
+                self._run_background()
+            else:
+                self._run_maintenance()
+        logging.debug(f"{self.name} exiting")
+
+    def _run_maintenance(self):
+        while True:
+            try:
+                task = self._task_queue.get(timeout=5)
+            except queue.Empty:
+                with WorkerThread._lock:
+                    if self._task_queue.empty() and WorkerThread._slots_busy == 0:
                         WorkerThread._singleton = None
-                    self._task_queue.task_done()
-                    break
+                        break
+                    continue
+            except:
+                break
+            
+            if task is None:
+                # let the backups in the slots finish, like a running task in the worker thread
+                self._wait_for_slots()
+                with WorkerThread._lock:
+                    WorkerThread._singleton = None
+                self._task_queue.task_done()
+                break
 
-                try:
-                    try:
-                        res = task.run()
-                        self._dispatch_ui(task.on_success, res)
-                    except Exception as e:
-                        self._dispatch_ui(task.on_failure, e)
-                    finally:
-                        self._dispatch_ui(task.on_final)
-                finally:
-                    if task._task_id is not None:
-                        with WorkerThread._lock:
-                            self._task_id_set.remove(task._task_id)
-                    self._task_queue.task_done()
-        logging.debug("Worker thread exiting")
+            if task.parallel and self._start_in_slot(task):
+                continue
+            with WorkerThread._lock:
+                WorkerThread._running.append(task)
+            self._execute(task, self._task_queue)
+
+    def _run_interactive(self):
+        task_queue = WorkerThread._interactive_queue
+        while True:
+            with WorkerThread._lock:
+                WorkerThread._interactive_idle += 1
+            try:
+                task = task_queue.get(timeout=5)
+            except queue.Empty:
+                with WorkerThread._lock:
+                    WorkerThread._interactive_idle -= 1
+                    if task_queue.empty():
+                        WorkerThread._interactive_threads.remove(self)
+                        break
+                    continue
+            with WorkerThread._lock:
+                WorkerThread._interactive_idle -= 1
+                if task is None:
+                    WorkerThread._interactive_threads.remove(self)
+                else:
+                    WorkerThread._running.append(task)
+            if task is None:
+                task_queue.task_done()
+                break
+            self._execute(task, task_queue)
+
+    def _run_background(self):
+        task_queue = WorkerThread._background_queue
+        while True:
+            try:
+                task = task_queue.get(timeout=5)
+            except queue.Empty:
+                with WorkerThread._lock:
+                    if task_queue.empty():
+                        WorkerThread._background_thread = None
+                        break
+                    continue
+            if task is None:
+                with WorkerThread._lock:
+                    WorkerThread._background_thread = None
+                task_queue.task_done()
+                break
+            with WorkerThread._lock:
+                WorkerThread._running.append(task)
+            self._execute(task, task_queue)
+
+    @staticmethod
+    def _start_background_worker():
+        with WorkerThread._lock:
+            if WorkerThread._background_thread and WorkerThread._background_thread.is_alive():
+                return
+            WorkerThread._background_thread = WorkerThread("BackgroundWorker", WorkerTask.BACKGROUND)
+            WorkerThread._background_thread.start()
+
+    @staticmethod
+    def _start_interactive_worker():
+        with WorkerThread._lock:
+            if WorkerThread._interactive_idle > 0 or len(WorkerThread._interactive_threads) >= WorkerThread._interactive_limit:
+                return
+            t = WorkerThread("InteractiveWorker", WorkerTask.INTERACTIVE)
+            WorkerThread._interactive_threads.append(t)
+            t.start()
+
+    @staticmethod
+    def running_tasks() -> list[WorkerTask]:
+        with WorkerThread._lock:
+            return list(WorkerThread._running)
+
+    @staticmethod
+    def queued_count() -> int:
+        return WorkerThread._task_queue.qsize() + WorkerThread._interactive_queue.qsize() + WorkerThread._background_queue.qsize()
 
     @staticmethod
     def start_worker_thread():
@@ -452,28 +1209,43 @@ class WorkerThread(threading.Thread):
             WorkerThread._singleton.start()
             logging.debug("Worker thread started.")
 
+    @staticmethod
+    def _drain(task_queue:queue.Queue):
+        while True:
+            try:
+                task_queue.get_nowait()
+                # Do not call task_done for tasks that are not processed.
+            except queue.Empty:
+                break
+
     @staticmethod
     def shutdown():
         with WorkerThread._lock:
             WorkerThread._shutdown_requested = True
             if WorkerThread._singleton and WorkerThread._singleton.is_alive():
                 # Drain the queue to cancel pending tasks.
-                while True:
-                    try:
-                        WorkerThread._task_queue.get_nowait()
-                        # Do not call task_done for tasks that are not processed.
-                    except queue.Empty:
-                        break
+                WorkerThread._drain(WorkerThread._task_queue)
                 WorkerThread._task_queue.put(None)
+            WorkerThread._drain(WorkerThread._interactive_queue)
+            for _ in WorkerThread._interactive_threads:
+                WorkerThread._interactive_queue.put(None)
+            if WorkerThread._background_thread and WorkerThread._background_thread.is_alive():
+                WorkerThread._drain(WorkerThread._background_queue)
+                WorkerThread._background_queue.put(None)
 
     @staticmethod
     def waitjoin():
-        if WorkerThread._singleton and WorkerThread._singleton.is_alive():
-            logging.debug("waiting for worker thread to finish...")
-            WorkerThread._singleton.join()
-            logging.debug("worker thread finished")
+        with WorkerThread._lock:
+            threads = [WorkerThread._singleton, WorkerThread._background_thread] + WorkerThread._interactive_threads
+        for t in threads:
+            if t and t.is_alive():
+                logging.debug(f"waiting for {t.name} to finish...")
+                t.join()
+                logging.debug(f"{t.name} finished")
 
     @staticmethod
     def isalive() -> bool:
         with WorkerThread._lock:
-            return WorkerThread._singleton is not None and WorkerThread._singleton.is_alive()
\ No newline at end of file
+            return (WorkerThread._singleton is not None and WorkerThread._singleton.is_alive()) or \
+                (WorkerThread._background_thread is not None and WorkerThread._background_thread.is_alive()) or \
+                any(t.is_alive() for t in WorkerThread._interactive_threads)